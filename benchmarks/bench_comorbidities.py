@@ -0,0 +1,55 @@
+import os
+import sys
+import timeit
+import warnings
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipelines"))
+from model import dataPreprocessing
+
+
+def comorbidity_column(n, n_comorbidities=300, max_items=4, missing=0.45, seed=0):
+    '''
+    Constructs a column shaped like 'Non-cancer illness code, self-reported | Instance 0'
+
+    Returns
+    -------
+    s : pandas series object
+    '''
+    rng = np.random.default_rng(seed)
+    names = np.array(["comorbidity %d" % i for i in range(n_comorbidities)], dtype=object)
+    s = ["|".join(rng.choice(names, size=rng.integers(1, max_items+1), replace=False)) for i in range(n)]
+    s = pd.Series(s, dtype=object)
+    s[rng.random(n) < missing] = np.nan
+    return s
+
+
+class ComorbidityEncoding():
+    '''
+    Legacy get_comorb + mc_search loop against the vectorized encode_comorbidities
+    '''
+    params = [2000, 20000]
+
+    def setup(self, n):
+        self.s = comorbidity_column(n)
+
+    def time_legacy(self, n):
+        dp = dataPreprocessing(wd="")
+        self.s.apply(dp.get_comorb)
+        df = pd.DataFrame()
+        for i in dp.comorbidities:
+            df[i] = self.s.apply(dp.mc_search, current_comord=i)
+
+    def time_vectorized(self, n):
+        dataPreprocessing(wd="").encode_comorbidities(self.s)
+
+
+if __name__ == "__main__":
+    warnings.filterwarnings("ignore")
+    bench = ComorbidityEncoding()
+    for n in bench.params:
+        bench.setup(n)
+        legacy = min(timeit.repeat(lambda: bench.time_legacy(n), number=1, repeat=3))
+        vectorized = min(timeit.repeat(lambda: bench.time_vectorized(n), number=1, repeat=3))
+        print("rows: %d legacy: %.3fs vectorized: %.3fs speedup: %.0fx" % (n, legacy, vectorized, legacy / vectorized))
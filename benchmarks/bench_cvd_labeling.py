@@ -0,0 +1,73 @@
+import os
+import sys
+import timeit
+import warnings
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipelines"))
+from model import dataPreprocessing
+
+
+def cvd_extract(n, n_columns=120, prevalence=0.05, seed=0):
+    '''
+    Constructs a CVD first occurence extract with n_columns event columns and the attendance date
+
+    Returns
+    -------
+    events : pandas dataframe object
+    attendance : pandas series object
+    '''
+    rng = np.random.default_rng(seed)
+    start = np.datetime64("1970-01-01")
+    events = {}
+    for k in range(n_columns):
+        dates = (start + rng.integers(0, 18000, n).astype("timedelta64[D]")).astype(str).astype(object)
+        dates[rng.random(n) > prevalence] = np.nan
+        dates[rng.random(n) < 0.002] = "Code has event date matching participant's date of birth"
+        events["Date I%02d first reported (event %d)" % (k % 100, k)] = dates
+    attendance = pd.Series(np.datetime64("2006-03-01") + rng.integers(0, 1500, n).astype("timedelta64[D]"))
+    return pd.DataFrame(events), attendance
+
+
+def legacy_labeling(dp, events, attendance):
+    '''
+    Column loop of labeling_cvd before event_labels
+    '''
+    cvd = events.copy()
+    cvd['Date of attending assessment centre | Instance 0'] = attendance
+    for c in events.columns:
+        cvd[c+"_binary"] = cvd[c].apply(lambda i: 0 if pd.isnull(i) else 1)
+    for c in events.columns:
+        cvd[c] = cvd[c].replace("Code has event date matching participant's date of birth", np.nan)
+        cvd[c] = cvd[c].replace("Code has event date after participant's date of birth and falls in the same calendar year as date of birth", np.nan)
+        cvd[c] = pd.to_datetime(cvd[c])
+        cvd[c+'diff_days'] = (cvd[c] - cvd['Date of attending assessment centre | Instance 0']) / np.timedelta64(1, 'D')
+    return cvd.drop(['Date of attending assessment centre | Instance 0'], axis=1)
+
+
+class CvdLabeling():
+    '''
+    Column loop of labeling_cvd against the 2-D event_labels
+    '''
+    params = [2000, 20000]
+
+    def setup(self, n):
+        self.dp = dataPreprocessing(wd="")
+        self.events, self.attendance = cvd_extract(n)
+
+    def time_legacy(self, n):
+        legacy_labeling(self.dp, self.events, self.attendance)
+
+    def time_vectorized(self, n):
+        self.dp.event_labels(self.events, self.attendance)
+
+
+if __name__ == "__main__":
+    warnings.filterwarnings("ignore")
+    bench = CvdLabeling()
+    for n in bench.params:
+        bench.setup(n)
+        legacy = min(timeit.repeat(lambda: bench.time_legacy(n), number=1, repeat=3))
+        vectorized = min(timeit.repeat(lambda: bench.time_vectorized(n), number=1, repeat=3))
+        print("rows: %d columns: %d legacy: %.3fs vectorized: %.3fs speedup: %.0fx" % (n, bench.events.shape[1], legacy, vectorized, legacy / vectorized))
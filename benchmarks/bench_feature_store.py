@@ -0,0 +1,76 @@
+import os
+import sys
+import shutil
+import timeit
+import tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipelines"))
+from model import featureStore
+
+
+def feature_table(n, seed=0):
+    '''
+    Constructs a table with every kind of column the feature table holds: float with missing values, integer,
+    boolean, uint8, datetime, object, ordered categorical and sparse columns, in interleaved order
+
+    Returns
+    -------
+    df : pandas dataframe object
+    '''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({"Participant ID": np.arange(1000000, 1000000 + n)})
+    for k in range(20):
+        values = rng.normal(50, 10, n)
+        values[rng.random(n) < 0.1] = np.nan
+        df["float %d" % k] = values
+        df["integer %d" % k] = rng.integers(0, 5, n)
+        df["onehot %d" % k] = rng.integers(0, 2, n).astype(np.uint8)
+    df["flag"] = rng.random(n) < 0.5
+    df["date"] = np.datetime64("2006-03-01") + rng.integers(0, 1500, n).astype("timedelta64[D]")
+    text = rng.choice(["Never", "Previous", "Current"], n).astype(object)
+    text[rng.random(n) < 0.2] = np.nan
+    df["text"] = text
+    df["ordered"] = pd.Categorical(rng.choice(["low", "mid", "high"], n), categories=["low", "mid", "high"], ordered=True)
+    for k in range(5):
+        df["sparse %d" % k] = pd.arrays.SparseArray((rng.random(n) < 0.01).astype(np.uint8), fill_value=0)
+    df["sparse float"] = pd.arrays.SparseArray(np.where(rng.random(n) < 0.05, rng.normal(0, 1, n), np.nan))
+    return df
+
+
+def check_roundtrip(df, path):
+    '''
+    Writes df to a feature store at path and raises an AssertionError when reading it back gives another table
+    '''
+    featureStore(path).write(df)
+    pd.testing.assert_frame_equal(featureStore(path).read(), df.reset_index(drop=True))
+
+
+class FeatureStore():
+    '''
+    Reading the feature store, setup checks that read returns the table given to write
+    '''
+    params = [20000, 500000]
+
+    def setup(self, n):
+        self.path = tempfile.mkdtemp()
+        check_roundtrip(feature_table(n), self.path)
+
+    def teardown(self, n):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def time_read(self, n):
+        featureStore(self.path).read()
+
+    def peakmem_read(self, n):
+        featureStore(self.path).read()
+
+
+if __name__ == "__main__":
+    bench = FeatureStore()
+    for n in bench.params:
+        bench.setup(n)
+        read = min(timeit.repeat(lambda: bench.time_read(n), number=1, repeat=3))
+        print("rows: %d round trip: ok read: %.3fs" % (n, read))
+        bench.teardown(n)
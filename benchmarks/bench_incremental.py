@@ -0,0 +1,72 @@
+import os
+import sys
+import shutil
+import timeit
+import tempfile
+import contextlib
+import io
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipelines"))
+from model import dataPreprocessing
+from synthetic_data import syntheticBiobank
+
+
+def change_sleep(wd, n_changed):
+    '''
+    Sets the sleep duration of the first n_changed participants with a numeric answer to 3 hours, so the
+    changed participants have no text answers in a column the feature table stores as text
+    '''
+    path = os.path.join(wd, "NHS/Data_files/Grouped_files/replace/Sleep.csv")
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    numeric = pd.to_numeric(df["Sleep duration | Instance 0"], errors="coerce").notnull()
+    df.loc[df.index[numeric][:n_changed], "Sleep duration | Instance 0"] = "3"
+    df.to_csv(path, index=False)
+
+
+def check_incremental(previous_wd, wd, store_dir):
+    '''
+    Builds the store of previous_wd, updates it incrementally to wd and raises an AssertionError when the
+    result is another table than factory gives on wd
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        dataPreprocessing(previous_wd, use_cache=False).factory_incremental(store_dir)
+        df = dataPreprocessing(wd, use_cache=False).factory_incremental(store_dir)
+        dp = dataPreprocessing(wd, use_cache=False)
+        dp.factory()
+    assert os.path.exists(os.path.join(store_dir, "features.parquet"))
+    pd.testing.assert_frame_equal(df, dp.df.sort_values("Participant ID", kind="mergesort").reset_index(drop=True))
+
+
+class Incremental():
+    '''
+    Updating the feature table after a change of a few participants, setup checks that the update equals factory
+    '''
+    params = [3000, 20000]
+
+    def setup(self, n):
+        self.path = tempfile.mkdtemp()
+        self.wd = os.path.join(self.path, "cohort") + os.sep
+        self.previous_wd = os.path.join(self.path, "previous") + os.sep
+        syntheticBiobank(self.wd, n_participants=n).generate()
+        shutil.copytree(self.wd, self.previous_wd)
+        change_sleep(self.previous_wd, 40)
+        check_incremental(self.previous_wd, self.wd, os.path.join(self.path, "store"))
+
+    def teardown(self, n):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def time_factory_incremental(self, n):
+        #Every call updates the store to the other cohort, the same participants change each time
+        self.wd, self.previous_wd = self.previous_wd, self.wd
+        with contextlib.redirect_stdout(io.StringIO()):
+            dataPreprocessing(self.wd, use_cache=False).factory_incremental(os.path.join(self.path, "store"))
+
+
+if __name__ == "__main__":
+    bench = Incremental()
+    for n in bench.params:
+        bench.setup(n)
+        update = min(timeit.repeat(lambda: bench.time_factory_incremental(n), number=1, repeat=3))
+        print("rows: %d incremental equals factory: ok update: %.3fs" % (n, update))
+        bench.teardown(n)
@@ -0,0 +1,172 @@
+import os
+import sys
+import tempfile
+import contextlib
+import io
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipelines"))
+from model import dataPreprocessing, modelConstruction, controller, featureStore
+from synthetic_data import syntheticBiobank
+
+
+#Synthetic cohorts and their feature tables are kept here between benchmark processes
+COHORT_DIR = os.environ.get("BENCHMARK_COHORTS", os.path.join(tempfile.gettempdir(), "lifestyle_benchmarks"))
+
+
+def cohort(n):
+    '''
+    Returns the working directory of a synthetic cohort of n participants, generated on first use
+    '''
+    wd = os.path.join(COHORT_DIR, str(n)) + "/"
+    if not os.path.exists(wd + "complete"):
+        syntheticBiobank(wd, n_participants=n).generate()
+        open(wd + "complete", "w").close()
+    return wd
+
+
+def features(n):
+    '''
+    Returns the feature table of the synthetic cohort of n participants, built on first use
+    '''
+    path = cohort(n) + "features"
+    if not featureStore.is_store(path):
+        dp = dataPreprocessing(cohort(n), use_cache=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            dp.factory()
+        featureStore(path).write(dp.df)
+    return featureStore(path).read()
+
+
+def construction(n, sex=""):
+    '''
+    Returns a modelConstruction object on a fixed train/test split of the synthetic cohort
+    '''
+    df = features(n)
+    if sex != "":
+        df = df[df["Sex"] == (1 if sex == "men" else 0)]
+    train = df.sample(frac=0.8, random_state=0)
+    test = df.drop(train.index)
+    return modelConstruction(df=df, train=train, test=test, evaluation_folder=tempfile.mkdtemp() + "/",
+                             dp=dataPreprocessing(wd=""), sex=sex)
+
+
+class Stages():
+    '''
+    Every preprocessing stage on its own, the stages it depends on run in setup
+    '''
+    params = ([20000, 100000], dataPreprocessing(wd="").stage_order())
+    param_names = ["participants", "stage"]
+
+    def setup(self, n, stage):
+        self.dp = dataPreprocessing(cohort(n), use_cache=False)
+        dependencies = self.dp.stage_dependencies.get(stage, (None, []))[1]
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = self.dp.run_stages(stages=dependencies) if dependencies else {}
+        self.kwargs = self.dp.stage_kwargs(stage, results)
+
+    def time_stage(self, n, stage):
+        with contextlib.redirect_stdout(io.StringIO()):
+            getattr(self.dp, stage)(**self.kwargs)
+
+    def peakmem_stage(self, n, stage):
+        with contextlib.redirect_stdout(io.StringIO()):
+            getattr(self.dp, stage)(**self.kwargs)
+
+
+class Factory():
+    '''
+    All stages and the join into the feature table
+    '''
+    params = [20000, 100000]
+    param_names = ["participants"]
+
+    def setup(self, n):
+        self.wd = cohort(n)
+
+    def time_factory(self, n):
+        with contextlib.redirect_stdout(io.StringIO()):
+            dataPreprocessing(self.wd, use_cache=False).factory()
+
+    def peakmem_factory(self, n):
+        with contextlib.redirect_stdout(io.StringIO()):
+            dataPreprocessing(self.wd, use_cache=False).factory()
+
+
+class Modeling():
+    '''
+    Model training, diabetes is trained on men as in controller
+    '''
+    params = ([50000, 200000], ["diabetes", "copd", "cvd"])
+    param_names = ["participants", "disease"]
+
+    def setup(self, n, disease):
+        np.random.seed(0)
+        self.mc = construction(n, sex="men" if disease == "diabetes" else "")
+
+    def time_modeling(self, n, disease):
+        with contextlib.redirect_stdout(io.StringIO()):
+            getattr(self.mc, disease + "_modeling")()
+
+    def peakmem_modeling(self, n, disease):
+        with contextlib.redirect_stdout(io.StringIO()):
+            getattr(self.mc, disease + "_modeling")()
+
+
+class DiabetesTraining():
+    '''
+    The 16 diabetes random forests with a growing core budget, should scale with the cores of the machine
+    '''
+    params = ([200000], [1, 2, 4, 8])
+    param_names = ["participants", "cores"]
+
+    def setup(self, n, cores):
+        np.random.seed(0)
+        self.mc = construction(n, sex="men")
+        self.mc.n_jobs = cores
+
+    def time_diabetes_modeling(self, n, cores):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.mc.diabetes_modeling()
+
+
+class Evaluation():
+    '''
+    Evaluation of a trained model of the registry on the test set, as controller evaluates it
+    '''
+    params = ([50000, 200000], ["niddm_na_five_lada_rfmodel_one", "emphysema_model_current", "cvd_hf_model"])
+    param_names = ["participants", "model"]
+
+    def setup(self, n, model):
+        np.random.seed(0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.mc = construction(n, sex="men" if model.startswith("niddm") else "")
+            self.mc.train_models(names=[model])
+
+    def time_evaluation(self, n, model):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.mc.evaluate_models(names=[model])
+
+    def peakmem_evaluation(self, n, model):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.mc.evaluate_models(names=[model])
+
+
+class Controller():
+    '''
+    The full pipeline from the source files to the evaluations
+    '''
+    params = [50000]
+    param_names = ["participants"]
+    timeout = 3600
+
+    def setup(self, n):
+        self.wd = cohort(n)
+        self.evaluation_folder = tempfile.mkdtemp() + "/"
+        #controller writes its results to the working directory
+        os.chdir(self.evaluation_folder)
+
+    def time_controller(self, n):
+        np.random.seed(0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            controller(self.wd, evaluation_folder=self.evaluation_folder, file=None, suppress_warnings=True, no_cache=True)
@@ -0,0 +1,64 @@
+import os
+import sys
+import timeit
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipelines"))
+from model import prevalence_curve
+
+
+def height_extract(n, prevalence=0.02, seed=0):
+    '''
+    Constructs standing heights, sex and an osteoporosis label for n participants
+
+    Returns
+    -------
+    df : pandas dataframe object
+    '''
+    rng = np.random.default_rng(seed)
+    sex = rng.integers(0, 2, n)
+    height = np.round(rng.normal(163 + 13*sex, 7))
+    height[rng.random(n) < 0.01] = np.nan
+    return pd.DataFrame({"Standing height | Instance 0": height, "Sex": sex,
+                         "label": (rng.random(n) < prevalence*(1 + (height < 160))).astype(int)})
+
+
+def legacy_curve(df, x, s):
+    '''
+    Value loop of osteoporosis_modeling before prevalence_curve
+    '''
+    y = []
+    for i in x:
+        t = df[(df['Standing height | Instance 0']==i) & (df['label']==0) & (df["Sex"] ==s)]
+        to = df[(df['Standing height | Instance 0']==i) & (df['label']==1)& (df["Sex"] ==s)]
+        if to.shape[0] == 0:
+            y.append(0)
+        else:
+            y.append(to.shape[0]/(t.shape[0]+to.shape[0])*100)
+    return y
+
+
+class PrevalenceCurve():
+    '''
+    Value loop of osteoporosis_modeling against prevalence_curve
+    '''
+    params = [20000, 400000]
+
+    def setup(self, n):
+        self.df = height_extract(n)
+
+    def time_legacy(self, n):
+        legacy_curve(self.df, range(140,190), 0)
+
+    def time_vectorized(self, n):
+        prevalence_curve(self.df, 'Standing height | Instance 0', 'label', x=range(140,190), sex=0)
+
+
+if __name__ == "__main__":
+    bench = PrevalenceCurve()
+    for n in bench.params:
+        bench.setup(n)
+        legacy = min(timeit.repeat(lambda: bench.time_legacy(n), number=1, repeat=3))
+        vectorized = min(timeit.repeat(lambda: bench.time_vectorized(n), number=1, repeat=3))
+        print("rows: %d legacy: %.3fs vectorized: %.4fs speedup: %.0fx" % (n, legacy, vectorized, legacy / vectorized))
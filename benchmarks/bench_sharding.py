@@ -0,0 +1,54 @@
+import os
+import sys
+import shutil
+import timeit
+import tempfile
+import contextlib
+import io
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipelines"))
+from model import dataPreprocessing
+from synthetic_data import syntheticBiobank
+
+
+def check_sharded(wd, output_dir, n_shards=3, chunk_size=1000):
+    '''
+    Builds the feature table of wd with factory and with factory_sharded and raises an AssertionError when the
+    partitions together give another table
+    '''
+    dp = dataPreprocessing(wd, use_cache=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        dp.factory()
+        partitions = dp.factory_sharded(output_dir, n_shards=n_shards, chunk_size=chunk_size)
+    sharded = dp.read_partitions(partitions).sort_values("Participant ID", kind="mergesort").reset_index(drop=True)
+    pd.testing.assert_frame_equal(sharded, dp.df.sort_values("Participant ID", kind="mergesort").reset_index(drop=True))
+
+
+class Sharding():
+    '''
+    Partitioning the source files over the shards, setup checks that the sharded build equals factory
+    '''
+    params = [3000, 20000]
+
+    def setup(self, n):
+        self.path = tempfile.mkdtemp()
+        self.wd = os.path.join(self.path, "cohort") + os.sep
+        syntheticBiobank(self.wd, n_participants=n).generate() #Family_history.csv has a preamble row
+        check_sharded(self.wd, os.path.join(self.path, "sharded"))
+        self.dp = dataPreprocessing(self.wd, use_cache=False)
+
+    def teardown(self, n):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def time_split_sources(self, n):
+        self.dp.split_sources(os.path.join(self.path, "shards"), 8)
+
+
+if __name__ == "__main__":
+    bench = Sharding()
+    for n in bench.params:
+        bench.setup(n)
+        split = min(timeit.repeat(lambda: bench.time_split_sources(n), number=1, repeat=3))
+        print("rows: %d sharded equals factory: ok split: %.3fs" % (n, split))
+        bench.teardown(n)
@@ -0,0 +1,211 @@
+'''
+Runs the asv style benchmarks of this folder without asv and compares results against a baseline:
+
+    python benchmarks/run.py run --output baseline.json
+    python benchmarks/run.py run --output results.json --bench Modeling
+    python benchmarks/run.py compare baseline.json results.json --threshold 1.25
+
+Every benchmark runs in its own process, so peakmem_ benchmarks measure that benchmark only. compare exits with
+status 1 when a benchmark of the baseline is slower or uses more memory than threshold times its baseline value,
+or did not finish
+'''
+import os
+import sys
+import re
+import json
+import time
+import glob
+import argparse
+import datetime
+import platform
+import importlib
+import itertools
+import subprocess
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def benchmark_classes(module):
+    '''
+    Returns the classes of a benchmark module which define time_ or peakmem_ methods
+    '''
+    return [c for c in vars(module).values() if isinstance(c, type) and c.__module__ == module.__name__
+            and any(re.match("(time|peakmem)_", name) for name in vars(c))]
+
+
+def parameter_sets(cls):
+    '''
+    Returns the parameter combinations of an asv style class, a list of lists is a grid
+    '''
+    params = getattr(cls, "params", None)
+    if params == None:
+        return [()]
+    if isinstance(params, tuple) or (len(params) > 0 and isinstance(params[0], list)):
+        return list(itertools.product(*params))
+    return [(p,) for p in params]
+
+
+def discover(pattern=None):
+    '''
+    Lists the benchmarks of the bench_*.py modules as (module, class, method, params)
+
+    Parameters
+    ----------
+    pattern : String
+        Regular expression the benchmark name has to match (default is None, all benchmarks)
+    '''
+    sys.path.insert(0, BENCHMARK_DIR)
+    found = []
+    for path in sorted(glob.glob(os.path.join(BENCHMARK_DIR, "bench_*.py"))):
+        module = importlib.import_module(os.path.basename(path)[:-3])
+        for cls in benchmark_classes(module):
+            for method in sorted(name for name in vars(cls) if re.match("(time|peakmem)_", name)):
+                for params in parameter_sets(cls):
+                    b = (module.__name__, cls.__name__, method, list(params))
+                    if pattern == None or re.search(pattern, benchmark_name(*b)):
+                        found.append(b)
+    return found
+
+
+def benchmark_name(module, cls, method, params):
+    return "%s.%s.%s(%s)" % (module, cls, method, ", ".join(str(p) for p in params))
+
+
+def peak_rss():
+    '''
+    Returns the peak resident set size of this process in bytes
+    '''
+    if resource == None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def run_single(module, cls, method, params, repeat):
+    '''
+    Runs one benchmark in this process: the minimum wall time over repeat calls for time_ benchmarks,
+    the peak RSS of the process for peakmem_ benchmarks
+    '''
+    sys.path.insert(0, BENCHMARK_DIR)
+    bench = getattr(importlib.import_module(module), cls)()
+    if hasattr(bench, "setup"):
+        bench.setup(*params)
+    try:
+        if method.startswith("peakmem_"):
+            getattr(bench, method)(*params)
+            return {"value": peak_rss(), "unit": "bytes"}
+        timings = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            getattr(bench, method)(*params)
+            timings.append(time.perf_counter() - start)
+        return {"value": min(timings), "unit": "seconds"}
+    finally:
+        if hasattr(bench, "teardown"):
+            bench.teardown(*params)
+
+
+def run(pattern, output, repeat):
+    '''
+    Runs the benchmarks in separate processes and writes the results as JSON
+    '''
+    results = {}
+    for module, cls, method, params in discover(pattern):
+        name = benchmark_name(module, cls, method, params)
+        command = [sys.executable, os.path.abspath(__file__), "single", module, cls, method, json.dumps(params), "--repeat", str(repeat)]
+        timeout = getattr(getattr(importlib.import_module(module), cls), "timeout", 1800)
+        try:
+            finished = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+            lines = finished.stdout.strip().splitlines()
+            if finished.returncode != 0 or len(lines) == 0:
+                raise RuntimeError(finished.stderr.strip().splitlines()[-1] if finished.stderr.strip() else "no result")
+            results[name] = json.loads(lines[-1])
+        except (RuntimeError, subprocess.TimeoutExpired) as e:
+            results[name] = {"value": None, "error": str(e)}
+        print("%-90s %s" % (name, format_result(results[name])))
+
+    with open(output, "w") as f:
+        json.dump({"machine": platform.node(), "python": platform.python_version(),
+                   "date": datetime.datetime.now().isoformat(timespec="seconds"), "results": results}, f, indent=1)
+
+
+def format_result(result):
+    if result["value"] == None:
+        return "failed: " + result.get("error", "")
+    if result["unit"] == "bytes":
+        return "%.1f MB" % (result["value"] / 1024**2)
+    return "%.4f s" % result["value"]
+
+
+def compare(baseline, current, threshold):
+    '''
+    Compares two result files, returns the names of the benchmarks which regressed past threshold
+
+    Parameters
+    ----------
+    baseline : String
+        Result file of the baseline
+    current : String
+        Result file to check
+    threshold : float
+        Allowed ratio of current to baseline value
+
+    Returns
+    -------
+    regressions : list
+    '''
+    with open(baseline) as f:
+        baseline = json.load(f)["results"]
+    with open(current) as f:
+        current = json.load(f)["results"]
+
+    regressions = []
+    for name, base in baseline.items():
+        new = current.get(name)
+        if base["value"] == None:
+            continue
+        if new == None or new["value"] == None:
+            print("%-90s %s" % (name, "missing" if new == None else format_result(new)))
+            regressions.append(name)
+            continue
+        ratio = new["value"] / base["value"] if base["value"] > 0 else 1.0
+        state = "REGRESSED" if ratio > threshold else ("improved" if ratio < 1/threshold else "")
+        print("%-90s %12s -> %12s %6.2fx %s" % (name, format_result(base), format_result(new), ratio, state))
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run and compare the benchmarks of this folder")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run the benchmarks and write their results")
+    run_parser.add_argument("--bench", default=None, help="Regular expression selecting benchmarks by name")
+    run_parser.add_argument("--output", default="benchmark_results.json")
+    run_parser.add_argument("--repeat", type=int, default=3, help="Calls per time_ benchmark, the fastest is kept")
+    compare_parser = commands.add_parser("compare", help="Fail when results regressed against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=1.25, help="Allowed ratio of current to baseline value")
+    single_parser = commands.add_parser("single", help=argparse.SUPPRESS)
+    single_parser.add_argument("module")
+    single_parser.add_argument("cls")
+    single_parser.add_argument("method")
+    single_parser.add_argument("params")
+    single_parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args.bench, args.output, args.repeat)
+    elif args.command == "compare":
+        regressions = compare(args.baseline, args.current, args.threshold)
+        if regressions:
+            print("%d benchmarks regressed past %.2fx" % (len(regressions), args.threshold))
+            sys.exit(1)
+    else:
+        result = run_single(args.module, args.cls, args.method, json.loads(args.params), args.repeat)
+        sys.stdout = sys.__stdout__
+        print(json.dumps(result))
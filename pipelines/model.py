@@ -2,7 +2,6 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 import re
-import datetime
 from sklearn.linear_model import LogisticRegression
 from sklearn import metrics
 from sklearn.naive_bayes import GaussianNB
@@ -10,7 +9,31 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import MinMaxScaler
 import scipy.stats as sps
+from scipy import sparse
 import warnings
+import os
+import json
+import time
+import pickle
+import hashlib
+import inspect
+import functools
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+import contextlib
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.compute
+except ImportError:
+    pyarrow = None
+try:
+    import resource
+except ImportError:
+    resource = None
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 __author__ = "Keimpe Dijkstra"
 __credits__ = ["Stefan Wijtsma"]
@@ -19,11 +42,740 @@ __version__ = "1.0.1"
 __maintainer__ = "Keimpe Dijkstra"
 __email__ = "k.dijkstra@labonovum.com"
 
+#Strings read_csv reads as missing by default (na_values in the pandas read_csv documentation), read_csv_pyarrow uses the same
+CSV_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA',
+                 'NULL', 'NaN', 'n/a', 'nan', 'null']
+
+
+class stageCache():
+    '''
+    On-disk cache for the dataframes returned by the pre_* and labeling_* stages of dataPreprocessing.
+    Entries are keyed by the source files (size and content hash) and the code version,
+    they are stored as parquet (pickle when parquet is not available) and evicted least recently used first.
+    '''
+
+    def __init__(self, cache_dir, max_bytes=20*1024**3):
+        '''
+        Parameters
+        ----------
+        cache_dir : String
+            Folder in which the cache is stored
+        max_bytes : int
+            Maximum size of the cache on disk (default is 20GB)
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(cache_dir, "index.json")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self.read_index()
+
+    def read_index(self):
+        '''
+        Reads the cache index, which holds the cache entries and the hashes of the source files
+
+        Returns
+        -------
+        index : dict
+        '''
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                return json.load(f)
+        return {"entries": {}, "sources": {}}
+
+    def write_index(self):
+        tmp = self.index_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp, self.index_file)
+
+    def file_hash(self, path, block_size=2**24):
+        '''
+        Returns the content hash of a source file, the hash is only recomputed when size or mtime changed
+
+        Parameters
+        ----------
+        path : String
+            Path to the source file
+
+        Returns
+        -------
+        size : int
+        digest : String
+        '''
+        st = os.stat(path)
+        known = self.index["sources"].get(path)
+        if known != None and known["size"] == st.st_size and known["mtime"] == st.st_mtime_ns:
+            return known["size"], known["hash"]
+
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                h.update(block)
+        self.index["sources"][path] = {"size": st.st_size, "mtime": st.st_mtime_ns, "hash": h.hexdigest()}
+        self.write_index()
+        return st.st_size, h.hexdigest()
+
+    def key(self, stage, sources, code_version, options=None):
+        '''
+        Constructs the cache key of a stage
+
+        Parameters
+        ----------
+        stage : String
+            Name of the stage
+        sources : list
+            Paths of the files read by the stage
+        code_version : String
+            Version of the code which constructs the stage
+        options : dict
+            Settings which change the output of the stage (default is None)
+
+        Returns
+        -------
+        key : String
+        '''
+        fingerprint = [stage, code_version, options or {}] + [[os.path.basename(p)] + list(self.file_hash(p)) for p in sources]
+        return hashlib.sha1(json.dumps(fingerprint).encode()).hexdigest()
+
+    def load(self, stage, key):
+        '''
+        Returns the cached dataframe of a stage or None when there is no valid entry
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        entry = self.index["entries"].get(key)
+        if entry == None or not os.path.exists(os.path.join(self.cache_dir, entry["file"])):
+            return None
+        path = os.path.join(self.cache_dir, entry["file"])
+        if entry["format"] == "parquet":
+            df = pd.read_parquet(path)
+        else:
+            df = pd.read_pickle(path)
+        entry["last_access"] = time.time()
+        self.write_index()
+        return df
+
+    def store(self, stage, key, df, sources=None):
+        '''
+        Writes the dataframe of a stage to the cache and evicts old entries when the cache is too large.
+        The entry replaces the entry of the same stage and source files, entries of other source files
+        (shards, increments) stay
+
+        Parameters
+        ----------
+        stage : String
+            Name of the stage
+        key : String
+            Key as constructed by the key function
+        df : pandas dataframe object
+        sources : list
+            Paths of the files read by the stage (default is None)
+        '''
+        name = stage + "-" + key[:16]
+        try:
+            fmt = "parquet"
+            file = name + ".parquet"
+            df.to_parquet(os.path.join(self.cache_dir, file + ".tmp"), index=False)
+        except Exception: #Parquet engine missing or columns with mixed types
+            fmt = "pickle"
+            file = name + ".pkl"
+            df.to_pickle(os.path.join(self.cache_dir, file + ".tmp"))
+        os.replace(os.path.join(self.cache_dir, file + ".tmp"), os.path.join(self.cache_dir, file))
+
+        sources = sorted(os.path.abspath(p) for p in sources or [])
+        for k in [k for k, e in self.index["entries"].items() if e["stage"] == stage and e.get("sources") == sources and k != key]:
+            self.remove(k)
+        self.index["entries"][key] = {"stage": stage, "sources": sources, "file": file, "format": fmt,
+                                      "bytes": os.path.getsize(os.path.join(self.cache_dir, file)),
+                                      "last_access": time.time()}
+        self.evict()
+        self.write_index()
+
+    def evict(self):
+        '''
+        Removes least recently used entries until the cache fits in max_bytes
+        '''
+        entries = sorted(self.index["entries"].items(), key=lambda e: e[1]["last_access"])
+        total = sum(e["bytes"] for k, e in entries)
+        for k, e in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(k)
+            total -= e["bytes"]
+
+    def remove(self, key):
+        entry = self.index["entries"].pop(key)
+        path = os.path.join(self.cache_dir, entry["file"])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def invalidate(self, stage=None, keep=None):
+        '''
+        Removes the entries of a stage, or all entries when no stage is given
+
+        Parameters
+        ----------
+        stage : String
+            Name of the stage (default is None)
+        keep : String
+            Key of an entry which should not be removed (default is None)
+        '''
+        for k in [k for k, e in self.index["entries"].items() if (stage == None or e["stage"] == stage) and k != keep]:
+            self.remove(k)
+        self.write_index()
+
+
+class sourceRegistry():
+    '''
+    Parses every raw source file at most once per run of the stages and hands out read-only views of it.
+    A table is freed once every stage reading it has been released
+    '''
+
+    def __init__(self, consumers, reader=pd.read_csv):
+        '''
+        Parameters
+        ----------
+        consumers : dict
+            Number of stages reading each source path
+        reader : function
+            Function which reads a source path (default is pandas.read_csv)
+        '''
+        self.consumers = dict(consumers)
+        self.reader = reader
+        self.tables = {}
+        self.reads = {}
+        self.pid = os.getpid()
+
+    def read(self, path, **kwargs):
+        '''
+        Returns a read-only view of a source file, the file is parsed on the first request only.
+        Worker processes use the tables loaded before they were forked and parse other files without keeping them
+
+        Parameters
+        ----------
+        path : String
+            Path of the source file
+        kwargs :
+            Arguments passed to the reader
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        if path not in self.tables:
+            df = self.reader(path, **kwargs)
+            if os.getpid() != self.pid:
+                return df
+            #Rebuilt from read-only views of its columns, so a stage writing into a shared table raises
+            data = {}
+            for c in df.columns:
+                values = df[c].to_numpy() if isinstance(df[c].dtype, np.dtype) else df[c].array
+                if isinstance(values, np.ndarray):
+                    values.flags.writeable = False
+                data[c] = values
+            self.tables[path] = pd.DataFrame(data, index=df.index, columns=df.columns, copy=False)
+            self.reads[path] = self.reads.get(path, 0) + 1
+        return self.tables[path].copy(deep=False)
+
+    def release(self, paths):
+        '''
+        Marks a consumer of each path as finished, tables without remaining consumers are freed
+
+        Parameters
+        ----------
+        paths : list
+            Source paths read by the finished stage
+        '''
+        for path in paths:
+            if path in self.consumers:
+                self.consumers[path] -= 1
+                if self.consumers[path] <= 0:
+                    self.tables.pop(path, None)
+
+    def shared(self):
+        '''
+        Returns the paths with more than one remaining consumer
+        '''
+        return [path for path, n in self.consumers.items() if n > 1]
+
+
+class featureStore():
+    '''
+    Memory mapped store for the feature table. Columns are grouped by dtype into .npy blocks with one
+    contiguous row per column, schema.json holds the column order, dtypes and the categories of the
+    encoded columns. Numeric, bool and datetime columns are mapped copy-on-write, so loading does not
+    copy them and processes reading the same store share the pages. Sparse columns are grouped by dtype
+    into compressed blocks, indptr, indices and data .npy files as in a CSR matrix with one row per column
+    '''
+
+    def __init__(self, path):
+        '''
+        Parameters
+        ----------
+        path : String
+            Folder of the store
+        '''
+        self.path = path
+        self.schema_file = os.path.join(path, "schema.json")
+
+    @staticmethod
+    def is_store(path):
+        return path != None and os.path.isfile(os.path.join(path, "schema.json"))
+
+    def write(self, df):
+        '''
+        Writes a dataframe to the store. Object columns are stored as category codes, sparse columns as the
+        rows and values which differ from their fill value
+
+        Parameters
+        ----------
+        df : pandas dataframe object
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self.schema_file):
+            os.remove(self.schema_file) #An interrupted write leaves no readable store
+        columns = []
+        blocks = {}
+        sparse_blocks = {}
+        for c in df.columns:
+            s = df[c]
+            column = {"name": c}
+            if isinstance(s.dtype, pd.SparseDtype):
+                column["sparse_fill_value"] = None if pd.isna(s.dtype.fill_value) else np.array(s.dtype.fill_value).item()
+                values = s.sparse.to_dense().to_numpy()
+                rows = np.flatnonzero(pd.notna(values) if pd.isna(s.dtype.fill_value) else values != s.dtype.fill_value)
+                column["block"] = "sparse_" + values.dtype.str.replace("<", "").replace(">", "").replace("|", "")
+                column["position"] = len(sparse_blocks.setdefault(column["block"], []))
+                sparse_blocks[column["block"]].append((rows, values[rows]))
+                columns.append(column)
+                continue
+            elif isinstance(s.dtype, np.dtype) and s.dtype.kind in "biufM":
+                values = s.to_numpy()
+            else:
+                column["ordered"] = bool(s.cat.ordered) if s.dtype.name == "category" else None
+                codes, categories = (s.cat.codes.to_numpy(), s.cat.categories) if s.dtype.name == "category" else pd.factorize(s.astype(object))
+                column["categories"] = [v.item() if isinstance(v, np.generic) else v for v in categories]
+                values = codes.astype(np.int32)
+            #Decoded columns get their own blocks, so the blocks of mapped columns hold no other columns
+            prefix = "codes_" if "categories" in column else "block_"
+            column["block"] = prefix + values.dtype.str.replace("<", "").replace(">", "").replace("|", "") + ".npy"
+            column["position"] = len(blocks.setdefault(column["block"], []))
+            blocks[column["block"]].append(values)
+            columns.append(column)
+
+        for name, arrays in blocks.items():
+            mm = np.lib.format.open_memmap(os.path.join(self.path, name), mode="w+", dtype=arrays[0].dtype, shape=(len(arrays), len(df)))
+            for i, values in enumerate(arrays):
+                mm[i] = values
+            mm.flush()
+            del mm
+        for name, arrays in sparse_blocks.items():
+            indices = [rows for rows, values in arrays]
+            np.save(os.path.join(self.path, name + "_indptr.npy"), np.r_[0, np.cumsum([len(rows) for rows in indices])].astype(np.int64))
+            np.save(os.path.join(self.path, name + "_indices.npy"), np.concatenate(indices).astype(np.int32 if len(df) < 2**31 else np.int64))
+            np.save(os.path.join(self.path, name + "_data.npy"), np.concatenate([values for rows, values in arrays]))
+
+        tmp = self.schema_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"n_rows": len(df), "columns": columns}, f, indent=1)
+        os.replace(tmp, self.schema_file)
+
+    def read(self):
+        '''
+        Reads the store. The mapped columns are passed to the dataframe with copy=False, so they stay views of
+        the blocks, only encoded and sparse columns are decoded in memory, a sparse column one at a time
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        with open(self.schema_file) as f:
+            schema = json.load(f)
+        columns = schema["columns"]
+        n_rows = schema["n_rows"]
+        blocks = set(c["block"] for c in columns if "sparse_fill_value" not in c)
+        mapped = {name: np.load(os.path.join(self.path, name), mmap_mode="c") for name in blocks}
+        for name in set(c["block"] for c in columns) - blocks:
+            mapped[name] = {part: np.load(os.path.join(self.path, name + "_" + part + ".npy"), mmap_mode="r") for part in ["indptr", "indices", "data"]}
+
+        data = {}
+        for column in columns:
+            if "sparse_fill_value" in column:
+                block = mapped[column["block"]]
+                start, end = block["indptr"][column["position"]:column["position"]+2]
+                fill_value = np.nan if column["sparse_fill_value"] == None else column["sparse_fill_value"]
+                values = np.full(n_rows, fill_value, dtype=block["data"].dtype)
+                values[block["indices"][start:end]] = block["data"][start:end]
+                data[column["name"]] = pd.arrays.SparseArray(values, fill_value=fill_value)
+                continue
+            values = mapped[column["block"]][column["position"]]
+            if "categories" in column:
+                categories = pd.Index(column["categories"], dtype=object)
+                if column["ordered"] == None:
+                    values = np.where(values >= 0, categories.to_numpy()[np.maximum(values, 0)], np.nan)
+                else:
+                    values = pd.Categorical.from_codes(values, categories, ordered=column["ordered"])
+            data[column["name"]] = values
+        return pd.DataFrame(data, index=pd.RangeIndex(n_rows), columns=pd.Index(list(data), dtype=object), copy=False)
+
+
+class codingExclusion():
+    '''
+    Excludes participants whose first occurence dates hold one of the special codings of coding819
+    (e.g. "Code has no event date"). The meanings are a categorical dtype, so the values of all date
+    columns are looked up in one hashed pass. Excluded participants are counted per coding
+    '''
+
+    def __init__(self, coding):
+        '''
+        Parameters
+        ----------
+        coding : pandas dataframe object
+            coding819 with the columns coding and meaning
+        '''
+        self.coding = coding["coding"].tolist()
+        self.meaning = coding["meaning"].tolist()
+        self.dtype = pd.CategoricalDtype(pd.unique(coding["meaning"]))
+        self.report = {}
+
+    def exclude(self, df, columns, name=None):
+        '''
+        Removes the rows in which any of the columns holds a meaning of coding819
+
+        Parameters
+        ----------
+        df : pandas dataframe object
+        columns : list
+            Date columns to check
+        name : String
+            Key of the exclusion counts in self.report (default is None, not reported)
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        codes = pd.Categorical(df[columns].to_numpy(dtype=object).ravel(), dtype=self.dtype).codes.reshape(len(df), len(columns))
+        excluded = (codes >= 0).any(axis=1)
+
+        if name != None:
+            #Count a participant once per coding, also when it occurs in several columns
+            rows, cols = np.nonzero(codes >= 0)
+            pairs = np.unique(rows.astype(np.int64) * len(self.dtype.categories) + codes[rows, cols])
+            counts = np.bincount(pairs % len(self.dtype.categories), minlength=len(self.dtype.categories))
+            self.report[name] = {m: int(n) for m, n in zip(self.dtype.categories, counts) if n > 0}
+            print("%s: excluded %d participants %s" % (name, excluded.sum(), self.report[name]))
+        return df[~excluded]
+
+
+class stageProfiler():
+    '''
+    Records wall time, CPU time, peak RSS growth and input/output row and column counts of the instrumented
+    methods of dataPreprocessing and modelConstruction, exported as JSON lines or a Chrome trace
+    '''
+    def __init__(self):
+        self.records = []
+        self.active = []
+
+    @staticmethod
+    def peak_rss():
+        '''
+        Returns the peak resident set size of this process in bytes, None where the resource module is missing
+        '''
+        if resource == None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+    @contextlib.contextmanager
+    def record(self, name, inputs=()):
+        '''
+        Context manager measuring the enclosed block, frames passed to observe inside the block count as input
+
+        Parameters
+        ----------
+        name : String
+            Name of the record
+        inputs : iterable
+            Input dataframes
+
+        Returns
+        -------
+        entry : dict
+            Record of the block, the output is set with observe_output
+        '''
+        entry = {"name": name, "pid": os.getpid(), "input_rows": 0, "input_columns": 0,
+                 "output_rows": None, "output_columns": None}
+        for df in inputs:
+            self.observe(df, entry)
+        self.active.append(entry)
+        rss = self.peak_rss()
+        cpu = time.process_time()
+        entry["start"] = time.time()
+        try:
+            yield entry
+        finally:
+            entry["wall_seconds"] = time.time() - entry["start"]
+            entry["cpu_seconds"] = time.process_time() - cpu
+            entry["peak_rss_delta"] = None if rss == None else self.peak_rss() - rss
+            self.active.pop()
+            self.records.append(entry)
+
+    def observe(self, df, entry=None):
+        '''
+        Adds a dataframe to the input counts of entry, or of the innermost active record
+        '''
+        if entry == None:
+            if len(self.active) == 0:
+                return
+            entry = self.active[-1]
+        entry["input_rows"] += df.shape[0]
+        entry["input_columns"] += df.shape[1]
+
+    def observe_output(self, entry, df):
+        '''
+        Sets the output counts of entry when df is a dataframe
+        '''
+        if isinstance(df, pd.DataFrame):
+            entry["output_rows"], entry["output_columns"] = df.shape
+
+    def extend(self, records):
+        '''
+        Adds the records of a worker process
+        '''
+        self.records.extend(records)
+
+    def to_jsonl(self, path):
+        '''
+        Writes one JSON object per record
+        '''
+        with open(path, "w") as f:
+            for entry in self.records:
+                f.write(json.dumps(entry) + "\n")
+
+    def to_chrome_trace(self, path):
+        '''
+        Writes the records as complete events of the Chrome trace event format, open with chrome://tracing or Perfetto
+        '''
+        events = []
+        for entry in self.records:
+            args = {k: v for k, v in entry.items() if k not in ("name", "pid", "start", "wall_seconds")}
+            events.append({"name": entry["name"], "cat": entry["name"].split("_")[0], "ph": "X", "pid": entry["pid"],
+                           "tid": entry["pid"], "ts": entry["start"]*1e6, "dur": entry["wall_seconds"]*1e6, "args": args})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        '''
+        Returns the records as a dataframe, slowest first
+        '''
+        return pd.DataFrame(self.records).sort_values("wall_seconds", ascending=False)
+
+
+def profiled(method):
+    '''
+    Decorator recording a method with the stageProfiler in the profiler attribute of its object, if any.
+    Dataframe arguments count as input, objects can add input with a profile_input method
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profiler = getattr(self, "profiler", None)
+        if profiler == None:
+            return method(self, *args, **kwargs)
+        inputs = [a for a in list(args)+list(kwargs.values()) if isinstance(a, pd.DataFrame)]
+        if len(inputs) == 0 and hasattr(self, "profile_input"):
+            inputs = self.profile_input(method.__name__)
+        with profiler.record(method.__name__, inputs) as entry:
+            result = method(self, *args, **kwargs)
+            profiler.observe_output(entry, result)
+        return result
+    return wrapper
+
+
+def instrument(cls, pattern):
+    '''
+    Wraps the methods of cls whose name matches pattern with profiled
+    '''
+    for name, method in list(vars(cls).items()):
+        if inspect.isfunction(method) and re.search(pattern, name):
+            setattr(cls, name, profiled(method))
+    return cls
+
+
+#Registry inherited by forked worker processes of dataPreprocessing.run_stages
+shared_sources = None
+
+
+def fit_random_forest(x_train, y_train, scaling=True, n_jobs=None, random_state=None):
+    '''
+    Constructs random forest model, module level so it can be submitted to a process pool
+
+    Parameters
+    ----------
+    x_train : pandas dataframe object
+        Datasource
+    y_train : pandas dataframe column
+        Column containing class variable
+    scaling : Binary
+        Indicates wether or not data should be scaled (default is True)
+    n_jobs : integer
+        Threads used by the random forest (default is None, one)
+    random_state : integer
+        Seed of the random forest (default is None)
+
+    Returns
+    -------
+    model : sklearn random forest model
+    mms : minmaxscaler object
+    '''
+    mms = None
+    if scaling:
+        mms = MinMaxScaler()
+        mms.fit(x_train)
+        tcol = x_train.columns.tolist()
+        data_transformed = mms.transform(x_train)
+        x_train = pd.DataFrame(data_transformed, columns=tcol)
+    model = RandomForestClassifier(n_jobs=n_jobs, random_state=random_state)
+    model.fit(x_train, y_train)
+    return model, mms
+
+
+def prevalence_curve(df, feature, label, x, sex=None, edges=None, merge_empty=False):
+    '''
+    Percentage of cases per value of a feature, counted in one pass. Without edges a participant counts for the
+    value of x their feature equals, with edges for x[k] when edges[k] <= feature < edges[k+1]. Values without
+    cases get a percentage of 0, unless merge_empty folds their controls into the previous value with cases
+
+    Parameters
+    ----------
+    df : pandas dataframe object
+        Datasource
+    feature : String
+        Column to bin
+    label : String
+        Binary column, 1 for cases and 0 for controls
+    x : list
+        Values of the curve
+    sex : integer
+        Only count participants of this sex (default is None, all)
+    edges : list
+        Bin edges, one more than x (default is None, exact values)
+    merge_empty : Binary
+        Drops values without cases and adds their controls to the previous value with cases, values before
+        the first one with cases are dropped (default is False)
+
+    Returns
+    -------
+    curve : pandas dataframe object
+        Columns x, cases, controls and y, the percentage of cases. x and y can be passed to linear_regression
+    '''
+    x = list(x)
+    values = pd.to_numeric(df[feature], errors="coerce").to_numpy(dtype=float)
+    labels = df[label].to_numpy()
+    if edges is None:
+        bins = pd.Index(x).get_indexer(values)
+    else:
+        bins = np.searchsorted(np.asarray(edges, dtype=float), values, side="right") - 1
+        bins[(bins >= len(x)) | np.isnan(values)] = -1
+    counted = bins >= 0
+    if sex is not None:
+        counted &= df["Sex"].to_numpy() == sex
+    cases = np.bincount(bins[counted & (labels == 1)], minlength=len(x))
+    controls = np.bincount(bins[counted & (labels == 0)], minlength=len(x))
+
+    if merge_empty:
+        keep = np.flatnonzero(cases > 0)
+        #Every value adds its controls to the last value with cases at or before it
+        owner = np.maximum.accumulate(np.where(cases > 0, np.arange(len(x)), -1))
+        controls = np.bincount(owner[owner >= 0], weights=controls[owner >= 0], minlength=len(x)).astype(int)[keep]
+        cases = cases[keep]
+        x = [x[k] for k in keep]
+
+    total = cases + controls
+    y = np.divide(cases * 100, total, out=np.zeros(len(x)), where=cases > 0)
+    return pd.DataFrame({"x": x, "cases": cases, "controls": controls, "y": y})
+
+
+def run_controller_cohort(con, cohort, store, index, train_positions, seed):
+    '''
+    Runs a cohort of controller on the feature table of a feature store, module level so it can be submitted
+    to a process pool
+
+    Parameters
+    ----------
+    con : controller object
+        Controller without its dataframes
+    cohort : String
+        Name of the cohort method
+    store : String
+        Folder of the feature store with the dataframe
+    index : numpy array object
+        Index of the dataframe
+    train_positions : numpy array object
+        Positions of the train set in the dataframe
+    seed : integer
+        Seed of the global numpy random state
+
+    Returns
+    -------
+    attributes : dict
+        Attributes set by the cohort, the dataframe and train set of model construction objects are dropped
+    records : list
+        Profiler records of the worker, empty without profiler
+    '''
+    np.random.seed(seed)
+    if con.dp.profiler != None:
+        con.dp.profiler = stageProfiler()
+    con.df = featureStore(store).read()
+    con.df.index = index
+    con.train = con.df.iloc[train_positions]
+    con.test = con.df.drop(con.train.index)
+
+    before = set(con.__dict__)
+    getattr(con, cohort)()
+    attributes = {k: v for k, v in con.__dict__.items() if k not in before}
+    for mc in attributes.values():
+        if isinstance(mc, modelConstruction):
+            mc.df = None
+            mc.train = None
+            mc.dp = None
+    return attributes, [] if con.dp.profiler == None else con.dp.profiler.records
+
+
+def run_preprocessing_stage(dp, stage, kwargs):
+    '''
+    Runs a stage of dataPreprocessing, module level so it can be submitted to a process pool
+
+    Parameters
+    ----------
+    dp : dataPreprocessing object
+    stage : String
+        Name of the stage
+    kwargs : dict
+        Arguments passed to the stage
+
+    Returns
+    -------
+    df : pandas dataframe object
+    records : list
+        Profiler records of the worker, empty without profiler
+    '''
+    dp.sources = shared_sources
+    if dp.profiler != None:
+        dp.profiler = stageProfiler()
+    df = getattr(dp, stage)(**kwargs)
+    return df, [] if dp.profiler == None else dp.profiler.records
+
+
 class dataPreprocessing():
     '''This class handles the preprocessing of selected files obtained from the UK biobank
     '''
 
-    def __init__(self, wd) :
+    def __init__(self, wd, cache_dir=None, use_cache=True, cache_max_bytes=20*1024**3, sparse_comorbidities=False, n_jobs=1, csv_engine=None,
+                 compact_dtypes=False, family_history_targets=None, profiler=None) :
+        self.wd = wd
+        self.profiler = profiler
+
         #Data
         self.family_history = wd + "NHS/Data_files/Grouped_files/replace/Family_history.csv"
         self.attendance = wd + "NHS/Data_files/Grouped_files/replace/Dates_attending_assessment_centers_participant.csv"
@@ -51,236 +803,654 @@ class dataPreprocessing():
         #Coding
         self.coding819 = wd + "NHS/Data_files/coding/coding819.tsv"
 
+        #Source files read by each stage
+        self.stage_sources = {
+            "pre_demographics_basic": [self.demographics],
+            "pre_demographics_ethnicity": [self.demographics],
+            "pre_blood_biomarker": [self.blood_biomarkers, self.demographics],
+            "pre_alcohol": [self.alcohol],
+            "pre_bodymeasures": [self.bodymeasures],
+            "pre_blood_pressure": [self.bloodpressure],
+            "pre_family_history": [self.family_history],
+            "pre_medical_conditions": [self.medical_conditions],
+            "pre_sleep": [self.sleep],
+            "pre_smoking": [self.smoking],
+            "pre_urine_biomarkers": [self.urine_biomarkers],
+            "pre_physical_activity": [self.physical_activity],
+            "pre_white_bloodcell": [self.white_bloodcell],
+            "pre_smoking_supplementary": [self.smoking_supplementary],
+            "pre_symptomes": [self.symptomes],
+            "pre_attendance": [self.attendance],
+            "labeling_diabetes": [self.first_occurence_diabetes, self.attendance],
+            "labeling_copd": [self.first_occurence_copd, self.coding819],
+            "labeling_asthma": [self.first_occurence_asthma, self.coding819, self.attendance],
+            "labeling_osteoporosis": [self.first_occurence_osteoporosis, self.attendance],
+            "labeling_cvd": [self.first_occurence_cvd, self.attendance]
+        }
+
+        #Arguments for pandas.read_csv of source files read by more than one stage
+        self.source_read_kwargs = {
+            self.coding819: {"sep": "\t"}
+        }
+
+        #Columns each stage needs from its first source file, a list or a function on the column name.
+        #A source is read with the union of the columns of its stages, all columns when a stage is not listed here.
+        #Functions are partials of methods so that the object can be sent to worker processes
+        instance_0 = functools.partial(self.exclude_column, pattern="Instance 1|Instance 2|Instance 3")
+        self.stage_columns = {
+            "pre_demographics_basic": ['Participant ID', 'Age at recruitment', 'Sex'],
+            "pre_demographics_ethnicity": ['Participant ID', 'Ethnic background | Instance 0'],
+            "pre_blood_biomarker": instance_0,
+            "pre_alcohol": ['Participant ID', 'Alcohol intake frequency. | Instance 0'],
+            "pre_bodymeasures": ["Participant ID", "Body mass index (BMI) | Instance 0", "Body fat percentage | Instance 0",
+                                 "Waist circumference | Instance 0", "Weight | Instance 0", "Hip circumference | Instance 0",
+                                 "Whole body fat mass | Instance 0", "Basal metabolic rate | Instance 0",
+                                 "Trunk fat percentage | Instance 0", "Arm fat percentage (left) | Instance 0",
+                                 "Leg fat percentage (left) | Instance 0", 'Standing height | Instance 0'],
+            "pre_blood_pressure": ["Participant ID",
+                                   'Diastolic blood pressure, automated reading | Instance 0 | Array 0',
+                                   'Diastolic blood pressure, automated reading | Instance 0 | Array 1',
+                                   'Systolic blood pressure, automated reading | Instance 0 | Array 0',
+                                   'Systolic blood pressure, automated reading | Instance 0 | Array 1'],
+            "pre_medical_conditions": ['Participant ID', 'Non-cancer illness code, self-reported | Instance 0',
+                                       "Medication for cholesterol, blood pressure or diabetes | Instance 0",
+                                       'Medication for cholesterol, blood pressure, diabetes, or take exogenous hormones | Instance 0',
+                                       'Doctor diagnosed asthma', 'Diabetes diagnosed by doctor | Instance 0',
+                                       'Blood clot, DVT, bronchitis, emphysema, asthma, rhinitis, eczema, allergy diagnosed by doctor | Instance 0',
+                                       'Doctor diagnosed bronchiectasis', 'Doctor diagnosed hayfever or allergic rhinitis',
+                                       'Doctor diagnosed chronic bronchitis'],
+            "pre_sleep": ["Participant ID", "Sleep duration | Instance 0"],
+            "pre_smoking": ["Participant ID", "Tobacco smoking"],
+            "pre_urine_biomarkers": functools.partial(self.exclude_column, pattern="Instance 1|Instance 2|Instance 3|flag"),
+            "pre_physical_activity": ['Participant ID', 'Usual walking pace | Instance 0',
+                                      'Summed MET minutes per week for all activity | Instance 0',
+                                      'Summed minutes activity | Instance 0'],
+            "pre_white_bloodcell": instance_0,
+            "pre_symptomes": ['Participant ID', 'Wheeze or whistling in the chest in last year | Instance 0']
+        }
+
+        #Declared dtypes of source columns, columns not listed are inferred
+        numeric = lambda columns: {c: "float64" for c in columns}
+        self.source_dtypes = {
+            self.bodymeasures: numeric(self.stage_columns["pre_bodymeasures"][1:]),
+            self.bloodpressure: numeric(self.stage_columns["pre_blood_pressure"][1:]),
+            self.physical_activity: numeric(self.stage_columns["pre_physical_activity"][2:]),
+            self.demographics: {"Age at recruitment": "float64"}
+        }
+
+        #Compact dtypes of the feature table, the first matching pattern wins.
+        #auto downcasts floats to float32, integers to the smallest integer type and repeated strings to categories
+        self.compact_dtypes = compact_dtypes
+        self.dtype_schema = [
+            ("^Participant ID$", "int64"),
+            ("^Date [A-Z][0-9]+ first reported \\(.*\\)$|^Date of attending assessment centre \\| Instance [0-9]$", "datetime64[ns]"),
+            ("^Sleep duration \\| Instance 0$", "float32"),
+            #Flags stay integers, the models look up labels as 0/1
+            ("_binary$|_onehot$|_tertiary$|^binary_assesment$|^all_copd$|^Sex$|^Illnesses of (father|mother|siblings)( \\| [a-z]+)?$", "int8"),
+            ("^Usual walking pace|^Medication for|^Blood clot, DVT", "category"),
+            (".*", "auto")
+        ]
+        self.column_groups = {}
+
+        #One hot encoded columns with their source file and the transformation the stage applies before encoding
+        self.vocabulary_sources = {
+            "Ethnic background | Instance 0": (self.demographics, functools.partial(self.ethnicity_regrouping, col_name="Ethnic background | Instance 0")),
+            "Alcohol intake frequency. | Instance 0": (self.alcohol, None),
+            "Usual walking pace | Instance 0": (self.physical_activity, None),
+            "Tobacco smoking": (self.smoking, None),
+            "Wheeze or whistling in the chest in last year | Instance 0": (self.symptomes, functools.partial(pd.DataFrame.replace, to_replace=["Prefer not to answer", "Do not know"], value=np.nan))
+        }
+
+        #Rows at the top of a source file which the stage skips, copied to every shard
+        self.shard_preamble_rows = {self.family_history: 1}
+
+        #CSV parser, pyarrow when installed
+        if csv_engine == None:
+            csv_engine = "c" if pyarrow == None else "pyarrow"
+        self.csv_engine = csv_engine
+
+        #Stages which need the (merged) output of other stages, {stage: (argument, [stages merged on Participant ID])}
+        self.stage_dependencies = {
+            "pre_blood_biomarker": ("dem_basic", ["pre_demographics_basic", "pre_demographics_ethnicity"])
+        }
+
+        #Order in which the stage outputs are merged into the final dataframe
+        self.merge_order = ["pre_blood_biomarker", "pre_alcohol", "pre_bodymeasures", "pre_blood_pressure",
+                            "pre_family_history", "pre_medical_conditions", "pre_sleep", "pre_smoking",
+                            "pre_urine_biomarkers", "pre_physical_activity", "pre_white_bloodcell",
+                            "pre_smoking_supplementary", "pre_symptomes", "pre_attendance",
+                            "labeling_diabetes", "labeling_copd", "labeling_asthma", "labeling_osteoporosis", "labeling_cvd"]
+
+        #Stage producing each column of the final dataframe, the first matching pattern wins. Used by plan to find the
+        #stages a set of columns needs, comorbidities are named after the self-reported illnesses and match the last rule
+        self.stage_outputs = [
+            ("^Participant ID$", None),
+            ("^(Glycated haemoglobin \\(HbA1c\\)|Triglycerides|HDL cholesterol|Cholesterol|Apolipoprotein A|Apolipoprotein B|Glucose) \\| Instance 0$"
+             "|^trigl_hdl_ratio$|^apob_apoa_ratio$|^Age at recruitment$|^Sex$|^(Asian|Black|Chinese|Mixed|Other|White)$", "pre_blood_biomarker"),
+            ("^Alcohol intake frequency", "pre_alcohol"),
+            ("^fmi$|^(Body mass index \\(BMI\\)|Body fat percentage|Waist circumference|Weight|Hip circumference|Whole body fat mass"
+             "|Basal metabolic rate|Trunk fat percentage|Arm fat percentage \\(left\\)|Leg fat percentage \\(left\\)|Standing height) \\| Instance 0$", "pre_bodymeasures"),
+            ("^(Diastolic|Systolic) blood pressure$", "pre_blood_pressure"),
+            ("^Illnesses of ", "pre_family_history"),
+            ("^Sleep duration", "pre_sleep"),
+            ("^Tobacco smoking", "pre_smoking"),
+            (" in urine \\| Instance 0$|^albumin_creatine_ratio$", "pre_urine_biomarkers"),
+            ("^Usual walking pace|^Summed (MET minutes|minutes activity)|^(Brisk pace|None of the above|Prefer not to answer|Slow pace|Steady average pace)$",
+             "pre_physical_activity"),
+            ("^(Neutrophill count|Eosinophill count|Haemoglobin concentration) \\| Instance 0$", "pre_white_bloodcell"),
+            ("^Pack years|^Age started smoking|^Number of cigarettes", "pre_smoking_supplementary"),
+            ("^Wheeze or whistling", "pre_symptomes"),
+            ("^Date of attending assessment centre|^Year of birth$", "pre_attendance"),
+            ("^Date E1[0-4] |^first_occurence_diabetes", "labeling_diabetes"),
+            ("^Date J4[0-47] |^all_copd", "labeling_copd"),
+            ("^Date J4[56] |^all_asthma|^binary_assesment$|^age_asthma$", "labeling_asthma"),
+            ("^Date M8[0-2] ", "labeling_osteoporosis"),
+            ("^Date I[0-9]+ ", "labeling_cvd"),
+            ("^Non-cancer illness|^Medication for|^Blood clot|^Doctor diagnosed|^Diabetes diagnosed|^Cholesterol_lowering_medication$"
+             "|^Insulin$|^Blood_pressure$|^Hayfever_allergic|^Emphysema_chronic|^[a-z]", "pre_medical_conditions")
+        ]
+
+        #Number of worker processes used by factory
+        self.n_jobs = n_jobs
+
+        #Raw source files shared between the stages of a run
+        self.sources = None
+
+        #Cache
+        self.cache = None
+        if cache_dir != None:
+            self.cache = stageCache(cache_dir, max_bytes=cache_max_bytes)
+        self.use_cache = use_cache
+
+        #Store the comorbidity indicators as sparse columns
+        self.sparse_comorbidities = sparse_comorbidities
+
+        #Dates
+        self.date_format = "%Y-%m-%d"
+        self.sentinel_dates = ["Code has no event date",
+                               "Code has event date before participant's date of birth",
+                               "Code has event date matching participant's date of birth",
+                               "Code has event date after participant's date of birth and falls in the same calendar year as date of birth",
+                               "Code has event date in the future and is presumed to be a place-holder or other system default"]
+
+        #Family history: pattern of the reported illnesses per disease, hip fracture is the only one related to osteoporosis.
+        #pre_family_history encodes the diseases in family_history_targets
+        self.family_history_diseases = {"diabetes": "Diabetes",
+                                        "copd": "Chronic bronchitis/emphysema",
+                                        "cvd": "Heart disease|Stroke|High blood pressure",
+                                        "osteoporosis": "Hip fracture"}
+        self.family_history_targets = ["diabetes"] if family_history_targets == None else family_history_targets
+        self.family_history_categories = {}
+
+        #Flags of pre_medical_conditions: (source columns, pattern, output column), see string_flags
+        medication = ["Medication for cholesterol, blood pressure or diabetes | Instance 0",
+                      "Medication for cholesterol, blood pressure, diabetes, or take exogenous hormones | Instance 0"]
+        diagnosed = ["Blood clot, DVT, bronchitis, emphysema, asthma, rhinitis, eczema, allergy diagnosed by doctor | Instance 0"]
+        self.medical_condition_flags = [
+            (medication, "Cholesterol lowering medication", "Cholesterol_lowering_medication"),
+            (medication, "Insulin", "Insulin"),
+            (medication, "Blood pressure medication", "Blood_pressure"),
+            (["Doctor diagnosed asthma"], "^Yes$", "Doctor diagnosed asthma"),
+            (["Diabetes diagnosed by doctor | Instance 0"], "^Yes$", "Diabetes diagnosed by doctor | Instance 0"),
+            (diagnosed, "Hayfever, allergic rhinitis or eczema", "Hayfever_allergic_rhinitis_eczema_doctor"),
+            (diagnosed, "Emphysema/chronic bronchitis", "Emphysema_chronic_bronchitis_doctor"),
+            (["Doctor diagnosed bronchiectasis"], "^Yes$", "Doctor diagnosed bronchiectasis"),
+            (["Doctor diagnosed hayfever or allergic rhinitis"], "^Yes$", "Doctor diagnosed hayfever or allergic rhinitis"),
+            (["Doctor diagnosed chronic bronchitis"], "^Yes$", "Doctor diagnosed chronic bronchitis")
+        ]
+
+        #Global vocabularies, set by factory_sharded so that every shard encodes the same columns
+        self.vocabularies = {}
+        self.comorbidity_vocabulary = None
+
         #Variables
         self.meaning = None
         self.coding = None
+        self.exclusion = None
         self.df = None
         self.comorbidities = []
 
+    def code_version(self):
+        '''
+        Returns a version string of the preprocessing code, used to invalidate cached stages after code changes.
+        The whole module is hashed, the stages also depend on its module level helpers
+
+        Returns
+        -------
+        version : String
+        '''
+        try:
+            source = inspect.getsource(inspect.getmodule(type(self)))
+        except (OSError, TypeError):
+            source = ""
+        return __version__ + "-" + hashlib.sha1(source.encode()).hexdigest()
+
+    def __getstate__(self):
+        #The source registry is not sent to worker processes, forked workers inherit it
+        state = self.__dict__.copy()
+        state["sources"] = None
+        return state
+
+    def exclude_column(self, c, pattern):
+        '''
+        Column selector of stage_columns, True when the column name does not match the pattern
+        '''
+        return not re.search(pattern, c)
 
-    def merge_noneoftheabove(self, df):
-        '''This functions replaces none of the above from group 1 and 2 into general none of the above
+    def read_source(self, path, **kwargs):
         '''
-        return df.replace(to_replace="None of the above (group 1)|None of the above (group 2)", value="None of the above")
-    
-    def remove_redundant_noneoftheabove(self, df):
-        '''This function replaces none of the above from group 1 and 2 and replaces them with an empty string
+        Reads a raw source file through the source registry of the current run, directly from disk outside a run
+
+        Parameters
+        ----------
+        path : String
+            Path of the source file
+        kwargs :
+            Arguments passed to pandas.read_csv
+
+        Returns
+        -------
+        df : pandas dataframe object
         '''
-        df =  df.replace(to_replace="\|None of the above \(group 1\)", value="", regex=True)
-        df =  df.replace(to_replace="\|None of the above \(group 2\)", value="", regex=True)
+        if self.sources == None:
+            df = self.read_csv(path, **kwargs)
+        else:
+            df = self.sources.read(path, **kwargs)
+        if self.profiler != None:
+            self.profiler.observe(df)
         return df
-    
-    def diagnosis_including_diabetes(self, df, df_columns):
+
+    def source_columns(self, path):
         '''
-        Consructs three lists:
-         1) dm: The various sets of diseases containing dm
-         2) other: The various sets of diseases not containing dm
-         1) uncertain: The condition of familymember is not specified
+        Returns the columns of a source file needed by the stages reading it, in file order
 
         Parameters
         ----------
-        df : pandas dataframe object
-            Dataframe containing data to be used
-        df_columns : List
-            List with column names as string to be evaluated
-
-        Returns
-        -------
-        dm : list
-        other : list
-        uncertain : list
-        '''
-        all = []
-        for col in df_columns:
-            for i in df[col].unique():
-                if i not in all:
-                    all.append(i)
-                    
-        dm = []
-        other = []
-        uncertain = []
-        for i in all:
-            if type(i) == str:
-                if re.search("Diabetes", i):
-                    dm.append(i)
-                elif re.search("Do not know", i):
-                    uncertain.append(i)
-                else:
-                    other.append(i)
-            else:
-                uncertain.append(i)
+        path : String
+            Path of the source file
 
-        return dm, other, uncertain
+        Returns
+        -------
+        columns : list
+            None when all columns are needed
+        '''
+        declared = [self.stage_columns.get(stage) for stage, sources in self.stage_sources.items() if sources[0] == path]
+        if len(declared) == 0 or any(d is None for d in declared):
+            return None
+        header = pd.read_csv(path, nrows=0, **self.source_read_kwargs.get(path, {})).columns
+        return [c for c in header if any(d(c) if callable(d) else c in d for d in declared)]
 
-    def pre_family_history(self):
+    def read_csv(self, path, **kwargs):
         '''
-        Returns dataframe with three rows indicating the presence of diabetes in father, mother and sibling binary
+        Reads a source file with only the columns declared in stage_columns and the dtypes in source_dtypes
+
+        Parameters
+        ----------
+        path : String
+            Path of the source file
+        kwargs :
+            Arguments passed to pandas.read_csv
 
         Returns
         -------
         df : pandas dataframe object
-            Dataframe with diabetes values for different family members
         '''
-        fh = pd.read_csv(self.family_history)
-        fh = self.merge_noneoftheabove(fh)
-        fh = self.remove_redundant_noneoftheabove(fh)
-        dm, other, uncertain = self.diagnosis_including_diabetes(fh, fh.columns[1:])
-        #Create new columns indicating whether a familymember suffers from diabetes (1:yes,0:no,3:uncertain)
-        fh.loc[:, ("Illnesses of father | Instance 0",
-                "Illnesses of father | Instance 1",
-                "Illnesses of father | Instance 2",
-                "Illnesses of father | Instance 3",
-                "Illnesses of mother | Instance 0",
-                "Illnesses of mother | Instance 1",
-                "Illnesses of mother | Instance 2",
-                "Illnesses of mother | Instance 3",
-                "Illnesses of siblings | Instance 0",
-                "Illnesses of siblings | Instance 1",
-                "Illnesses of siblings | Instance 2",
-                "Illnesses of siblings | Instance 3"
-                )] = fh.loc[:, ("Illnesses of father | Instance 0",
-                "Illnesses of father | Instance 1",
-                "Illnesses of father | Instance 2",
-                "Illnesses of father | Instance 3",
-                "Illnesses of mother | Instance 0",
-                "Illnesses of mother | Instance 1",
-                "Illnesses of mother | Instance 2",
-                "Illnesses of mother | Instance 3",
-                "Illnesses of siblings | Instance 0",
-                "Illnesses of siblings | Instance 1",
-                "Illnesses of siblings | Instance 2",
-                "Illnesses of siblings | Instance 3"
-                )].replace(to_replace=dm, value=1)
-
-        fh.loc[:, ("Illnesses of father | Instance 0",
-                "Illnesses of father | Instance 1",
-                "Illnesses of father | Instance 2",
-                "Illnesses of father | Instance 3",
-                "Illnesses of mother | Instance 0",
-                "Illnesses of mother | Instance 1",
-                "Illnesses of mother | Instance 2",
-                "Illnesses of mother | Instance 3",
-                "Illnesses of siblings | Instance 0",
-                "Illnesses of siblings | Instance 1",
-                "Illnesses of siblings | Instance 2",
-                "Illnesses of siblings | Instance 3"
-                )] = fh.loc[:, ("Illnesses of father | Instance 0",
-                "Illnesses of father | Instance 1",
-                "Illnesses of father | Instance 2",
-                "Illnesses of father | Instance 3",
-                "Illnesses of mother | Instance 0",
-                "Illnesses of mother | Instance 1",
-                "Illnesses of mother | Instance 2",
-                "Illnesses of mother | Instance 3",
-                "Illnesses of siblings | Instance 0",
-                "Illnesses of siblings | Instance 1",
-                "Illnesses of siblings | Instance 2",
-                "Illnesses of siblings | Instance 3"
-                )].replace(to_replace=other, value=0)
-
-        fh.loc[:, ("Illnesses of father | Instance 0",
-                "Illnesses of father | Instance 1",
-                "Illnesses of father | Instance 2",
-                "Illnesses of father | Instance 3",
-                "Illnesses of mother | Instance 0",
-                "Illnesses of mother | Instance 1",
-                "Illnesses of mother | Instance 2",
-                "Illnesses of mother | Instance 3",
-                "Illnesses of siblings | Instance 0",
-                "Illnesses of siblings | Instance 1",
-                "Illnesses of siblings | Instance 2",
-                "Illnesses of siblings | Instance 3"
-                )] = fh.loc[:, ("Illnesses of father | Instance 0",
-                "Illnesses of father | Instance 1",
-                "Illnesses of father | Instance 2",
-                "Illnesses of father | Instance 3",
-                "Illnesses of mother | Instance 0",
-                "Illnesses of mother | Instance 1",
-                "Illnesses of mother | Instance 2",
-                "Illnesses of mother | Instance 3",
-                "Illnesses of siblings | Instance 0",
-                "Illnesses of siblings | Instance 1",
-                "Illnesses of siblings | Instance 2",
-                "Illnesses of siblings | Instance 3"
-                )].replace(to_replace=uncertain, value=3)
-
-        conditions = [ (fh["Illnesses of father | Instance 0"] == 1),
-                    (fh["Illnesses of father | Instance 1"] == 1),
-                    (fh["Illnesses of father | Instance 2"] == 1),
-                    (fh["Illnesses of father | Instance 3"] == 1),
-                    (fh["Illnesses of father | Instance 0"] == 3),
-                    (fh["Illnesses of father | Instance 1"] == 3),
-                    (fh["Illnesses of father | Instance 2"] == 3),
-                    (fh["Illnesses of father | Instance 3"] == 3),
-                    (fh["Illnesses of father | Instance 0"] == 0),
-                    (fh["Illnesses of father | Instance 1"] == 0),
-                    (fh["Illnesses of father | Instance 2"] == 0),
-                    (fh["Illnesses of father | Instance 3"] == 0)
-                    ]
-
-        values = [1,1,1,1,3,3,3,3,0,0,0,0]
-        fh["Illnesses of father"] = np.select(conditions, values)
-
-        conditions = [
-                    (fh["Illnesses of mother | Instance 0"] == 1),
-                    (fh["Illnesses of mother | Instance 1"] == 1),
-                    (fh["Illnesses of mother | Instance 2"] == 1),
-                    (fh["Illnesses of mother | Instance 3"] == 1),
-                    (fh["Illnesses of mother | Instance 0"] == 3),
-                    (fh["Illnesses of mother | Instance 1"] == 3),
-                    (fh["Illnesses of mother | Instance 2"] == 3),
-                    (fh["Illnesses of mother | Instance 3"] == 3),
-                    (fh["Illnesses of mother | Instance 0"] == 0),
-                    (fh["Illnesses of mother | Instance 1"] == 0),
-                    (fh["Illnesses of mother | Instance 2"] == 0),
-                    (fh["Illnesses of mother | Instance 3"] == 0)]
-        fh["Illnesses of mother"] = np.select(conditions, values)
-
-        conditions = [
-                    (fh["Illnesses of siblings | Instance 0"] == 1),
-                    (fh["Illnesses of siblings | Instance 1"] == 1),
-                    (fh["Illnesses of siblings | Instance 2"] == 1),
-                    (fh["Illnesses of siblings | Instance 3"] == 1),
-                    (fh["Illnesses of siblings | Instance 0"] == 3),
-                    (fh["Illnesses of siblings | Instance 1"] == 3),
-                    (fh["Illnesses of siblings | Instance 2"] == 3),
-                    (fh["Illnesses of siblings | Instance 3"] == 3),
-                    (fh["Illnesses of siblings | Instance 0"] == 0),
-                    (fh["Illnesses of siblings | Instance 1"] == 0),
-                    (fh["Illnesses of siblings | Instance 2"] == 0),
-                    (fh["Illnesses of siblings | Instance 3"] == 0)]
-        fh["Illnesses of siblings"] = np.select(conditions, values)
-
-        fh = fh.drop(fh.columns[1:13], axis=1)
-        fh = fh[1:].replace(3,0)
-        return fh
-    
-    def ethnicity_regrouping(self, df, col_name):  # demographics
+        kwargs = dict(self.source_read_kwargs.get(path, {}), **kwargs)
+        usecols = self.source_columns(path)
+        if usecols != None:
+            kwargs["usecols"] = usecols
+        dtype = {c: t for c, t in self.source_dtypes.get(path, {}).items() if usecols == None or c in usecols}
+        if dtype:
+            kwargs["dtype"] = dtype
+
+        if self.csv_engine != "pyarrow":
+            return pd.read_csv(path, **kwargs)
+        return self.read_csv_pyarrow(path, sep=kwargs.get("sep", ","), usecols=usecols, dtype=dtype)
+
+    def read_csv_pyarrow(self, path, sep=",", usecols=None, dtype=None):
         '''
-        This function regroups the different ethinicities into bigger groups as
-        provided by the ethnicity_mapping dictionary.
+        Reads a csv file with the pyarrow parser into a dataframe equal to the one of pandas.read_csv:
+        same missing values, dates kept as strings and NaN for missing strings
 
         Parameters
         ----------
+        path : String
+            Path of the csv file
+        sep : String
+            Delimiter (default is ",")
+        usecols : list
+            Columns to read, all when None (default is None)
+        dtype : dict
+            Dtypes of columns (default is None)
+
+        Returns
+        -------
         df : pandas dataframe object
-            Dataframe containing data to be used
-        col_name : String
-            Name of column containing ethnicity values
+        '''
+        #Text columns are read as strings by pyarrow, casting after the conversion would turn missing values into "nan"
+        text = {c: pyarrow.string() for c, t in (dtype or {}).items() if t in (str, object, "str", "object")}
+        dtype = {c: t for c, t in (dtype or {}).items() if c not in text}
+        convert_options = pyarrow.csv.ConvertOptions(include_columns=usecols, null_values=CSV_NA_VALUES,
+                                                     strings_can_be_null=True, column_types=text)
+        table = pyarrow.csv.read_csv(path, parse_options=pyarrow.csv.ParseOptions(delimiter=sep),
+                                     convert_options=convert_options)
+        #pyarrow infers dates, the stages expect the raw strings
+        for i, field in enumerate(table.schema):
+            if pyarrow.types.is_date(field.type) or pyarrow.types.is_timestamp(field.type):
+                table = table.set_column(i, field.name, pyarrow.compute.cast(table.column(i), pyarrow.string()))
+        df = table.to_pandas()
+        del table
+        for c in df.columns[df.dtypes == object]:
+            df[c] = df[c].where(df[c].notnull(), np.nan)
+        if dtype:
+            df = df.astype(dtype)
+        return df
+
+    def stage_options(self, stage):
+        '''
+        Returns the settings of this object which change the output of a stage, part of its cache key
+
+        Parameters
+        ----------
+        stage : String
+            Name of the stage
+
+        Returns
+        -------
+        options : dict
+        '''
+        if stage == "pre_family_history":
+            return {"family_history_targets": self.family_history_targets}
+        if stage == "pre_medical_conditions":
+            return {"sparse_comorbidities": self.sparse_comorbidities, "comorbidity_vocabulary": self.comorbidity_vocabulary}
+        vocabularies = {c: v for c, v in self.vocabularies.items() if self.vocabulary_sources[c][0] == self.stage_sources[stage][0]}
+        if vocabularies:
+            return {"vocabularies": vocabularies}
+        return {}
+
+    def cached_stage(self, stage):
+        '''
+        Looks up a stage in the cache
+
+        Parameters
+        ----------
+        stage : String
+            Name of the stage
 
         Returns
         -------
+        key : String
+            Cache key of the stage, None when caching is disabled
         df : pandas dataframe object
-            Dataframe with grouped ethnicities
+            Cached result, None on a miss
         '''
-        try:
-                if "Ethnic background" not in col_name:
-                    raise ValueError("Double check that the column is the ethnicity background column" )
-            
-        except ValueError as e:
-            print("Error:", e)
-            # You can choose to re-raise the exception to propagate it to the calling code
-            raise e    
-        else:
+        if self.cache == None or not self.use_cache:
+            return None, None
+        key = self.cache.key(stage, self.stage_sources[stage], self.code_version(), self.stage_options(stage))
+        return key, self.cache.load(stage, key)
+
+    def store_stage(self, stage, key, df):
+        '''
+        Writes the result of a stage to the cache, no-op when caching is disabled
+        '''
+        if key != None:
+            self.cache.store(stage, key, df, self.stage_sources[stage])
+
+    def stage_order(self):
+        '''
+        Returns all stages in an order where every stage comes after the stages it depends on
+
+        Returns
+        -------
+        order : list
+        '''
+        order = []
+        def visit(stage):
+            if stage in order:
+                return
+            if stage in self.stage_dependencies:
+                for dependency in self.stage_dependencies[stage][1]:
+                    visit(dependency)
+            order.append(stage)
+        for stage in self.stage_sources:
+            visit(stage)
+        return order
+
+    def stage_kwargs(self, stage, results):
+        '''
+        Builds the arguments of a stage from the results of the stages it depends on
+
+        Parameters
+        ----------
+        stage : String
+            Name of the stage
+        results : dict
+            Finished stages, dependencies are removed from it once consumed
+
+        Returns
+        -------
+        kwargs : dict
+        '''
+        if stage not in self.stage_dependencies:
+            return {}
+        argument, dependencies = self.stage_dependencies[stage]
+        df = results.pop(dependencies[0])
+        for dependency in dependencies[1:]:
+            df = df.merge(results.pop(dependency), on="Participant ID")
+        return {argument: df}
+
+    def run_stages(self, n_jobs=1, stages=None):
+        '''
+        Runs the stages and the stages they depend on, independent stages run concurrently in a process pool when
+        n_jobs > 1. Cache lookups and writes are done in this process
+
+        Parameters
+        ----------
+        n_jobs : integer
+            Number of worker processes (default is 1)
+        stages : list
+            Stages of self.merge_order to run (default is None, all of them)
+
+        Returns
+        -------
+        results : dict
+            Output of the stages
+        '''
+        if stages == None:
+            stages = self.merge_order
+        candidates = set(stages)
+        for stage in stages:
+            candidates.update(self.stage_dependencies.get(stage, (None, []))[1])
+        order = [stage for stage in self.stage_order() if stage in candidates]
+        results = {}
+        keys = {}
+
+        #Cached stages, the dependencies of a cached stage are not needed
+        for stage in order:
+            keys[stage], df = self.cached_stage(stage)
+            if df is not None:
+                results[stage] = df
+                print("%s (cached)" % stage)
+        needed = set(stages)
+        for stage in stages:
+            if stage not in results and stage in self.stage_dependencies:
+                needed.update(self.stage_dependencies[stage][1])
+        waiting = [stage for stage in order if stage in needed and stage not in results]
+        total = len(waiting)
+
+        #Source files are parsed once and freed after their last consumer
+        consumers = {}
+        for stage in waiting:
+            for path in self.stage_sources[stage]:
+                consumers[path] = consumers.get(path, 0) + 1
+        self.sources = sourceRegistry(consumers, reader=self.read_csv)
+
+        if n_jobs <= 1:
+            for i, stage in enumerate(waiting):
+                results[stage] = getattr(self, stage)(**self.stage_kwargs(stage, results))
+                self.sources.release(self.stage_sources[stage])
+                self.store_stage(stage, keys[stage], results[stage])
+                print("%d/%d %s" % (i+1, total, stage))
+            self.sources = None
+            return results
+
+        #Forked workers inherit the shared sources loaded here, other start methods read from disk
+        global shared_sources
+        if multiprocessing.get_start_method() == "fork":
+            for path in self.sources.shared():
+                self.read_source(path)
+            shared_sources = self.sources
+
+        running = {}
+        finished = 0
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            while waiting or running:
+                #Dispatch stages whose dependencies are done
+                for stage in list(waiting):
+                    dependencies = self.stage_dependencies.get(stage, (None, []))[1]
+                    if all(d in results for d in dependencies):
+                        waiting.remove(stage)
+                        future = executor.submit(run_preprocessing_stage, self, stage, self.stage_kwargs(stage, results))
+                        running[future] = stage
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    results[stage], records = future.result()
+                    if self.profiler != None:
+                        self.profiler.extend(records)
+                    self.sources.release(self.stage_sources[stage])
+                    self.store_stage(stage, keys[stage], results[stage])
+                    finished += 1
+                    print("%d/%d %s" % (finished, total, stage))
+        shared_sources = None
+        self.sources = None
+        return results
+
+    def invalidate(self, stage=None):
+        '''
+        Removes cached results of a stage, or of all stages when no stage is given
+
+        Parameters
+        ----------
+        stage : String
+            Name of the stage (default is None)
+        '''
+        if self.cache != None:
+            self.cache.invalidate(stage)
+
+
+    def pre_family_history(self):
+        '''
+        Returns dataframe with three rows indicating the presence of diabetes in father, mother and sibling binary.
+        The other diseases of self.family_history_targets get a column per relative named "<relative> | <disease>"
+
+        Returns
+        -------
+        df : pandas dataframe object
+            Dataframe with diabetes values for different family members
+        '''
+        fh = self.read_source(self.family_history)[1:]
+        encoded = self.family_history_encoding(fh, self.family_history_targets)
+        df = pd.DataFrame({"Participant ID": pd.to_numeric(fh["Participant ID"])}) #Text in the preamble row makes the column object
+        for name, codes in encoded.items():
+            df[name] = np.where(codes == 1, 1, 0) #Uncertain counts as no
+        return df
+
+    def family_history_encoding(self, fh, diseases):
+        '''
+        Encodes the illnesses of every relative for each disease as 1 (disease reported), 3 (uncertain, missing
+        or do not know) or 0 (other illnesses). Every distinct string is classified once, the instances of a relative
+        are combined with the maximum over the ranks other < uncertain < disease
+
+        Parameters
+        ----------
+        fh : pandas dataframe object
+            Family history with "Illnesses of <relative> | Instance <n>" columns
+        diseases : list
+            Keys of self.family_history_diseases
+
+        Returns
+        -------
+        encoded : dict
+            Column name, "Illnesses of <relative>" for diabetes and "Illnesses of <relative> | <disease>" otherwise,
+            with an array of codes
+        '''
+        relatives = {}
+        for c in fh.columns:
+            m = re.match("^(Illnesses of .*) \\| Instance [0-9]+$", c)
+            if m:
+                relatives.setdefault(m.group(1), []).append(c)
+        columns = [c for instances in relatives.values() for c in instances]
+        values = fh[columns].to_numpy(dtype=object)
+        codes, uniques = pd.factorize(values.ravel())
+
+        encoded = {}
+        for disease in diseases:
+            #Missing values have code -1, which picks the appended uncertain rank
+            ranks = np.append(self.family_history_ranks(uniques, disease), 1)[codes].reshape(values.shape)
+            k = 0
+            for relative, instances in relatives.items():
+                rank = ranks[:, k:k+len(instances)].max(axis=1) if len(fh) else np.zeros(0, dtype=int)
+                k += len(instances)
+                encoded[relative if disease == "diabetes" else relative + " | " + disease] = np.array([0, 3, 1])[rank]
+        return encoded
+
+    def family_history_ranks(self, uniques, disease):
+        '''
+        Ranks reported illnesses for a disease: 2 when the disease is reported, 1 for do not know and 0 otherwise.
+        Classifications are kept in self.family_history_categories, so a string is matched at most once per disease
+
+        Parameters
+        ----------
+        uniques : array
+            Distinct reported illnesses
+        disease : String
+            Key of self.family_history_diseases
+
+        Returns
+        -------
+        ranks : array
+        '''
+        known = self.family_history_categories.setdefault(disease, {})
+        pattern = self.family_history_diseases[disease]
+        for i in uniques:
+            if i not in known:
+                if type(i) != str:
+                    known[i] = 1
+                elif re.search(pattern, i):
+                    known[i] = 2
+                elif re.search("Do not know", i):
+                    known[i] = 1
+                else:
+                    known[i] = 0
+        return np.array([known[i] for i in uniques], dtype=int)
+    
+    def ethnicity_regrouping(self, df, col_name):  # demographics
+        '''
+        This function regroups the different ethinicities into bigger groups as
+        provided by the ethnicity_mapping dictionary.
+
+        Parameters
+        ----------
+        df : pandas dataframe object
+            Dataframe containing data to be used
+        col_name : String
+            Name of column containing ethnicity values
+
+        Returns
+        -------
+        df : pandas dataframe object
+            Dataframe with grouped ethnicities
+        '''
+        try:
+                if "Ethnic background" not in col_name:
+                    raise ValueError("Double check that the column is the ethnicity background column" )
+            
+        except ValueError as e:
+            print("Error:", e)
+            # You can choose to re-raise the exception to propagate it to the calling code
+            raise e    
+        else:
             ethnicity_mapping = {    # We use the same groups as explained in the AMS.
                 'British': 'White',          
                 'Irish': 'White',
@@ -314,6 +1484,28 @@ class dataPreprocessing():
 
             return df
         
+    def categorical(self, x):
+        '''
+        Returns columns as categorical with their global vocabulary, so one hot encoding creates a column for every
+        category. Columns without a vocabulary are returned unchanged
+
+        Parameters
+        ----------
+        x : pandas series or dataframe object
+
+        Returns
+        -------
+        x : pandas series or dataframe object
+        '''
+        if isinstance(x, pd.Series):
+            if x.name not in self.vocabularies:
+                return x
+            return x.astype(pd.CategoricalDtype(self.vocabularies[x.name]))
+        dtypes = {c: pd.CategoricalDtype(v) for c, v in self.vocabularies.items() if c in x.columns}
+        if not dtypes:
+            return x
+        return x.astype(dtypes)
+
     def pre_demographics_ethnicity(self):
         '''
         Returns a dataframe with one hot encodings for six main ethnicities
@@ -322,10 +1514,10 @@ class dataPreprocessing():
         -------
         df : pandas dataframe object
         '''
-        d = pd.read_csv(self.demographics)
+        d = self.read_source(self.demographics)
         d = self.ethnicity_regrouping(d, "Ethnic background | Instance 0")
         d = d[["Participant ID", "Ethnic background | Instance 0"]]
-        one_hot = pd.get_dummies(d["Ethnic background | Instance 0"])
+        one_hot = pd.get_dummies(self.categorical(d["Ethnic background | Instance 0"]))
         d = pd.concat([d, one_hot], axis=1)
         d = d[['Participant ID',
                'Asian',
@@ -344,7 +1536,7 @@ class dataPreprocessing():
         -------
         df : pandas dataframe object
         '''
-        d = pd.read_csv(self.demographics)
+        d = self.read_source(self.demographics)
         d = d[['Participant ID', 'Age at recruitment', 'Sex']]
         d["Sex"] = d[["Sex"]].apply(self.sex_to_binary, axis=1)
         return d
@@ -357,7 +1549,7 @@ class dataPreprocessing():
         -------
         df : pandas dataframe object
         '''
-        bm = pd.read_csv(self.bodymeasures)
+        bm = self.read_source(self.bodymeasures)
         bm["fmi"] = bm["Whole body fat mass | Instance 0"] / ((bm["Standing height | Instance 0"] /100)* (bm["Standing height | Instance 0"]/100))#Create fat mass index column
         bm = bm[["Participant ID","fmi",
                 "Body mass index (BMI) | Instance 0",
@@ -402,7 +1594,7 @@ class dataPreprocessing():
         -------
         df : pandas dataframe object
         '''
-        bbm = pd.read_csv(self.blood_biomarkers)
+        bbm = self.read_source(self.blood_biomarkers)
         first_and_general_instances = [i for i in list(bbm.columns) if not re.search("Instance 1|Instance 2|Instance 3", i)]
         remove_columns = [ i for i in bbm.columns if i not in first_and_general_instances ]
         bbm = bbm.drop(remove_columns, axis=1)
@@ -420,7 +1612,7 @@ class dataPreprocessing():
         -------
         df : pandas dataframe object
         '''
-        bp = pd.read_csv(self.bloodpressure)
+        bp = self.read_source(self.bloodpressure)
 
         bp['Diastolic blood pressure'] = bp[['Diastolic blood pressure, automated reading | Instance 0 | Array 0',
         'Diastolic blood pressure, automated reading | Instance 0 | Array 1']].mean(axis=1)
@@ -437,7 +1629,7 @@ class dataPreprocessing():
         -------
         df : pandas dataframe object
         '''
-        bm = pd.read_csv(self.urine_biomarkers, low_memory=False)
+        bm = self.read_source(self.urine_biomarkers, low_memory=False)
         first_and_general_instances = [i for i in list(bm.columns) if not re.search("Instance 1|Instance 2|Instance 3|flag", i)]
         remove_columns = [ i for i in bm.columns if i not in first_and_general_instances ]
         bm = bm.drop(remove_columns, axis=1)
@@ -446,532 +1638,1277 @@ class dataPreprocessing():
         return bm
     
 
-    def pre_medical_conditions(self):
+    def pre_medical_conditions(self):
+        '''
+        Function which creates da datframe for medical conditions
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        mc = self.read_source(self.medical_conditions, low_memory=False)
+        
+        #Comorbilities
+        comorb = self.encode_comorbidities(mc['Non-cancer illness code, self-reported | Instance 0'])
+        mc = pd.concat([mc, comorb], axis=1)
+
+        #Medication and diagnosed by doctor
+        for name, flag in self.string_flags(mc, self.medical_condition_flags).items():
+            mc[name] = flag
+
+        return mc
+    
+    def string_flags(self, df, flags):
+        '''
+        Computes binary flags from string columns. The patterns of all flags reading a column are compiled into a
+        single regular expression of optional lookaheads, so one match of a distinct value sets every flag it
+        satisfies. Each column is scanned once through its distinct values, missing values are never flagged
+
+        Parameters
+        ----------
+        df : pandas dataframe object
+        flags : list
+            (source columns, pattern, output column), a row is flagged when the pattern matches any of the source columns
+
+        Returns
+        -------
+        flags : dict
+            Output column with an integer array of ones and zeros
+        '''
+        out = {name: np.zeros(len(df), dtype=np.int64) for columns, pattern, name in flags}
+        for column in dict.fromkeys(c for columns, pattern, name in flags for c in columns):
+            readers = [(pattern, name) for columns, pattern, name in flags if column in columns]
+            matcher = re.compile("".join("(?=(?:.*?(?P<f%d>%s))?)" % (k, pattern) for k, (pattern, name) in enumerate(readers)), re.DOTALL)
+            codes, uniques = pd.factorize(df[column])
+            matched = np.zeros((len(uniques)+1, len(readers)), dtype=bool) #Last row for the missing values, code -1
+            for u, value in enumerate(uniques):
+                if type(value) == str:
+                    groups = matcher.match(value).groupdict()
+                    matched[u] = [groups["f%d" % k] != None for k in range(len(readers))]
+            for k, (pattern, name) in enumerate(readers):
+                out[name] |= matched[codes, k]
+        return out
+
+    def encode_comorbidities(self, s, sep="|"):
+        '''
+        One hot encodes the comorbidities in a column of separated self-reported illnesses.
+        The column is split once and every comorbidity is matched as an exact token, columns are ordered by first occurence.
+
+        Parameters
+        -------
+        s : pandas series object
+            Column with comorbidities separated by sep
+        sep : String
+            Separator between comorbidities (default is |)
+
+        Returns
+        -------
+        df : pandas dataframe object
+            Dataframe with a binary column for every comorbidity
+        '''
+        tokens = s.reset_index(drop=True).str.split(sep).explode().dropna()
+        if self.comorbidity_vocabulary == None:
+            codes, uniques = pd.factorize(tokens)
+        else:
+            uniques = pd.Index(self.comorbidity_vocabulary)
+            codes = uniques.get_indexer(tokens.values)
+            tokens = tokens[codes >= 0]
+            codes = codes[codes >= 0]
+        self.comorbidities = uniques.tolist()
+
+        if self.sparse_comorbidities:
+            block = sparse.csc_matrix((np.ones(len(codes), dtype=np.uint8), (tokens.index.to_numpy(), codes)),
+                                      shape=(len(s), len(uniques)))
+            block.sum_duplicates()
+            block.data[:] = 1
+            return pd.DataFrame.sparse.from_spmatrix(block, index=s.index, columns=self.comorbidities)
+
+        block = np.zeros((len(s), len(uniques)), dtype=np.int64)
+        block[tokens.index.to_numpy(), codes] = 1
+        return pd.DataFrame(block, columns=self.comorbidities, index=s.index)
+
+    def comorbidity_memory_report(self, df=None, column='Non-cancer illness code, self-reported | Instance 0', sep="|"):
+        '''
+        Compares the memory use of the comorbidity indicator block in different layouts:
+        dense int64 (previous layout), the current layout of the dataframe, sparse CSR and bit-packed
+
+        Parameters
+        -------
+        df : pandas dataframe object
+            Dataframe containing the comorbidity columns (default is self.df)
+        column : String
+            Column with the self-reported illnesses the comorbidities were derived from
+
+        Returns
+        -------
+        report : pandas dataframe object
+            Bytes per layout and the ratio to the dense int64 layout
+        '''
+        if df is None:
+            df = self.df
+        comorbidities = [c for c in pd.unique(df[column].str.split(sep).explode().dropna()) if c in df.columns]
+        n, k = df.shape[0], len(comorbidities)
+        nnz = int(sum((df[c] != 0).sum() for c in comorbidities))
+
+        report = pd.DataFrame({"layout": ["dense int64", "current", "sparse CSR (uint8, int32 indices)", "bit-packed"],
+                               "bytes": [n*k*8,
+                                         int(df[comorbidities].memory_usage(index=False, deep=True).sum()),
+                                         nnz*(1+4) + (n+1)*4,
+                                         k*int(np.ceil(n/8))]})
+        report["ratio"] = report["bytes"] / max(n*k*8, 1)
+        report["total_dataframe_bytes"] = int(df.memory_usage(index=True, deep=True).sum())
+        return report
+
+    def get_comorb(self, i):
+        '''
+        Returns list with different obseverd comorbidities
+
+        Parameters
+        -------
+        i : String
+
+
+        Returns
+        -------
+        list : list
+            List containing applicable comborbidities
+        '''
+        if str(i) != "nan":
+            i = i.split("|")
+            for j in i:
+                if j not in self.comorbidities:
+                    self.comorbidities.append(j)
+
+    def mc_search(self, instance_comord, current_comord):
+        if re.search(current_comord, str(instance_comord)):
+            return 1
+        return 0
+    
+    def pre_alcohol(self): 
+        '''
+        Returns one hot encoding for selected rates of alcohol consumption
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        alc = self.read_source(self.alcohol, sep=",", low_memory=False)
+        alc = pd.get_dummies(self.categorical(alc), columns=["Alcohol intake frequency. | Instance 0"])
+        alc = alc[['Participant ID', 
+            'Alcohol intake frequency. | Instance 0_Daily or almost daily',
+            'Alcohol intake frequency. | Instance 0_Never',
+            'Alcohol intake frequency. | Instance 0_Once or twice a week',
+            'Alcohol intake frequency. | Instance 0_One to three times a month',
+            'Alcohol intake frequency. | Instance 0_Special occasions only',
+            'Alcohol intake frequency. | Instance 0_Three or four times a week']]
+        return alc
+    
+    def pre_physical_activity(self):
+        '''
+        Returns selected physical activity measures
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        pa = self.read_source(self.physical_activity, low_memory=False)
+        one_hot = pd.get_dummies(self.categorical(pa['Usual walking pace | Instance 0']))
+        pa = pd.concat([pa, one_hot], axis=1)
+        return pa
+    
+    def pre_sleep(self):
+        '''
+        Returns selected sleep measures
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        sleep = self.read_source(self.sleep, low_memory=False)
+        sleep = sleep[["Participant ID", "Sleep duration | Instance 0"]]
+        sleep = sleep.replace("Prefer not to answer", pd.np.nan)
+        sleep = sleep.replace("Do not know", pd.np.nan)
+        return sleep
+    
+    def pre_smoking(self):
+        '''
+        Returns dataframe with columns indicating if a participant smokes, or has smoked
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        smoking = self.read_source(self.smoking, low_memory=False)
+        smoking = smoking[["Participant ID","Tobacco smoking"]]
+        smoking = pd.get_dummies(self.categorical(smoking), columns=["Tobacco smoking", ])
+        smoking = smoking[['Participant ID', 'Tobacco smoking_Ex-smoker',
+                            'Tobacco smoking_Never smoked', 'Tobacco smoking_Occasionally',
+                            'Tobacco smoking_Smokes on most or all days']]
+        return smoking
+    
+    def pre_smoking_supplementary(self):
+        '''
+        Creates dataframe with extensive smoking data
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        smoking_data = self.read_source(self.smoking_supplementary)
+        smoking_data = smoking_data.rename(columns={"eid": 'Participant ID', "p20161_i0":"Pack years of smoking",
+                                          "p20162_i0":"Pack years adult smoking as proportion of life span exposed to smoking",
+                                          "p3436_i0":"Age started smoking in current smokers",
+                                          "p2867_i0":"Age started smoking in former smokers",
+                                          "p3456_i0":"Number of cigarettes currently smoked daily (current cigarette smokers)",
+                                          "p6183_i0":"Number of cigarettes previously smoked daily (current cigar/pipe smokers)",
+                                          "p2887_i0":"Number of cigarettes previously smoked daily"})
+        smoking_data['Age started smoking in current smokers'] = smoking_data['Age started smoking in current smokers'].replace("Do not know", pd.np.nan)
+        smoking_data['Age started smoking in current smokers'] = smoking_data['Age started smoking in current smokers'].replace("Prefer not to answer", pd.np.nan)
+        smoking_data["Age started smoking in current smokers"] = pd.to_numeric(smoking_data["Age started smoking in current smokers"])
+
+        smoking_data['Age started smoking in former smokers'] = smoking_data['Age started smoking in former smokers'].replace("Do not know", pd.np.nan)
+        smoking_data['Age started smoking in former smokers'] = smoking_data['Age started smoking in former smokers'].replace("Prefer not to answer", pd.np.nan)
+        smoking_data["Age started smoking in former smokers"] = pd.to_numeric(smoking_data["Age started smoking in former smokers"])
+
+        smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'] = smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'].replace("Do not know", pd.np.nan)
+        smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'] = smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'].replace("Prefer not to answer", pd.np.nan)
+        smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'] = smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'].replace("Less than one a day", pd.np.nan)
+        smoking_data["Number of cigarettes currently smoked daily (current cigarette smokers)"] = pd.to_numeric(smoking_data["Number of cigarettes currently smoked daily (current cigarette smokers)"])
+
+        smoking_data['Number of cigarettes previously smoked daily'] = smoking_data['Number of cigarettes previously smoked daily'].replace("Do not know", pd.np.nan)
+        smoking_data['Number of cigarettes previously smoked daily'] = smoking_data['Number of cigarettes previously smoked daily'].replace("Prefer not to answer", pd.np.nan)
+        smoking_data['Number of cigarettes previously smoked daily'] = smoking_data['Number of cigarettes previously smoked daily'].replace("Less than one a day", pd.np.nan)
+        smoking_data["Number of cigarettes previously smoked daily"] = pd.to_numeric(smoking_data["Number of cigarettes previously smoked daily"])
+        return smoking_data
+    
+    def pre_white_bloodcell(self):
+        '''
+        Creates dataframe with white bloodcell data
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        wb = self.read_source(self.white_bloodcell)
+        first_and_general_instances = [i for i in list(wb.columns) if not re.search("Instance 1|Instance 2|Instance 3", i)]
+        remove_columns = [ i for i in wb.columns if i not in first_and_general_instances ]
+        wb = wb.drop(remove_columns, axis=1)
+        return wb
+   
+    def pre_symptomes(self):
+        '''
+        Creates dataframe with symptom data
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        s = self.read_source(self.symptomes, low_memory=False)
+        s = s[['Participant ID',
+                'Wheeze or whistling in the chest in last year | Instance 0'
+                ]]
+        s = s.replace("Prefer not to answer", pd.np.nan)
+        s = s.replace("Do not know", pd.np.nan)
+        
+        #s = s.dropna()
+        s = pd.get_dummies(self.categorical(s), columns=['Wheeze or whistling in the chest in last year | Instance 0'])
+        return s
+    
+    def pre_attendance(self):
+        '''
+        Creates dataframe with attendance data
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        return self.read_source(self.attendance)
+    
+    def labeling_diabetes(self):
+        '''
+        Returns dataframe with two labels:
+            1) first_occurence_binary: label which indicates whether a first occurence of diabetes has happend (no=0, yes=1)
+            2) first_occurence_tertiary: label which indicates whether a first occurence has happend, is going to happen,
+                                         or doesn't happen (0: did not happen, 1: did happen, 3: is going to happen)
+        
+        Returns
+        -------
+        df : pandas dataframe object
+        ''' 
+        df = self.read_source(self.first_occurence_diabetes)
+        df["first_occurence_diabetes"] = self.earliest_date(df, df.columns[1:]) #Earliest parsed date over all diabetes columns
+        df["first_occurence_diabetes_binary"] = self.nan_to_binary(df["first_occurence_diabetes"])
+
+        att = self.read_source(self.attendance)
+        att = att[["Participant ID", "Date of attending assessment centre | Instance 0"]] #Select columns
+        df = df.merge(att, on = "Participant ID")
+        df["first_occurence_diabetes_tertiary"] = self.nan_to_tertiary(df["first_occurence_diabetes"], df["Date of attending assessment centre | Instance 0"])
+
+        di = ['Date E10 first reported (insulin-dependent diabetes mellitus)',
+       'Date E11 first reported (non-insulin-dependent diabetes mellitus)',
+       'Date E12 first reported (malnutrition-related diabetes mellitus)',
+       'Date E13 first reported (other specified diabetes mellitus)',
+       'Date E14 first reported (unspecified diabetes mellitus)']
+        for i in di:
+            df[i+"_onehot"] = self.nan_to_binary(df[i]) #One hot encoding for various diabetes types
+
+
+        df = df.drop(["Date of attending assessment centre | Instance 0"], axis=1)
+        return df
+    
+    def parse_dates(self, s):
+        '''
+        Parses a column of first occurence dates with self.date_format. UK biobank sentinel
+        strings (self.sentinel_dates) and values which cannot be parsed become NaT
+
+        Parameters
+        -------
+        s : pandas series object
+
+        Returns
+        -------
+        pandas series object
+            Column with dtype datetime64[ns]
+        '''
+        if s.dtype.kind == "M":
+            return s
+        s = s.where(~s.isin(self.sentinel_dates))
+        parsed = pd.to_datetime(s, format=self.date_format, errors="coerce")
+        failed = parsed.isnull() & s.notnull()
+        if failed.any():
+            print("Varible not convertable to datetime: ", s[failed].unique()[:5].tolist(), "(%d values)" % failed.sum())
+        return parsed
+
+    def earliest_date(self, df, columns):
+        '''
+        Returns the earliest date per row over multiple date columns
+
+        Parameters
+        -------
+        df : pandas dataframe object
+        columns : list
+            Columns with dates (strings or datetime64)
+
+        Returns
+        -------
+        pandas series object
+            Earliest date per row, NaT when no column holds a valid date
+        '''
+        columns = list(columns)
+        if len(columns) == 0:
+            return pd.Series(pd.NaT, index=df.index, dtype="datetime64[ns]")
+        dates = np.empty((len(df), len(columns)), dtype=np.int64)
+        for j, c in enumerate(columns):
+            dates[:, j] = self.parse_dates(df[c]).values.astype("datetime64[ns]").view(np.int64)
+        nat = np.iinfo(np.int64).min #NaT is stored as the minimum int64
+        dates[dates == nat] = np.iinfo(np.int64).max
+        earliest = dates.min(axis=1)
+        earliest[earliest == np.iinfo(np.int64).max] = nat
+        return pd.Series(earliest.view("datetime64[ns]"), index=df.index)
+
+    def nan_to_binary(self, s):
+        '''
+        Convert a column into binary on the existance of missing values: 0 for missing values, 1 otherwise
+
+        Parameters
+        -------
+        s : pandas series object
+
+        Returns
+        -------
+        pandas series object
+        '''
+        return s.notnull().astype(np.int64)
+
+    def nan_to_tertiary(self, first_occurence, attendance):
+        '''
+        Encodes a first occurence relative to attendance (0: did not happen, 1: happend before attendance, 2: happend on or after attendance)
+
+        Parameters
+        -------
+        first_occurence : pandas series object
+        attendance : pandas series object
+
+        Returns
+        -------
+        pandas series object
+        '''
+        first_occurence = self.parse_dates(first_occurence)
+        attendance = self.parse_dates(attendance)
+        labels = np.select([first_occurence.isnull().values, (first_occurence < attendance).values], [0, 1], default=2)
+        return pd.Series(labels.astype(np.int64), index=first_occurence.index)
+    
+    def labeling_asthma(self):
+        '''
+        Returns dataframe with class labels for asthma
+
+        Returns
+        -------
+        df : pandas dataframe object
+        '''
+        #Obtain first occurence for asthma 
+        df = self.read_source(self.first_occurence_asthma)
+        
+        #Delete with specific coding
+        df = self.coding_exclusion().exclude(df, ["Date J45 first reported (asthma)", "Date J46 first reported (status asthmaticus)"],
+                                             name="labeling_asthma")
+
+        #Earliest date for first occurence
+        df["all_asthma"] = self.earliest_date(df, ["Date J45 first reported (asthma)", "Date J46 first reported (status asthmaticus)"])
+        df["all_asthma_binary"] = self.nan_to_binary(df["all_asthma"])
+
+        #Obtain assesment dates
+        df = df.merge(self.read_source(self.attendance)[["Participant ID", "Date of attending assessment centre | Instance 0",
+                                                     "Year of birth"]], on="Participant ID")
+        df['Date of attending assessment centre | Instance 0']= pd.to_datetime(df['Date of attending assessment centre | Instance 0'])
+        df["binary_assesment"] = self.binary_assesment(df["all_asthma"], df['Date of attending assessment centre | Instance 0'])
+
+        #Age of asthma diagnosis
+        df["age_asthma"] = self.age_asthma(df["all_asthma"], df["Year of birth"])
+
+        df = df.drop(["Date of attending assessment centre | Instance 0"], axis=1)
+        df = df.drop([ "Year of birth"], axis=1)
+
+        return df
+    
+    def coding_exclusion(self):
         '''
-        Function which creates da datframe for medical conditions
+        Returns the codingExclusion of coding819, which is read on the first call
 
         Returns
         -------
-        df : pandas dataframe object
+        exclusion : codingExclusion object
         '''
-        mc = pd.read_csv(self.medical_conditions, low_memory=False)
-        
-        #Comorbilities
-        mc['Non-cancer illness code, self-reported | Instance 0'].apply(self.get_comorb)
-        for i in self.comorbidities:
-            mc[i] = mc['Non-cancer illness code, self-reported | Instance 0'].apply(self.mc_search, current_comord=i)
-
-        #Medication
-        mc["Cholesterol_lowering_medication"] = mc[["Medication for cholesterol, blood pressure or diabetes | Instance 0", 'Medication for cholesterol, blood pressure, diabetes, or take exogenous hormones | Instance 0']].apply(self.str_check_twocolumn, string="Cholesterol lowering medication",axis=1)
-        mc["Insulin"] = mc[["Medication for cholesterol, blood pressure or diabetes | Instance 0", 'Medication for cholesterol, blood pressure, diabetes, or take exogenous hormones | Instance 0']].apply(self.str_check_twocolumn, string="Insulin", axis=1)
-        mc["Blood_pressure"] = mc[["Medication for cholesterol, blood pressure or diabetes | Instance 0", 'Medication for cholesterol, blood pressure, diabetes, or take exogenous hormones | Instance 0']].apply(self.str_check_twocolumn, string="Blood pressure medication", axis=1)
-        mc['Doctor diagnosed asthma'] = mc['Doctor diagnosed asthma'].apply(self.yes_no_binary)
-        mc['Diabetes diagnosed by doctor | Instance 0'] = mc['Diabetes diagnosed by doctor | Instance 0'].replace("Prefer not to answer", pd.np.nan)
-        mc['Diabetes diagnosed by doctor | Instance 0'] = mc['Diabetes diagnosed by doctor | Instance 0'].replace("Do not know", pd.np.nan)
-        mc['Diabetes diagnosed by doctor | Instance 0'] =mc['Diabetes diagnosed by doctor | Instance 0'].apply(self.yes_no_binary)
-
-        #diagnosed by doctor
-        mc["Hayfever_allergic_rhinitis_eczema_doctor"] = mc[['Blood clot, DVT, bronchitis, emphysema, asthma, rhinitis, eczema, allergy diagnosed by doctor | Instance 0']].apply(self.Hayfever_allergic_rhinitis_eczema_doctor_check, axis=1)
-        mc["Emphysema_chronic_bronchitis_doctor"] = mc[['Blood clot, DVT, bronchitis, emphysema, asthma, rhinitis, eczema, allergy diagnosed by doctor | Instance 0']].apply(self.Emphysema_chronic_bronchitis_doctor_check, axis=1)
-        
-        #Binairy to ones and zeros
-        mc["Doctor diagnosed bronchiectasis"] = mc[['Doctor diagnosed bronchiectasis']].apply(self.yes_no_binary, axis=1)
-        mc["Doctor diagnosed hayfever or allergic rhinitis"] = mc[['Doctor diagnosed hayfever or allergic rhinitis']].apply(self.Emphysema_chronic_bronchitis_doctor_check, axis=1)
-        mc["Doctor diagnosed chronic bronchitis"] = mc[['Doctor diagnosed chronic bronchitis']].apply(self.yes_no_binary, axis=1)
-        mc["Doctor diagnosed hayfever or allergic rhinitis"] = mc[['Doctor diagnosed hayfever or allergic rhinitis']].apply(self.Emphysema_chronic_bronchitis_doctor_check, axis=1)
+        if self.exclusion == None:
+            self.exclusion = codingExclusion(self.read_source(self.coding819))
+            self.coding = self.exclusion.coding
+            self.meaning = self.exclusion.meaning
+        return self.exclusion
 
-        return mc
-    
-    def Hayfever_allergic_rhinitis_eczema_doctor_check(self, i):
-        if re.search("Hayfever, allergic rhinitis or eczema", str(i)):
-                return 1
-        if re.search("nan", str(i)):
-                return pd.np.nan
-        return 0
-    
-    def Emphysema_chronic_bronchitis_doctor_check(self, i):
-        if re.search("Emphysema/chronic bronchitis", str(i)):
-                return 1
-        if re.search("nan", str(i)):
-                return pd.np.nan
-        return 0
-    
-    def yes_no_binary(self, i):
+    def binary_assesment(self, first_occurence, attendance):
         '''
-        This function replaces yes and no into binary values
+        1 when the first occurence is after attendance, 0 otherwise or when either date is missing
 
         Parameters
         -------
-        i : String
-            Either Yes or no
-        
+        first_occurence : pandas series object
+        attendance : pandas series object
+
         Returns
         -------
-        i : Integer
-            binary encoding for option
+        pandas series object
         '''
-        if str(i) == "Yes":
-            return 1
-        return 0
+        return (self.parse_dates(first_occurence) > self.parse_dates(attendance)).astype(np.int64)
 
-    def get_comorb(self, i):
+    def age_asthma(self, first_occurence, year_of_birth):
         '''
-        Returns list with different obseverd comorbidities
+        Age at the first occurence, NaN when the date is missing
 
         Parameters
         -------
-        i : String
+        first_occurence : pandas series object
+        year_of_birth : pandas series object
 
+        Returns
+        -------
+        pandas series object
+        '''
+        return self.parse_dates(first_occurence).dt.year - pd.to_numeric(year_of_birth, errors="coerce")
+        
+    def labeling_copd(self):
+        '''
+        Returns dataframe with class labels for copd
 
         Returns
         -------
-        list : list
-            List containing applicable comborbidities
+        df : pandas dataframe object
         '''
-        if str(i) != "nan":
-            i = i.split("|")
-            for j in i:
-                if j not in self.comorbidities:
-                    self.comorbidities.append(j)
+        df = self.read_source(self.first_occurence_copd)
 
-    def mc_search(self, instance_comord, current_comord):
-        if re.search(current_comord, str(instance_comord)):
-            return 1
-        return 0
+        cols = [
+       'Date J40 first reported (bronchitis, not specified as acute or chronic)',
+       'Date J41 first reported (simple and mucopurulent chronic bronchitis)',
+       'Date J42 first reported (unspecified chronic bronchitis)',
+       'Date J43 first reported (emphysema)',
+       'Date J44 first reported (other chronic obstructive pulmonary disease)',
+       'Date J47 first reported (bronchiectasis)']
+        for i in cols:
+            df[i+"_binary"] = self.nan_to_binary(df[i])
+        
+        cols_binary = [i+"_binary" for i in cols]
+        df["all_copd"] = df[cols_binary].max(axis=1)
+
+        df = self.coding_exclusion().exclude(df, cols, name="labeling_copd")
+
+        df["all_copd_date"] = self.earliest_date(df, cols)
+
+        return df
     
-    def str_check_twocolumn(self, i, string):
-        if re.search(string, str(i[0])) or re.search(string, str(i[1])):
-            return 1
+    def any_binary(self, l):
+        for i in l:
+            if i == 1:
+                return 1
         return 0
-        
-    def pre_alcohol(self): 
+    
+    def labeling_osteoporosis(self):
         '''
-        Returns one hot encoding for selected rates of alcohol consumption
+        Returns dataframe with class labels for osteoporosis
 
         Returns
         -------
         df : pandas dataframe object
         '''
-        alc = pd.read_csv(self.alcohol, sep=",", low_memory=False)
-        alc = pd.get_dummies(alc, columns=["Alcohol intake frequency. | Instance 0"])
-        alc = alc[['Participant ID', 
-            'Alcohol intake frequency. | Instance 0_Daily or almost daily',
-            'Alcohol intake frequency. | Instance 0_Never',
-            'Alcohol intake frequency. | Instance 0_Once or twice a week',
-            'Alcohol intake frequency. | Instance 0_One to three times a month',
-            'Alcohol intake frequency. | Instance 0_Special occasions only',
-            'Alcohol intake frequency. | Instance 0_Three or four times a week']]
-        return alc
+        df = self.read_source(self.first_occurence_osteoporosis)
+        att = self.read_source(self.attendance)
+        df = df.merge(att[['Participant ID', 'Year of birth']], on='Participant ID')
+
+        df["Date M80 first reported (osteoporosis with pathological fracture)_binary"] = self.nan_to_binary(df["Date M80 first reported (osteoporosis with pathological fracture)"])
+        df["Date M81 first reported (osteoporosis without pathological fracture)_binary"] = self.nan_to_binary(df["Date M81 first reported (osteoporosis without pathological fracture)"])
+        df["Date M82 first reported (osteoporosis in diseases classified elsewhere)_binary"] = self.nan_to_binary(df["Date M82 first reported (osteoporosis in diseases classified elsewhere)"])
     
-    def pre_physical_activity(self):
+        df['Date M80 first reported (osteoporosis with pathological fracture)_year'] = self.parse_dates(df['Date M80 first reported (osteoporosis with pathological fracture)']).dt.year
+        df['Date M81 first reported (osteoporosis without pathological fracture)_year'] = self.parse_dates(df['Date M81 first reported (osteoporosis without pathological fracture)']).dt.year
+        df['Date M82 first reported (osteoporosis in diseases classified elsewhere)_year'] = self.parse_dates(df['Date M82 first reported (osteoporosis in diseases classified elsewhere)']).dt.year
+
+        df["Date M80 first reported (osteoporosis with pathological fracture)_age"] = self.age_osteo(df['Year of birth'], df['Date M80 first reported (osteoporosis with pathological fracture)_year'])
+        df["Date M81 first reported (osteoporosis without pathological fracture)_age"] = self.age_osteo(df['Year of birth'], df['Date M80 first reported (osteoporosis with pathological fracture)_year'])
+        df["Date M82 first reported (osteoporosis in diseases classified elsewhere)_age"] = self.age_osteo(df['Year of birth'], df['Date M80 first reported (osteoporosis with pathological fracture)_year'])
+        #TODO: Add all_osteo column
+        df = df.drop(['Year of birth'], axis=1)
+        return df
+    
+    def age_osteo(self, year_of_birth, year):
         '''
-        Returns selected physical activity measures
+        Year of the first occurence minus year of birth
+
+        Parameters
+        -------
+        year_of_birth : pandas series object
+        year : pandas series object
 
         Returns
         -------
-        df : pandas dataframe object
+        pandas series object
         '''
-        pa = pd.read_csv(self.physical_activity, low_memory=False)
-        one_hot = pd.get_dummies(pa['Usual walking pace | Instance 0'])
-        pa = pd.concat([pa, one_hot], axis=1)
-        return pa
+        return (year - year_of_birth).astype(np.float64)
     
-    def pre_sleep(self):
+    def labeling_cvd(self):
         '''
-        Returns selected sleep measures
+        Returns dataframe with class labels for cvd
 
         Returns
         -------
         df : pandas dataframe object
         '''
-        sleep = pd.read_csv(self.sleep, low_memory=False)
-        sleep = sleep[["Participant ID", "Sleep duration | Instance 0"]]
-        sleep = sleep.replace("Prefer not to answer", pd.np.nan)
-        sleep = sleep.replace("Do not know", pd.np.nan)
-        return sleep
-    
-    def pre_smoking(self):
+        cvd = self.read_source(self.first_occurence_cvd, low_memory=False)
+        cvd_columns = cvd.columns.tolist()
+        cvd_columns.remove("Participant ID")
+        att = self.read_source(self.attendance)
+        att['Date of attending assessment centre | Instance 0'] = self.parse_dates(att['Date of attending assessment centre | Instance 0'])
+        cvd = cvd.merge(att[["Participant ID", 'Date of attending assessment centre | Instance 0']], on="Participant ID")
+
+        dates, flags, diff_days = self.event_labels(cvd[cvd_columns], cvd['Date of attending assessment centre | Instance 0'])
+        return pd.concat([cvd[["Participant ID"]], dates, flags, diff_days], axis=1)
+
+    def event_labels(self, events, reference):
         '''
-        Returns dataframe with columns indicating if a participant smokes, or has smoked
+        Labels a block of first occurence columns at once. The columns are handled as one 2-D array: a single
+        factorization gives the missing mask for the flags, the distinct values are parsed once with self.date_format
+        (sentinel strings become NaT) and the reference date is subtracted by broadcasting
+
+        Parameters
+        ----------
+        events : pandas dataframe object
+            First occurence columns as strings
+        reference : pandas series object
+            Reference date per row, e.g. the attendance date
 
         Returns
         -------
-        df : pandas dataframe object
+        dates : pandas dataframe object
+            Parsed dates, same columns as events
+        flags : pandas dataframe object
+            Bool, True when the column holds a value (also a sentinel), columns named "<column>_binary"
+        diff_days : pandas dataframe object
+            Float32 days from the reference date to the event, columns named "<column>diff_days"
         '''
-        smoking = pd.read_csv(self.smoking, low_memory=False)
-        smoking = smoking[["Participant ID","Tobacco smoking"]]
-        smoking = pd.get_dummies(smoking, columns=["Tobacco smoking", ])
-        smoking = smoking[['Participant ID', 'Tobacco smoking_Ex-smoker',
-                            'Tobacco smoking_Never smoked', 'Tobacco smoking_Occasionally',
-                            'Tobacco smoking_Smokes on most or all days']]
-        return smoking
+        #Dates repeat a lot, so the distinct values are parsed and taken back, missing values have code -1
+        codes, uniques = pd.factorize(events.to_numpy(dtype=object).ravel())
+        codes = codes.reshape(events.shape)
+        flags = codes >= 0
+        parsed = np.append(self.parse_dates(pd.Series(uniques, dtype=object)).to_numpy(), np.datetime64("NaT", "ns"))[codes]
+        diff_days = ((parsed - reference.to_numpy()[:, None]) / np.timedelta64(1, "D")).astype(np.float32)
+
+        columns = events.columns
+        return (pd.DataFrame(parsed, index=events.index, columns=columns),
+                pd.DataFrame(flags, index=events.index, columns=[c+"_binary" for c in columns]),
+                pd.DataFrame(diff_days, index=events.index, columns=[c+"diff_days" for c in columns]))
     
-    def pre_smoking_supplementary(self):
+    def merge_stages(self, frames, key="Participant ID"):
         '''
-        Creates dataframe with extensive smoking data
+        Joins the stage outputs with chained inner merges on key
+
+        Parameters
+        ----------
+        frames : list
+            Pandas dataframe objects, all with a key column. The list is emptied while merging
 
         Returns
         -------
         df : pandas dataframe object
         '''
-        smoking_data = pd.read_csv(self.smoking_supplementary)
-        smoking_data = smoking_data.rename(columns={"eid": 'Participant ID', "p20161_i0":"Pack years of smoking",
-                                          "p20162_i0":"Pack years adult smoking as proportion of life span exposed to smoking",
-                                          "p3436_i0":"Age started smoking in current smokers",
-                                          "p2867_i0":"Age started smoking in former smokers",
-                                          "p3456_i0":"Number of cigarettes currently smoked daily (current cigarette smokers)",
-                                          "p6183_i0":"Number of cigarettes previously smoked daily (current cigar/pipe smokers)",
-                                          "p2887_i0":"Number of cigarettes previously smoked daily"})
-        smoking_data['Age started smoking in current smokers'] = smoking_data['Age started smoking in current smokers'].replace("Do not know", pd.np.nan)
-        smoking_data['Age started smoking in current smokers'] = smoking_data['Age started smoking in current smokers'].replace("Prefer not to answer", pd.np.nan)
-        smoking_data["Age started smoking in current smokers"] = pd.to_numeric(smoking_data["Age started smoking in current smokers"])
+        df = frames.pop(0)
+        while frames:
+            df = df.merge(frames.pop(0), on=key)
+        return df
 
-        smoking_data['Age started smoking in former smokers'] = smoking_data['Age started smoking in former smokers'].replace("Do not know", pd.np.nan)
-        smoking_data['Age started smoking in former smokers'] = smoking_data['Age started smoking in former smokers'].replace("Prefer not to answer", pd.np.nan)
-        smoking_data["Age started smoking in former smokers"] = pd.to_numeric(smoking_data["Age started smoking in former smokers"])
+    def merge_column_names(self, column_lists, key="Participant ID", suffixes=("_x", "_y")):
+        '''
+        Returns the column names chained merges on key would produce, overlapping columns get the merge suffixes
 
-        smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'] = smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'].replace("Do not know", pd.np.nan)
-        smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'] = smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'].replace("Prefer not to answer", pd.np.nan)
-        smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'] = smoking_data['Number of cigarettes currently smoked daily (current cigarette smokers)'].replace("Less than one a day", pd.np.nan)
-        smoking_data["Number of cigarettes currently smoked daily (current cigarette smokers)"] = pd.to_numeric(smoking_data["Number of cigarettes currently smoked daily (current cigarette smokers)"])
+        Parameters
+        ----------
+        column_lists : list
+            Column names of every frame
 
-        smoking_data['Number of cigarettes previously smoked daily'] = smoking_data['Number of cigarettes previously smoked daily'].replace("Do not know", pd.np.nan)
-        smoking_data['Number of cigarettes previously smoked daily'] = smoking_data['Number of cigarettes previously smoked daily'].replace("Prefer not to answer", pd.np.nan)
-        smoking_data['Number of cigarettes previously smoked daily'] = smoking_data['Number of cigarettes previously smoked daily'].replace("Less than one a day", pd.np.nan)
-        smoking_data["Number of cigarettes previously smoked daily"] = pd.to_numeric(smoking_data["Number of cigarettes previously smoked daily"])
-        return smoking_data
-    
-    def pre_white_bloodcell(self):
+        Returns
+        -------
+        columns : list
         '''
-        Creates dataframe with white bloodcell data
+        columns = list(column_lists[0])
+        for right in column_lists[1:]:
+            right = [c for c in right if c != key]
+            overlap = set(columns) & set(right)
+            columns = [c+suffixes[0] if c in overlap else c for c in columns] + [c+suffixes[1] if c in overlap else c for c in right]
+        return columns
+
+    def join_stages(self, frames, key="Participant ID"):
+        '''
+        Joins the stage outputs in a single aligned concat on an int64 key index. Same result as merge_stages
+        (inner join, column order and suffixes, rows in the order of the first frame) without copying the
+        growing dataframe for every stage. Falls back to merge_stages when a key is duplicated
+
+        Parameters
+        ----------
+        frames : list
+            Pandas dataframe objects, all with a key column. The list is emptied while joining so the
+            stage outputs can be freed as soon as they are part of the result
 
         Returns
         -------
         df : pandas dataframe object
         '''
-        wb = pd.read_csv(self.white_bloodcell)
-        first_and_general_instances = [i for i in list(wb.columns) if not re.search("Instance 1|Instance 2|Instance 3", i)]
-        remove_columns = [ i for i in wb.columns if i not in first_and_general_instances ]
-        wb = wb.drop(remove_columns, axis=1)
-        return wb
-   
-    def pre_symptomes(self):
+        keys = []
+        for frame in frames:
+            if frame[key].dtype.kind not in "iu" or frame[key].duplicated().any():
+                return self.merge_stages(frames, key)
+            keys.append(frame[key].values.astype(np.int64))
+
+        #Participants present in every stage
+        common = np.sort(keys[0])
+        for k in keys[1:]:
+            common = np.intersect1d(common, k, assume_unique=True)
+        order = keys[0][np.isin(keys[0], common)]
+        index = pd.Index(order)
+
+        columns = self.merge_column_names([frame.columns for frame in frames], key)
+        parts = []
+        for i in range(len(frames)):
+            frame = frames.pop(0).copy(deep=False)
+            frame.index = pd.Index(keys[i])
+            if i > 0:
+                del frame[key] #Only copies the block holding the key, drop would copy the whole frame
+            if not frame.index.equals(index):
+                frame = frame.reindex(index)
+            parts.append(frame)
+
+        #copy=False would consolidate the blocks, which holds a third copy of the data at its peak
+        df = pd.concat(parts, axis=1, copy=True)
+        del parts
+        df.columns = columns
+        df.index = pd.RangeIndex(len(df))
+        return df
+
+    def join_memory_report(self):
         '''
-        Creates dataframe with symptom data
+        Compares merge_stages and join_stages on the stage outputs (loaded from the cache when enabled).
+        Peak is the memory traced by tracemalloc during the join on top of the stage outputs
 
         Returns
         -------
-        df : pandas dataframe object
+        report : pandas dataframe object
         '''
-        s = pd.read_csv(self.symptomes, low_memory=False)
-        s = s[['Participant ID',
-                'Wheeze or whistling in the chest in last year | Instance 0'
-                ]]
-        s = s.replace("Prefer not to answer", pd.np.nan)
-        s = s.replace("Do not know", pd.np.nan)
+        import tracemalloc
+        report = []
+        for name, join in [("merge_stages", self.merge_stages), ("join_stages", self.join_stages)]:
+            results = self.run_stages(self.n_jobs)
+            frames = [results.pop(stage) for stage in self.merge_order]
+            stage_bytes = sum(int(frame.memory_usage(deep=False).sum()) for frame in frames)
+            tracemalloc.start()
+            start = time.time()
+            df = join(frames)
+            seconds = time.time() - start
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            report.append({"method": name, "seconds": seconds, "stage_bytes": stage_bytes, "peak_bytes": peak,
+                           "result_bytes": int(df.memory_usage(deep=False).sum()), "shape": df.shape})
+            del df
+        return pd.DataFrame(report)
+
+    def factory(self, n_jobs=None, columns=None):
+        '''
+        Runs all stages and merges their output into self.df. When columns are given only the stages producing them
+        are run and only these columns are kept. Participants are then only required to be in the files of those
+        stages, so the rows can differ from a full run
+
+        Parameters
+        ----------
+        n_jobs : integer
+            Number of worker processes, defaults to self.n_jobs
+        columns : list
+            Columns of the dataframe, e.g. modelConstruction.required_columns (default is None, all columns)
+        '''
+        if n_jobs == None:
+            n_jobs = self.n_jobs
+
+        print("DATAPREPROCESSING INITIALIZED")
+        stages = self.merge_order
+        plan = None
+        if columns != None:
+            plan = self.plan(columns)
+            stages = list(plan)
+            print("Planned stages: %s" % ", ".join(stages))
+        results = self.run_stages(n_jobs, stages)
+
+        #Join the stage outputs
+        frames = [results.pop(stage) for stage in stages]
+        if plan != None:
+            frames = [frame[[c for c in frame.columns if c == "Participant ID" or c in plan[stage]]] for stage, frame in zip(stages, frames)]
+            missing = [c for stage in stages for c in plan[stage] if c not in frames[stages.index(stage)].columns]
+            if missing:
+                print("Columns not produced by their stage: %s" % missing)
+        columns = self.merge_column_names([frame.columns for frame in frames])
+        groups = [stages[0]]*len(frames[0].columns)
+        for stage, frame in zip(stages[1:], frames[1:]):
+            groups += [stage]*(len(frame.columns)-1)
+        self.column_groups = dict(zip(columns, groups))
+        df = self.join_stages(frames)
+        print("DATAPREPROCESSING DONE")
+
+        if self.sparse_comorbidities:
+            #Merges with missing keys upcast the sparse fill value, restore the uint8 indicators
+            sparse_columns = [c for c in df.columns if isinstance(df[c].dtype, pd.SparseDtype)]
+            df[sparse_columns] = df[sparse_columns].astype(pd.SparseDtype(np.uint8, 0))
+
+        if self.compact_dtypes:
+            df = self.compact(df)
         
-        #s = s.dropna()
-        s = pd.get_dummies(s, columns=['Wheeze or whistling in the chest in last year | Instance 0'])
-        return s
-    
-    def pre_attendance(self):
+        self.df = df
+
+    def plan(self, columns):
         '''
-        Creates dataframe with attendance data
+        Finds the stages which produce the columns with self.stage_outputs
+
+        Parameters
+        ----------
+        columns : list
+            Columns of the final dataframe
 
         Returns
         -------
-        df : pandas dataframe object
+        plan : dict
+            Stage with the requested columns it produces, in the order of self.merge_order
         '''
-        return pd.read_csv(self.attendance)
-    
-    def labeling_diabetes(self):
+        plan = {}
+        unknown = []
+        for c in columns:
+            stage = next((stage for pattern, stage in self.stage_outputs if re.search(pattern, c)), "")
+            if stage == "":
+                unknown.append(c)
+            elif stage != None and c not in plan.setdefault(stage, []):
+                plan[stage].append(c)
+        if unknown:
+            raise ValueError("No stage produces the columns: %s" % unknown)
+        return {stage: plan[stage] for stage in self.merge_order if stage in plan}
+
+    def compact(self, df):
         '''
-        Returns dataframe with two labels:
-            1) first_occurence_binary: label which indicates whether a first occurence of diabetes has happend (no=0, yes=1)
-            2) first_occurence_tertiary: label which indicates whether a first occurence has happend, is going to happen,
-                                         or doesn't happen (0: did not happen, 1: did happen, 3: is going to happen)
-        
+        Converts the columns of the feature table to the dtypes of self.dtype_schema. Columns declared as bool or
+        integer which hold missing values or values out of range become float32, sparse columns are left as they are
+
+        Parameters
+        ----------
+        df : pandas dataframe object
+
         Returns
         -------
         df : pandas dataframe object
-        ''' 
-        df = pd.read_csv(self.first_occurence_diabetes)
-        df["first_occurence_diabetes"] = df[df.columns[1:]].apply(self.earliest_date, axis=1) #Perform the earliest_date function
-        df["first_occurence_diabetes_binary"] = df["first_occurence_diabetes"].apply(self.nan_to_binary) #Perform the nan_to_binary function
+        '''
+        for c in df.columns:
+            s = df[c]
+            if isinstance(s.dtype, pd.SparseDtype):
+                continue
+            dtype = next(t for pattern, t in self.dtype_schema if re.search(pattern, c))
+            if dtype == "auto":
+                if s.dtype.kind == "f":
+                    dtype = "float32"
+                elif s.dtype.kind in "iu":
+                    dtype = pd.to_numeric(s, downcast="integer").dtype.name if len(s) else s.dtype.name
+                elif s.dtype == object and s.nunique() < 0.5 * max(s.count(), 1):
+                    dtype = "category"
+                else:
+                    continue
+            df[c] = self.cast_column(s, dtype)
+        return df
 
-        att = pd.read_csv(self.attendance)
-        att = att[["Participant ID", "Date of attending assessment centre | Instance 0"]] #Select columns
-        df = df.merge(att, on = "Participant ID")
-        df["first_occurence_diabetes_tertiary"] = df[["first_occurence_diabetes", "Date of attending assessment centre | Instance 0"]].apply(self.nan_to_tertiary, axis=1) #Apply nan_to_tertiary function
+    def cast_column(self, s, dtype):
+        '''
+        Casts a column to a dtype of the dtype schema
 
-        di = ['Date E10 first reported (insulin-dependent diabetes mellitus)',
-       'Date E11 first reported (non-insulin-dependent diabetes mellitus)',
-       'Date E12 first reported (malnutrition-related diabetes mellitus)',
-       'Date E13 first reported (other specified diabetes mellitus)',
-       'Date E14 first reported (unspecified diabetes mellitus)']
-        for i in di:
-            df[i+"_onehot"] = df[i].apply(self.nan_to_binary) #One hot encoding for various diabetes types
+        Parameters
+        ----------
+        s : pandas series object
+        dtype : String
+
+        Returns
+        -------
+        s : pandas series object
+        '''
+        if s.dtype.name == dtype:
+            return s
+        if dtype.startswith("datetime64"):
+            return self.parse_dates(s)
+        if dtype == "category":
+            return s.astype("category")
+        if s.dtype == object:
+            s = pd.to_numeric(s, errors="coerce")
+        if dtype == "bool" or dtype.startswith("int") or dtype.startswith("uint"):
+            if s.isnull().any():
+                return s.astype(np.float32)
+            if dtype == "bool":
+                return s.astype(bool) if s.isin([0, 1]).all() else s.astype(np.float32)
+            info = np.iinfo(dtype)
+            if len(s) and (s.min() < info.min or s.max() > info.max):
+                return s.astype(np.float32)
+        return s.astype(dtype)
+
+    def memory_report(self, df=None, deep=True):
+        '''
+        Returns the memory of the feature table per feature group (the stage which created the columns)
 
+        Parameters
+        ----------
+        df : pandas dataframe object
+            Defaults to self.df
+        deep : boolean
+            Include the memory of python objects (default is True)
 
-        df = df.drop(["Date of attending assessment centre | Instance 0"], axis=1)
-        return df
+        Returns
+        -------
+        report : pandas dataframe object
+        '''
+        if df is None:
+            df = self.df
+        memory = df.memory_usage(index=False, deep=deep)
+        report = pd.DataFrame({"group": [self.column_groups.get(c, "other") for c in df.columns],
+                               "columns": 1,
+                               "bytes": memory.values,
+                               "dtypes": [str(t) for t in df.dtypes]})
+        report = report.groupby("group", sort=False).agg({"columns": "sum", "bytes": "sum",
+                                                          "dtypes": lambda t: ", ".join(sorted(set(t)))})
+        report["share"] = report["bytes"] / report["bytes"].sum()
+        return report.sort_values("bytes", ascending=False)
     
-    def earliest_date(self, l):
+
+    def build_vocabularies(self, chunk_size=100000):
+        '''
+        Global first pass for sharded preprocessing: streams the one hot encoded columns and the comorbidity column
+        of the full source files and sets self.vocabularies and self.comorbidity_vocabulary
+
+        Parameters
+        ----------
+        chunk_size : integer
+            Rows per chunk (default is 100000)
         '''
-        Returns the earliest date when provided by multiple in a list
+        vocabularies = {}
+        for column, (path, transform) in self.vocabulary_sources.items():
+            values = set()
+            for chunk in pd.read_csv(path, usecols=[column], chunksize=chunk_size, **self.source_read_kwargs.get(path, {})):
+                values.update(chunk[column].dropna().unique())
+            values = pd.DataFrame({column: list(values)})
+            if transform != None:
+                values = transform(values)
+            vocabularies[column] = sorted(values[column].dropna().unique()) #get_dummies orders the categories
+        self.vocabularies = vocabularies
+
+        #Comorbidities in order of first occurence, as encode_comorbidities orders them
+        comorbidities = {}
+        column = 'Non-cancer illness code, self-reported | Instance 0'
+        for chunk in pd.read_csv(self.medical_conditions, usecols=[column], chunksize=chunk_size):
+            for i in pd.unique(chunk[column].str.split("|").explode().dropna()):
+                comorbidities.setdefault(i, None)
+        self.comorbidity_vocabulary = list(comorbidities)
+
+    def split_sources(self, shard_dir, n_shards, chunk_size=100000, id_source=None):
+        '''
+        Partitions every source file into n_shards working directories by Participant ID range
+
+        Parameters
+        ----------
+        shard_dir : String
+            Folder for the shard working directories
+        n_shards : integer
+            Number of shards
+        chunk_size : integer
+            Rows per chunk (default is 100000)
+        id_source : String
+            File of which the participant IDs define the ranges (default is the demographics file)
 
         Returns
         -------
-        l : list
-            List with datetime objects
+        wds : list
+            Working directory of every shard
+        '''
+        if id_source == None:
+            id_source = self.demographics
+        ids = np.sort(pd.read_csv(id_source, usecols=[0]).iloc[:, 0].to_numpy())
+        boundaries = ids[np.linspace(0, len(ids), n_shards+1)[1:-1].astype(int)] if len(ids) else np.array([])
+
+        wds = [os.path.join(shard_dir, "shard_%03d" % k) + os.sep for k in range(n_shards)]
+        self.partition_sources(wds, lambda ids: np.searchsorted(boundaries, ids, side="right"), chunk_size)
+        return wds
+
+    def partition_sources(self, wds, assign, chunk_size=100000):
+        '''
+        Streams every source file in chunks and writes its rows to the working directories chosen by assign.
+        Files are copied as text, so the partitions hold the same values as the original files. Lookup tables
+        without participant IDs and the preamble rows of shard_preamble_rows are copied to every directory
+
+        Parameters
+        ----------
+        wds : list
+            Working directories to write
+        assign : function
+            Maps an array of participant IDs to indices in wds, -1 drops the row
+        chunk_size : integer
+            Rows per chunk (default is 100000)
+        '''
+        paths = sorted(set(p for sources in self.stage_sources.values() for p in sources))
+        for path in paths:
+            relative = os.path.relpath(path, self.wd)
+            targets = [os.path.join(wd, relative) for wd in wds]
+            for target in targets:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+            kwargs = dict(self.source_read_kwargs.get(path, {}), dtype=str, keep_default_na=False)
+            header = pd.read_csv(path, nrows=0, **self.source_read_kwargs.get(path, {})).columns
+            if not re.search("Participant ID|eid", str(header[0])):
+                for target in targets:
+                    shutil.copyfile(path, target)
+                continue
+
+            preamble = self.shard_preamble_rows.get(path, 0)
+            written = [False]*len(wds)
+            for chunk in pd.read_csv(path, chunksize=chunk_size, **kwargs):
+                if preamble > 0:
+                    for k, target in enumerate(targets):
+                        chunk.iloc[:preamble].to_csv(target, index=False, sep=kwargs.get("sep", ","))
+                        written[k] = True
+                    chunk = chunk.iloc[preamble:]
+                    preamble = 0
+                shard = assign(pd.to_numeric(chunk.iloc[:, 0]).to_numpy())
+                for k in range(len(wds)):
+                    rows = chunk[shard == k]
+                    if len(rows) or not written[k]:
+                        rows.to_csv(targets[k], index=False, header=not written[k], mode="a" if written[k] else "w",
+                                    sep=kwargs.get("sep", ","))
+                        written[k] = True
+
+    def child(self, wd):
+        '''
+        Returns a dataPreprocessing object for another working directory with the settings, cache and
+        vocabularies of this one
+        '''
+        dp = dataPreprocessing(wd, use_cache=self.use_cache, sparse_comorbidities=self.sparse_comorbidities,
+                               n_jobs=self.n_jobs, csv_engine=self.csv_engine, compact_dtypes=self.compact_dtypes,
+                               family_history_targets=self.family_history_targets, profiler=self.profiler)
+        dp.cache = self.cache
+        dp.vocabularies = self.vocabularies
+        dp.comorbidity_vocabulary = self.comorbidity_vocabulary
+        return dp
+
+    def factory_sharded(self, output_dir, n_shards=8, shard_dir=None, chunk_size=100000, keep_shards=False):
+        '''
+        Out-of-core factory: partitions the participants by ID range, runs all stages on every shard and
+        writes one partition of the feature table per shard. Vocabularies of one hot encoded columns and
+        comorbidities are computed over the full files first, so every partition has identical columns
+
+        Parameters
+        ----------
+        output_dir : String
+            Folder for the partitions
+        n_shards : integer
+            Number of shards (default is 8)
+        shard_dir : String
+            Folder for the shard working directories (default is output_dir/shards)
+        chunk_size : integer
+            Rows per chunk when streaming the source files (default is 100000)
+        keep_shards : boolean
+            Keep the shard working directories (default is False)
 
         Returns
         -------
-        datetime object
-            Earliest date
+        partitions : list
+            Paths of the written partitions
         '''
-        l = l.dropna()
-        if len(l) == 0:
-            return pd.np.nan
-        elif len(l) == 1:
-            l = l[0].split("-")
-            try:
-                l = datetime.datetime(int(l[0]), int(l[1]), int(l[2]))
-                return l
-            except:
-                print("Varible not convertable to datetime: ", l)
-        else:
-            t = []
-            for i in l:
-                i = i.split("-")
-                try: 
-                    i = datetime.datetime(int(i[0]), int(i[1]), int(i[2]))
-                    t.append(i)
-                except:
-                    print("Varible not convertable to datetime: ", l)
-            return min(t)
-        
-    def nan_to_binary(self,i):
+        if shard_dir == None:
+            shard_dir = os.path.join(output_dir, "shards")
+        os.makedirs(output_dir, exist_ok=True)
+
+        print("SHARDED DATAPREPROCESSING INITIALIZED")
+        self.build_vocabularies(chunk_size)
+        wds = self.split_sources(shard_dir, n_shards, chunk_size)
+
+        partitions = []
+        for k, wd in enumerate(wds):
+            print("Shard %d/%d" % (k+1, n_shards))
+            dp = self.child(wd)
+            dp.factory()
+            self.column_groups = dp.column_groups
+            partitions.append(self.write_partition(dp.df, os.path.join(output_dir, "part-%03d" % k)))
+            del dp
+            if not keep_shards:
+                shutil.rmtree(wd)
+        print("SHARDED DATAPREPROCESSING DONE")
+        return partitions
+
+    def source_fingerprint(self, chunk_size=100000):
         '''
-        Convert a variable into binary on the existance of none object
+        Hashes every row of the source files per participant, used by factory_incremental to find
+        added and changed participants
 
         Parameters
-        -------
-        i : any variable
+        ----------
+        chunk_size : integer
+            Rows per chunk (default is 100000)
 
         Returns
         -------
-        integer
-            Binary encoding for nan
+        hashes : pandas dataframe object
+            Participant ID and row_hash, the combined hash of the rows of the participant in all source files
+        files : dict
+            Header of every file with participant IDs, content hash of the lookup tables
         '''
-        if pd.isnull(i):
-            return 0
-        return 1
-    
-    def nan_to_tertiary(self,l):
-        if pd.isnull(l[0]):
-            return 0
-        if pd.Timestamp(l[0]) < pd.Timestamp(l[1]):
-            return 1
-        return 2
-    
-    def labeling_asthma(self):
+        paths = sorted(set(p for sources in self.stage_sources.values() for p in sources))
+        files = {}
+        ids = []
+        row_hashes = []
+        for path in paths:
+            relative = os.path.relpath(path, self.wd)
+            header = pd.read_csv(path, nrows=0, **self.source_read_kwargs.get(path, {})).columns
+            if not re.search("Participant ID|eid", str(header[0])):
+                with open(path, "rb") as f:
+                    files[relative] = hashlib.sha1(f.read()).hexdigest()
+                continue
+            files[relative] = list(header)
+            salt = np.uint64(int(hashlib.sha1(relative.encode()).hexdigest()[:15], 16)) #Same row in another file hashes differently
+            preamble = self.shard_preamble_rows.get(path, 0)
+            kwargs = dict(self.source_read_kwargs.get(path, {}), dtype=str, keep_default_na=False)
+            for chunk in pd.read_csv(path, chunksize=chunk_size, **kwargs):
+                if preamble > 0:
+                    files[relative + " preamble"] = chunk.iloc[:preamble].values.tolist()
+                    chunk = chunk.iloc[preamble:]
+                    preamble = 0
+                ids.append(pd.to_numeric(chunk.iloc[:, 0]).to_numpy().astype(np.int64))
+                row_hashes.append(pd.util.hash_pandas_object(chunk, index=False).to_numpy() ^ salt)
+
+        #Combine the rows of a participant over the files
+        ids = np.concatenate(ids)
+        row_hashes = np.concatenate(row_hashes)
+        order = np.argsort(ids, kind="mergesort")
+        ids = ids[order]
+        row_hashes = row_hashes[order]
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        hashes = pd.DataFrame({"Participant ID": ids[starts], "row_hash": np.bitwise_xor.reduceat(row_hashes, starts)})
+        return hashes, files
+
+    def factory_incremental(self, store_dir, chunk_size=100000, subset_dir=None):
         '''
-        Returns dataframe with class labels for asthma
+        Incremental factory: compares the source files with the previous build in store_dir by Participant ID
+        and a hash of their rows, runs the stages only for added or changed participants and upserts them into
+        the stored feature table. Removed participants are deleted from it. Vocabularies are kept from the first
+        build so the columns stay stable, values unseen at that build are reported and not encoded. The table is
+        rebuilt completely when the code, the settings, a header or a lookup table changed
+
+        Parameters
+        ----------
+        store_dir : String
+            Folder with the feature table, row hashes and vocabularies of the previous build
+        chunk_size : integer
+            Rows per chunk when streaming the source files (default is 100000)
+        subset_dir : String
+            Working directory for the changed participants (default is store_dir/subset)
 
         Returns
         -------
         df : pandas dataframe object
+            Feature table, also stored in self.df, sorted on Participant ID
         '''
-        #Obtain first occurence for asthma 
-        df = pd.read_csv(self.first_occurence_asthma)
-        
-        #Obtain coding
-        coding819 = pd.read_csv(self.coding819, sep="\t")
-        self.coding = coding819["coding"].tolist()
-        self.meaning = coding819["meaning"].tolist()
-
-        #Delete with specific coding
-        df= df[df["Date J45 first reported (asthma)"].apply(self.delete_coding) ==1]
-        df= df[df["Date J46 first reported (status asthmaticus)"].apply(self.delete_coding) ==1]
-
-        #Earliest date for first occurence
-        df["all_asthma"] = df[["Date J45 first reported (asthma)", "Date J46 first reported (status asthmaticus)"]].apply(self.earliest_date, 1)
-        df["all_asthma_binary"] = df["all_asthma"].apply(self.nan_to_binary)
-
-        #Obtain assesment dates
-        df = df.merge(pd.read_csv(self.attendance)[["Participant ID", "Date of attending assessment centre | Instance 0",
-                                                     "Year of birth"]], on="Participant ID")
-        df['Date of attending assessment centre | Instance 0']= pd.to_datetime(df['Date of attending assessment centre | Instance 0'])
-        df["binary_assesment"] = df[["all_asthma", 'Date of attending assessment centre | Instance 0']].apply(self.binary_assesment, 1)
-
-        #Age of asthma diagnosis
-        df["age_asthma"] = df[["all_asthma", "Year of birth"]].apply(self.age_asthma, 1)
-
-        df = df.drop(["Date of attending assessment centre | Instance 0"], axis=1)
-        df = df.drop([ "Year of birth"], axis=1)
-
+        if subset_dir == None:
+            subset_dir = os.path.join(store_dir, "subset") + os.sep
+        os.makedirs(store_dir, exist_ok=True)
+        meta_file = os.path.join(store_dir, "meta.json")
+        hash_file = os.path.join(store_dir, "row_hashes.pkl")
+        options = {"sparse_comorbidities": self.sparse_comorbidities, "compact_dtypes": self.compact_dtypes}
+
+        print("INCREMENTAL DATAPREPROCESSING INITIALIZED")
+        meta = None
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            self.vocabularies = meta["vocabularies"]
+            self.comorbidity_vocabulary = meta["comorbidity_vocabulary"]
+        else:
+            self.build_vocabularies(chunk_size)
+        hashes, files = self.source_fingerprint(chunk_size)
+
+        rebuild = (meta == None or meta["code_version"] != self.code_version() or meta["options"] != options
+                   or meta["files"] != files or not os.path.exists(hash_file))
+        if rebuild:
+            print("Full build")
+            self.factory()
+            df = self.df
+        else:
+            previous = pd.read_pickle(hash_file)
+            current = pd.Series(hashes["row_hash"].to_numpy(), index=hashes["Participant ID"])
+            previous = pd.Series(previous["row_hash"].to_numpy(), index=previous["Participant ID"])
+            both = current.index.intersection(previous.index)
+            changed = current.index.difference(previous.index).append(both[current[both].to_numpy() != previous[both].to_numpy()])
+            removed = previous.index.difference(current.index)
+            print("Added or changed participants: %d, removed: %d" % (len(changed), len(removed)))
+
+            df = self.read_partitions([meta["table"]])
+            df = df[~df["Participant ID"].isin(changed) & ~df["Participant ID"].isin(removed)]
+            if len(changed):
+                self.report_unseen_vocabulary(changed.to_numpy(), chunk_size)
+                selected = set(changed.to_numpy().tolist())
+                self.partition_sources([subset_dir], lambda ids: np.where(pd.Series(ids).isin(selected), 0, -1), chunk_size)
+                subset = self.child(subset_dir)
+                subset.source_dtypes = self.subset_dtypes(subset, df)
+                subset.factory()
+                #Categories and integers of the subset can differ from the stored table
+                differ = [c for c in df.columns if subset.df[c].dtype != df[c].dtype and df[c].dtype != object]
+                df = pd.concat([df, subset.df.astype(df[differ].dtypes.to_dict())], ignore_index=True)
+                shutil.rmtree(subset_dir)
+        df = df.sort_values("Participant ID", kind="mergesort").reset_index(drop=True)
+
+        table = self.write_partition(df, os.path.join(store_dir, "features"))
+        hashes.to_pickle(hash_file)
+        with open(meta_file, "w") as f:
+            json.dump({"code_version": self.code_version(), "options": options, "files": files, "table": table,
+                       "vocabularies": self.vocabularies, "comorbidity_vocabulary": self.comorbidity_vocabulary}, f)
+        print("INCREMENTAL DATAPREPROCESSING DONE")
+        self.df = df
         return df
-    
-    def delete_coding(self, i):
-        if i in self.meaning:
-            return 0
-        return 1
-    
-    def binary_assesment(self, l):
-        if l[0] > l[1] and not pd.isnull(l[0]) and not pd.isnull(l[1]):
-            return 1
-        return 0
-    
-    def age_asthma(self, l):
-        try:
-            return l[0].year - l[1]
-        except:
-            return pd.np.nan
-        
-    def labeling_copd(self):
+
+    def subset_dtypes(self, subset, df):
         '''
-        Returns dataframe with class labels for copd
+        Returns the source_dtypes of a subset of the participants, source columns stored as text in the feature
+        table are read as text. A subset without text answers would otherwise parse such a column as numbers
+
+        Parameters
+        ----------
+        subset : dataPreprocessing object
+            Object of the subset working directory
+        df : pandas dataframe object
+            Stored feature table
 
         Returns
         -------
-        df : pandas dataframe object
+        dtypes : dict
+            Dtypes per source file and column
         '''
-        df = pd.read_csv(self.first_occurence_copd)
-
-        cols = [
-       'Date J40 first reported (bronchitis, not specified as acute or chronic)',
-       'Date J41 first reported (simple and mucopurulent chronic bronchitis)',
-       'Date J42 first reported (unspecified chronic bronchitis)',
-       'Date J43 first reported (emphysema)',
-       'Date J44 first reported (other chronic obstructive pulmonary disease)',
-       'Date J47 first reported (bronchiectasis)']
-        for i in cols:
-            df[i+"_binary"] = df[i].apply(self.nan_to_binary)
-        
-        cols_binary = [i+"_binary" for i in cols]
-        df["all_copd"] = df[cols_binary].apply(self.any_binary, 1)
-
-        coding819 = pd.read_csv(self.coding819, sep="\t")
-        self.coding = coding819["coding"].tolist()
-        self.meaning = coding819["meaning"].tolist()
-        for i in cols:
-            df = df[df[i].apply(self.delete_coding) ==1]
-
-        df["all_copd_date"] = df[cols].apply(self.earliest_date, 1)
+        text = set(df.columns[df.dtypes == object])
+        dtypes = {}
+        for path in set(p for sources in subset.stage_sources.values() for p in sources):
+            header = pd.read_csv(path, nrows=0, **subset.source_read_kwargs.get(path, {})).columns
+            dtypes[path] = dict({c: str for c in header if c in text}, **subset.source_dtypes.get(path, {}))
+        return dtypes
+
+    def report_unseen_vocabulary(self, ids, chunk_size=100000):
+        '''
+        Prints values of one hot encoded columns and comorbidities of the given participants which are not in
+        the stored vocabularies. These are not encoded, so the columns stay the same across incremental builds
 
-        return df
-    
-    def any_binary(self, l):
-        for i in l:
-            if i == 1:
-                return 1
-        return 0
-    
-    def labeling_osteoporosis(self):
+        Parameters
+        ----------
+        ids : array
+            Participant IDs
+        chunk_size : integer
+            Rows per chunk (default is 100000)
         '''
-        Returns dataframe with class labels for osteoporosis
+        ids = set(np.asarray(ids).tolist())
+        sources = dict(self.vocabulary_sources)
+        sources['Non-cancer illness code, self-reported | Instance 0'] = (self.medical_conditions, None)
+        for column, (path, transform) in sources.items():
+            values = set()
+            for chunk in pd.read_csv(path, chunksize=chunk_size, **self.source_read_kwargs.get(path, {})):
+                chunk = chunk[chunk.iloc[:, 0].isin(ids)]
+                if column == 'Non-cancer illness code, self-reported | Instance 0':
+                    values.update(chunk[column].str.split("|").explode().dropna().unique())
+                    continue
+                if transform != None:
+                    chunk = transform(chunk[[column]])
+                values.update(chunk[column].dropna().unique())
+            known = self.comorbidity_vocabulary if column == 'Non-cancer illness code, self-reported | Instance 0' else self.vocabularies[column]
+            unseen = sorted(values - set(known))
+            if unseen:
+                print("Values not in the vocabulary of %s, not encoded: %s" % (column, unseen[:10]))
+
+    def write_partition(self, df, name):
+        '''
+        Writes a partition as parquet, pickle when parquet is not available or the columns are not supported
+
+        Parameters
+        ----------
+        df : pandas dataframe object
+        name : String
+            Path without extension
 
         Returns
         -------
-        df : pandas dataframe object
+        path : String
         '''
-        df = pd.read_csv(self.first_occurence_osteoporosis)
-        att = pd.read_csv(self.attendance)
-        df = df.merge(att[['Participant ID', 'Year of birth']], on='Participant ID')
-
-        df["Date M80 first reported (osteoporosis with pathological fracture)_binary"] = df["Date M80 first reported (osteoporosis with pathological fracture)"].apply(self.nan_to_binary)
-        df["Date M81 first reported (osteoporosis without pathological fracture)_binary"] = df["Date M81 first reported (osteoporosis without pathological fracture)"].apply(self.nan_to_binary)
-        df["Date M82 first reported (osteoporosis in diseases classified elsewhere)_binary"] = df["Date M82 first reported (osteoporosis in diseases classified elsewhere)"].apply(self.nan_to_binary)
-    
-        df[ 'Date M80 first reported (osteoporosis with pathological fracture)_year'] = pd.DatetimeIndex(df['Date M80 first reported (osteoporosis with pathological fracture)']).year
-        df[ 'Date M81 first reported (osteoporosis without pathological fracture)_year'] = pd.DatetimeIndex(df['Date M81 first reported (osteoporosis without pathological fracture)']).year
-        df[ 'Date M82 first reported (osteoporosis in diseases classified elsewhere)_year'] = pd.DatetimeIndex(df['Date M82 first reported (osteoporosis in diseases classified elsewhere)']).year
-
-        df["Date M80 first reported (osteoporosis with pathological fracture)_age"] = df[['Year of birth', 'Date M80 first reported (osteoporosis with pathological fracture)_year']].apply(self.age_osteo, axis=1)
-        df["Date M81 first reported (osteoporosis without pathological fracture)_age"] = df[['Year of birth', 'Date M80 first reported (osteoporosis with pathological fracture)_year']].apply(self.age_osteo, axis=1)
-        df["Date M82 first reported (osteoporosis in diseases classified elsewhere)_age"] = df[['Year of birth', 'Date M80 first reported (osteoporosis with pathological fracture)_year']].apply(self.age_osteo, axis=1)
-        #TODO: Add all_osteo column
-        df = df.drop(['Year of birth'], axis=1)
-        return df
-    
-    def age_osteo(self, l):
-        return l[1]-l[0]
-    
-    def labeling_cvd(self):
+        try:
+            df.to_parquet(name + ".parquet", index=False)
+            return name + ".parquet"
+        except Exception:
+            if os.path.exists(name + ".parquet"):
+                os.remove(name + ".parquet")
+            df.to_pickle(name + ".pkl")
+            return name + ".pkl"
+
+    def read_partitions(self, partitions):
         '''
-        Returns dataframe with class labels for cvd
+        Reads the partitions written by factory_sharded into one dataframe, missing strings are NaN as in factory
+
+        Parameters
+        ----------
+        partitions : list
+            Paths of the partitions
 
         Returns
         -------
         df : pandas dataframe object
         '''
-        cvd = pd.read_csv(self.first_occurence_cvd, low_memory=False)
-        cvd_columns = cvd.columns.tolist()
-        cvd_columns.remove("Participant ID")
-        att = pd.read_csv(self.attendance)
-        att['Date of attending assessment centre | Instance 0'] = pd.to_datetime(att['Date of attending assessment centre | Instance 0'])
-        cvd = cvd.merge(att[["Participant ID", 'Date of attending assessment centre | Instance 0']], on="Participant ID")
+        frames = [pd.read_parquet(p) if p.endswith(".parquet") else pd.read_pickle(p) for p in partitions]
+        df = pd.concat(frames, ignore_index=True)
+        #parquet returns None for missing strings
+        for c in df.columns[df.dtypes == object]:
+            df[c] = df[c].where(df[c].notnull(), np.nan)
+        return df
 
-        for c in cvd_columns:
-            cvd[c+"_binary"] = cvd[c].apply(self.nan_to_binary)
 
-        for c in cvd_columns:
-            cvd[c] = cvd[c].replace("Code has event date matching participant's date of birth", pd.np.nan)
-            cvd[c] = cvd[c].replace("Code has event date after participant's date of birth and falls in the same calendar year as date of birth", pd.np.nan)
-            cvd[c] = pd.to_datetime(cvd[c])
-            cvd[c+'diff_days'] = (cvd[c] - cvd['Date of attending assessment centre | Instance 0']) / np.timedelta64(1, 'D')
-        cvd = cvd.drop(['Date of attending assessment centre | Instance 0'], axis=1)
-        return cvd
-    
-    def factory(self):
-        #Data
-        print("DATAPREPROCESSING INITIALIZED")
-        print("0/19")
-        df = self.pre_demographics_basic()
-        print("1/19")
-        df = df.merge(self.pre_demographics_ethnicity() ,on="Participant ID")
-        print("2/19")
-        df = self.pre_blood_biomarker(dem_basic=df) 
-        print("3/19")
-        df = df.merge(self.pre_alcohol() ,on="Participant ID") 
-        print("4/19")
-        df = df.merge(self.pre_bodymeasures() ,on="Participant ID")
-        print("5/19")
-        df = df.merge(self.pre_blood_pressure() ,on="Participant ID")
-        print("6/19")
-        df = df.merge(self.pre_family_history() ,on="Participant ID")
-        print("7/19")
-        df = df.merge(self.pre_medical_conditions() ,on="Participant ID")
-        print("9/19")
-        df = df.merge(self.pre_sleep() ,on="Participant ID")
-        print("10/19")
-        df = df.merge(self.pre_smoking() ,on="Participant ID")
-        print("11/19")
-        df = df.merge(self.pre_urine_biomarkers() ,on="Participant ID")
-        print("12/19")
-        df = df.merge(self.pre_physical_activity() ,on="Participant ID")
-        print("13/19")
-        df = df.merge(self.pre_white_bloodcell() ,on="Participant ID")
-        print("14/19")
-        df = df.merge(self.pre_smoking_supplementary() ,on="Participant ID")
-        print("15/19")
-        df = df.merge(self.pre_symptomes() ,on="Participant ID")
-        df = df.merge(self.pre_attendance(),on="Participant ID")
-
-        #Labels
-        df = df.merge(self.labeling_diabetes() ,on="Participant ID")
-        print("16/19")
-        df = df.merge(self.labeling_copd() ,on="Participant ID")
-        print("17/19")
-        df = df.merge(self.labeling_asthma() ,on="Participant ID")
-        print("18/19")
-        df = df.merge(self.labeling_osteoporosis() ,on="Participant ID")
-        df = df.merge(self.labeling_cvd(), on="Participant ID")
-        print("19/19 \nDATAPREPROCESSING DONE")
-        
-        self.df = df
-    
+instrument(dataPreprocessing, "^(pre|labeling)_")
 
 
 class ClusterWrapper():
@@ -1011,13 +2948,488 @@ class LRWrapper():
         self.scaler = scaler
         self.label_column = label_column
         self.data_columns = data_columns
-     
-        
+
+
+class modelSpec():
+    '''
+    Declaration of a model in the registry of modelConstruction
+    '''
+    def __init__(self, name, disease, cohorts, estimator, features, extra_features=[], label=None, window=None,
+                 window_column=None, cluster=None, cluster_model=None, evaluation_name=None):
+        '''
+        Parameters
+        ----------
+        name : String
+            Name of the model, also the attribute of modelConstruction holding its wrapper
+        disease : String
+            Key of modelConstruction.model_requirements
+        cohorts : list
+            Cohorts the controller trains the model on: combined, men or women
+        estimator : String
+            kmeans, random_forest or logistic_regression
+        features : String
+            Key of modelConstruction.feature_columns
+        extra_features : list
+            Columns used next to the feature list (default is [])
+        label : String
+            Label column (default is None)
+        window : tuple
+            Minimum and maximum days between attendance and first occurence of the positive class (default is None)
+        window_column : String
+            Column with the days of window, diabetes computes them (default is None)
+        cluster : integer
+            Cluster of the diabetes cases the model is trained on (default is None)
+        cluster_model : String
+            Name of the cluster model (default is None)
+        evaluation_name : String
+            Prefix of the prediction columns, {sex} is replaced by the cohort (default is None)
+        '''
+        self.name = name
+        self.disease = disease
+        self.cohorts = cohorts
+        self.estimator = estimator
+        self.features = features
+        self.extra_features = extra_features
+        self.label = label
+        self.window = window
+        self.window_column = window_column
+        self.cluster = cluster
+        self.cluster_model = cluster_model
+        self.evaluation_name = evaluation_name
+
+
+def diabetes_model_specs():
+    '''
+    Returns the specs of the diabetes models: per timescale a kmeans model on the NIDDM cases and a random forest
+    per cluster, trained against the healthy participants
+    '''
+    specs = []
+    x = 1
+    for window, rf, min_days, max_days in [("one", "rfmodel", 0, 365), ("five", "rfmodel", 0, 1825),
+                                           ("fiveten", "rfmodel", 1825, 3650), ("ten", "rfrmodel", 3650, 99999999)]:
+        cluster_model = "niddm_na_%s_lada_clustermodel" % window
+        specs.append(modelSpec(cluster_model, "diabetes", ["men", "women"], "kmeans", "diabetes_question",
+                               window=(min_days, max_days), window_column="diff_days"))
+        for cluster, number in enumerate(["one", "two", "three", "four"]):
+            specs.append(modelSpec("niddm_na_%s_lada_%s_%s" % (window, rf, number), "diabetes", ["men", "women"], "random_forest",
+                                   "diabetes_question", extra_features=['Glycated haemoglobin (HbA1c) | Instance 0'],
+                                   label='Date E11 first reported (non-insulin-dependent diabetes mellitus)_onehot',
+                                   window=(min_days, max_days), window_column="diff_days", cluster=cluster, cluster_model=cluster_model,
+                                   evaluation_name="%d_Diabetes_{sex}_%d_%d_%d" % (x, min_days, max_days, cluster)))
+            x += 1
+    return specs
+
+
+class cohortStore():
+    '''
+    Memoizes the cohorts modelConstruction trains and evaluates on. A key starts with the set the cohort is taken
+    from, train or test, followed by the cohort filter and columns. Scaled columns of a cohort are kept as float32
+    matrices by key, columns and scaler, so models and evaluations asking for the same slice share one matrix.
+    The cohorts of a set stay until they are evicted
+    '''
+
+    def __init__(self):
+        self.cohorts = {}
+        self.matrices = {}
+        self.hits = 0
+        self.misses = 0
+
+    def cohort(self, key, build):
+        '''
+        Returns the cohort of key, build is called on first use
+
+        Parameters
+        ----------
+        key : tuple
+            Set, cohort filter and columns of the cohort
+        build : function
+            Returns the cohort
+        '''
+        if key in self.cohorts:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.cohorts[key] = build()
+        return self.cohorts[key]
+
+    def matrix(self, key, columns, scaler="minmax"):
+        '''
+        Returns columns of the cohort of key as float32 matrix, the cohort has to be built by cohort first
+
+        Parameters
+        ----------
+        key : tuple
+            Key of the cohort
+        columns : list
+            Columns of the matrix
+        scaler : String or scaler object
+            minmax fits a MinMaxScaler on the cohort, None leaves the values unscaled, a fitted scaler is
+            applied (default is minmax)
+
+        Returns
+        -------
+        matrix : numpy array
+        scaler : scaler object
+        '''
+        mkey = (key, tuple(columns), scaler)
+        if mkey in self.matrices:
+            self.hits += 1
+        else:
+            self.misses += 1
+            values = self.cohorts[key][columns]
+            if isinstance(scaler, str):
+                scaler = MinMaxScaler().fit(values)
+            matrix = values.to_numpy(dtype=np.float32) if scaler == None else scaler.transform(values).astype(np.float32)
+            self.matrices[mkey] = (matrix, scaler)
+        return self.matrices[mkey]
+
+    def evict(self, subset=None):
+        '''
+        Removes the cohorts and matrices taken from subset, train or test (default is None, all)
+        '''
+        for key in [k for k in self.cohorts if subset == None or k[0] == subset]:
+            del self.cohorts[key]
+        for key in [k for k in self.matrices if subset == None or k[0][0] == subset]:
+            del self.matrices[key]
+
+
 class modelConstruction():
 
-    def __init__(self, df, test, train, evaluation_folder, dp, sex="", boxplot_eval=False, results=pd.DataFrame()):
+    #Feature columns of the models, the modeling methods and model_requirements read them from here
+    feature_columns = {
+        "diabetes_question": [
+            'Age at recruitment',
+            'Sex',
+            'Asian',
+            'Black',
+            'Chinese',
+            'Mixed',
+            'Other',
+            'White',
+            'Alcohol intake frequency. | Instance 0_Daily or almost daily',
+            'Alcohol intake frequency. | Instance 0_Never',
+            'Alcohol intake frequency. | Instance 0_Once or twice a week',
+            'Alcohol intake frequency. | Instance 0_One to three times a month',
+            'Alcohol intake frequency. | Instance 0_Special occasions only',
+            'Alcohol intake frequency. | Instance 0_Three or four times a week',
+            'fmi',
+            'Body mass index (BMI) | Instance 0',
+            'Body fat percentage | Instance 0',
+            'Waist circumference | Instance 0',
+            'Weight | Instance 0',
+            'Hip circumference | Instance 0',
+            'Whole body fat mass | Instance 0',
+            'Basal metabolic rate | Instance 0',
+            'Trunk fat percentage | Instance 0',
+            'Arm fat percentage (left) | Instance 0',
+            'Leg fat percentage (left) | Instance 0',
+            'Diastolic blood pressure',
+            'Systolic blood pressure',
+            'Illnesses of father',
+            'Illnesses of mother',
+            'Illnesses of siblings',
+            'Cholesterol_lowering_medication',
+            'Insulin',
+            'Blood_pressure',
+            'Sleep duration | Instance 0',
+            'Tobacco smoking_Ex-smoker',
+            'Tobacco smoking_Never smoked',
+            'Tobacco smoking_Occasionally',
+            'Tobacco smoking_Smokes on most or all days',
+            'Summed MET minutes per week for all activity | Instance 0',
+            'Summed minutes activity | Instance 0'
+        ],
+        "chronic_bronchitis_current": [
+            'Age at recruitment',
+            'Pack years adult smoking as proportion of life span exposed to smoking',
+            'Brisk pace',
+            'Steady average pace',
+            'Number of cigarettes previously smoked daily',
+            'hayfever/allergic rhinitis',
+            'Age started smoking in former smokers',
+            'allergy or anaphylactic reaction to food',
+            'Pack years of smoking',
+            'Neutrophill count | Instance 0'
+        ],
+        "emphysema_current": [
+            'Pack years adult smoking as proportion of life span exposed to smoking',
+            'Age at recruitment',
+            'Number of cigarettes previously smoked daily',
+            'Brisk pace',
+            'Body mass index (BMI) | Instance 0',
+            'chronic sinusitis',
+            'Steady average pace',
+            'Neutrophill count | Instance 0',
+            'Pack years of smoking',
+            'Hayfever_allergic_rhinitis_eczema_doctor'
+        ],
+        "other_copd_current": [
+            'Age at recruitment',
+            'Brisk pace',
+            'Pack years adult smoking as proportion of life span exposed to smoking',
+            'Steady average pace',
+            'Number of cigarettes previously smoked daily',
+            'Pack years of smoking',
+            'Neutrophill count | Instance 0',
+            'Doctor diagnosed asthma',
+            'Eosinophill count | Instance 0',
+            'Summed MET minutes per week for all activity | Instance 0'
+        ],
+        "emphysema_past": [
+            'Number of cigarettes currently smoked daily (current cigarette smokers)',
+            'Age at recruitment',
+            'Pack years of smoking',
+            'Age started smoking in current smokers',
+            'Body mass index (BMI) | Instance 0',
+            'Brisk pace',
+            'Steady average pace',
+            'Pack years adult smoking as proportion of life span exposed to smoking',
+            'Cholesterol | Instance 0',
+            'Haemoglobin concentration | Instance 0'
+        ],
+        "other_copd_past": [
+            'Number of cigarettes currently smoked daily (current cigarette smokers)',
+            'Age at recruitment',
+            'Brisk pace',
+            'Pack years adult smoking as proportion of life span exposed to smoking',
+            'Age started smoking in current smokers',
+            'Steady average pace',
+            'Body mass index (BMI) | Instance 0',
+            'Cholesterol | Instance 0',
+            'asbestosis',
+            'Haemoglobin concentration | Instance 0'
+        ],
+        "cvd_heart_failure": [
+            'Hip circumference | Instance 0',
+            'heart attack/myocardial infarction',
+            'bronchitis',
+            'nasal/sinus disorder',
+            'fmi',
+            'osteoarthritis',
+            'Age at recruitment',
+            'Body mass index (BMI) | Instance 0',
+            'fracture upper arm / humerus / elbow',
+            'rheumatic fever'
+        ],
+        "cvd_ischaemic": [
+            "heart attack/myocardial infarction",
+            "angina",
+            "Age at recruitment",
+            "Basal metabolic rate | Instance 0",
+            "ovarian cyst or cysts",
+            "Pack years adult smoking as proportion of life span exposed to smoking",
+            "essential hypertension",
+            "Pack years of smoking",
+            "Slow pace",
+            "hepatitis c"
+        ],
+        "osteoporosis_men": [
+            'hayfever/allergic rhinitis',
+            'eczema/dermatitis',
+            'pneumonia',
+            'Hayfever_allergic_rhinitis_eczema_doctor',
+            'Brisk pace', 'Slow pace',
+            'Steady average pace',
+            'Wheeze or whistling in the chest in last year | Instance 0_No',
+            'hypertension', 'heart attack/myocardial infarction',
+            'diabetes', 'high cholesterol', 'angina', 'asthma',
+            'osteoarthritis', 'enlarged prostate', 'hiatus hernia',
+            #'unclassifiable',
+            'depression', 'ulcerative colitis',
+            'emphysema/chronic bronchitis', 'stroke',
+            'cataract', 'back problem', 'rheumatoid arthritis', 'epilepsy'
+        ],
+        "osteoporosis_women": [
+            'hayfever/allergic rhinitis', 'chronic sinusitis',
+            'pneumonia', 'Hayfever_allergic_rhinitis_eczema_doctor',
+            'Brisk pace', 'Slow pace', 'Steady average pace',
+            'Wheeze or whistling in the chest in last year | Instance 0_No',
+            'hypertension', 'hypothyroidism/myxoedema', 'peritonitis', 'duodenal ulcer',
+            'heart attack/myocardial infarction', 'diabetes', 'high cholesterol',
+            'fracture lower leg / ankle', 'angina', 'anxiety/panic attacks',
+            'asthma', 'osteoarthritis', 'kidney stone/ureter stone/bladder stone',
+            'cholelithiasis/gall stones', 'chronic fatigue syndrome', 'psoriasis',
+            'hiatus hernia', 'heart valve problem/heart murmur', 'multiple sclerosis',
+            #'unclassifiable',
+            'allergy or anaphylactic reaction to drug', 'urinary frequency / incontinence',
+            'spine arthritis/spondylitis', 'depression', 'glaucoma', 'other renal/kidney problem',
+            'ulcerative colitis', 'ear/vestibular disorder', 'irritable bowel syndrome',
+            'colitis/not crohns or ulcerative colitis', 'emphysema/chronic bronchitis',
+            'diverticular disease/diverticulitis', 'hyperthyroidism/thyrotoxicosis',
+            'malabsorption/coeliac disease', 'stroke', 'cervical spondylosis',
+            'cataract',  'prolapsed disc/slipped disc',
+            'oesophagitis/barretts oesophagus', 'pleurisy', 'urinary tract infection/kidney infection',
+            'vaginal prolapse/uterine prolapse', 'back problem', 'essential hypertension',
+            'muscle/soft tissue problem', 'crohns disease', 'anaemia', 'ovarian cyst or cysts',
+            'chronic obstructive airways disease/copd', 'heart arrhythmia', 'rheumatoid arthritis',
+            'epilepsy', 'meningitis', 'other neurological problem', 'hepatitis', 'bone disorder',
+            'gestational hypertension/pre-eclampsia', "meniere's disease", 'appendicitis',
+            'benign breast lump', 'dry eyes', 'atrial fibrillation', 'polymyalgia rheumatica',
+            'gastric/stomach ulcers', 'osteopenia', 'rectal or colon adenoma/polyps',
+            'helicobacter pylori', 'eye/eyelid problem', 'parkinsons disease', 'joint disorder',
+            'varicose veins', 'fracture wrist / colles fracture', 'rheumatic fever',
+            'systemic lupus erythematosis/sle', 'pernicious anaemia', "sjogren's syndrome/sicca syndrome"
+        ],
+        "asthma_men": [
+            'hayfever/allergic rhinitis',
+            'pneumonia',
+            'Hayfever_allergic_rhinitis_eczema_doctor',
+            'Brisk pace',
+            'Slow pace',
+            'Wheeze or whistling in the chest in last year | Instance 0_No',
+            'hypertension',
+            'hypothyroidism/myxoedema',
+            'heart attack/myocardial infarction',
+            'diabetes',
+            'high cholesterol',
+            'angina',
+            'osteoarthritis',
+            'gout',
+            'enlarged prostate',
+            'hiatus hernia',
+            'depression',
+            'irritable bowel syndrome',
+            'emphysema/chronic bronchitis',
+            'stroke',
+            'cataract',
+            'prolapsed disc/slipped disc',
+            'back problem',
+            'eczema/dermatitis'
+        ],
+        "asthma_women": [
+            'hayfever/allergic rhinitis',
+            'pneumonia',
+            'Hayfever_allergic_rhinitis_eczema_doctor',
+            'Brisk pace',
+            'Slow pace',
+            'Steady average pace',
+            'Wheeze or whistling in the chest in last year | Instance 0_No',
+            'hypertension',
+            'hypothyroidism/myxoedema',
+            'heart attack/myocardial infarction',
+            'diabetes',
+            'high cholesterol',
+            'angina',
+            'anxiety/panic attacks',
+            'osteoarthritis',
+            'cholelithiasis/gall stones',
+            'psoriasis',
+            'hiatus hernia',
+            'migraine',
+            'allergy or anaphylactic reaction to drug',
+            'spine arthritis/spondylitis',
+            'depression',
+            'glaucoma',
+            'sciatica',
+            'allergy/hypersensitivity/anaphylaxis',
+            'irritable bowel syndrome',
+            'emphysema/chronic bronchitis',
+            'diverticular disease/diverticulitis',
+            'hyperthyroidism/thyrotoxicosis',
+            'stroke',
+            'cervical spondylosis',
+            'cataract',
+            'osteoporosis',
+            'prolapsed disc/slipped disc',
+            'endometriosis',
+            'vaginal prolapse/uterine prolapse',
+            'back problem',
+            'muscle/soft tissue problem',
+            'anaemia',
+            'eczema/dermatitis',
+            'rheumatoid arthritis',
+            'joint disorder'
+        ]
+    }
+
+    #Feature lists and further columns (labels, dates, selection criteria) used by the modeling of each disease
+    model_requirements = {
+        "copd": (["chronic_bronchitis_current", "emphysema_current", "other_copd_current", "emphysema_past", "other_copd_past"],
+                 ['Date J42 first reported (unspecified chronic bronchitis)_binary',
+                  'Date J43 first reported (emphysema)_binary',
+                  'Date J44 first reported (other chronic obstructive pulmonary disease)_binary']),
+        "cvd": (["cvd_heart_failure", "cvd_ischaemic"],
+                ['Date I50 first reported (heart failure)_binary',
+                 'Date I50 first reported (heart failure)diff_days',
+                 'Date I25 first reported (chronic ischaemic heart disease)_binary',
+                 'Date I25 first reported (chronic ischaemic heart disease)diff_days']),
+        "diabetes": (["diabetes_question"],
+                     ['Date E11 first reported (non-insulin-dependent diabetes mellitus)_onehot',
+                      'Date E11 first reported (non-insulin-dependent diabetes mellitus)',
+                      'first_occurence_diabetes_binary',
+                      'Glycated haemoglobin (HbA1c) | Instance 0',
+                      'Date of attending assessment centre | Instance 0',
+                      'Age at recruitment',
+                      'Body mass index (BMI) | Instance 0']),
+        "osteoporosis": (["osteoporosis_men", "osteoporosis_women"],
+                         ['Standing height | Instance 0',
+                          'Date M81 first reported (osteoporosis without pathological fracture)_binary']),
+        "asthma": (["asthma_men", "asthma_women"],
+                   ['Pack years of smoking',
+                    'all_asthma_binary',
+                    'Standing height | Instance 0'])
+    }
+
+    #Models trained and evaluated by train_models and evaluate_models, in this order. Class balancing draws from
+    #the global random state, so the order fixes the fitted models for a seed
+    model_registry = diabetes_model_specs() + [
+        modelSpec("chronic_bronchitis_model_current", "copd", ["combined"], "logistic_regression", "chronic_bronchitis_current",
+                  label='Date J42 first reported (unspecified chronic bronchitis)_binary',
+                  evaluation_name='Date J42 first reported (unspecified chronic bronchitis)_binary_current'),
+        modelSpec("emphysema_model_current", "copd", ["combined"], "logistic_regression", "emphysema_current",
+                  label='Date J43 first reported (emphysema)_binary',
+                  evaluation_name='Date J43 first reported (emphysema)_binary_current'),
+        modelSpec("other_copd_model_current", "copd", ["combined"], "logistic_regression", "other_copd_current",
+                  label='Date J44 first reported (other chronic obstructive pulmonary disease)_binary',
+                  evaluation_name='Date J44 first reported (other chronic obstructive pulmonary disease)_binary_current'),
+        modelSpec("emphysema_model_past", "copd", ["combined"], "logistic_regression", "emphysema_past",
+                  label='Date J43 first reported (emphysema)_binary',
+                  evaluation_name='Date J43 first reported (emphysema)_binary_past'),
+        modelSpec("other_copd_model_past", "copd", ["combined"], "logistic_regression", "other_copd_past",
+                  label='Date J44 first reported (other chronic obstructive pulmonary disease)_binary',
+                  evaluation_name='Date J44 first reported (other chronic obstructive pulmonary disease)_binary_past'),
+        modelSpec("cvd_hf_model", "cvd", ["combined"], "logistic_regression", "cvd_heart_failure",
+                  label='Date I50 first reported (heart failure)_binary', window=(0, 5*365),
+                  window_column='Date I50 first reported (heart failure)diff_days',
+                  evaluation_name='Date I50 first reported (heart failure)'),
+        modelSpec("cvd_isch_model", "cvd", ["combined"], "logistic_regression", "cvd_ischaemic",
+                  label="Date I25 first reported (chronic ischaemic heart disease)_binary", window=(0, 5*365),
+                  window_column='Date I25 first reported (chronic ischaemic heart disease)diff_days',
+                  evaluation_name='Date I25 first reported (chronic ischaemic heart disease)')
+    ]
+
+    #First occurence and attendance date of the diabetes windows
+    diabetes_dates = ('Date E11 first reported (non-insulin-dependent diabetes mellitus)', 'Date of attending assessment centre | Instance 0')
+
+    @classmethod
+    def required_columns(cls, diseases=None):
+        '''
+        Collects the columns the modeling of the diseases uses, to build only these with dataPreprocessing.factory
+
+        Parameters
+        ----------
+        diseases : list
+            Keys of model_requirements (default is None, all diseases)
+
+        Returns
+        -------
+        columns : list
+            Unique columns in order of first use
+        '''
+        if diseases == None:
+            diseases = list(cls.model_requirements)
+        columns = ["Participant ID", "Sex"]
+        for disease in diseases:
+            features, extra = cls.model_requirements[disease]
+            for c in [c for key in features for c in cls.feature_columns[key]] + extra:
+                if c not in columns:
+                    columns.append(c)
+        return columns
+
+    def __init__(self, df, test, train, evaluation_folder, dp, sex="", boxplot_eval=False, results=pd.DataFrame(), n_jobs=1, rf_n_jobs=None):
         '''
-        Is dependent on dataPreprocessing
+        Is dependent on dataPreprocessing. n_jobs is the number of cores for training the random forests,
+        rf_n_jobs the n_jobs of each random forest
         '''
         #Obtain data
         self.df = df
@@ -1026,43 +3438,28 @@ class modelConstruction():
         self.train = self.train.reset_index() 
         self.evaluation_folder = evaluation_folder
         self.dp = dp 
+        self.profiler = dp.profiler
         self.sex = sex
         self.boxplot_eval = boxplot_eval
         self.results = results
+        self.n_jobs = n_jobs
+        self.rf_n_jobs = rf_n_jobs
+        self.cohort_store = cohortStore()
+
+        #Wrappers of the registry, also set as attribute by name
+        self.models = {}
+        for spec in self.model_registry:
+            if spec.estimator == "kmeans":
+                self.models[spec.name] = ClusterWrapper(None, None)
+            elif spec.estimator == "random_forest":
+                self.models[spec.name] = RFWrapper(None, None, spec.window[0], spec.window[1])
+            else:
+                self.models[spec.name] = LRWrapper(None, None, spec.label, self.spec_columns(spec))
+            setattr(self, spec.name, self.models[spec.name])
 
-        #Diabetes models
-        self.niddm_na_one_lada_clustermodel = ClusterWrapper(None, None)
-        self.niddm_na_five_lada_clustermodel = ClusterWrapper(None, None)
-        self.niddm_na_fiveten_lada_clustermodel = ClusterWrapper(None, None)
-        self.niddm_na_ten_lada_clustermodel = ClusterWrapper(None, None)
-        self.niddm_na_one_lada_rfmodel_one = RFWrapper(None, None, 0, 365)
-        self.niddm_na_one_lada_rfmodel_two = RFWrapper(None, None, 0, 365)
-        self.niddm_na_one_lada_rfmodel_three = RFWrapper(None, None, 0, 365)
-        self.niddm_na_one_lada_rfmodel_four = RFWrapper(None, None, 0, 365)
-        self.niddm_na_five_lada_rfmodel_one = RFWrapper(None, None, 0, 1825)
-        self.niddm_na_five_lada_rfmodel_two = RFWrapper(None, None, 0, 1825)
-        self.niddm_na_five_lada_rfmodel_three = RFWrapper(None, None, 0, 1825)
-        self.niddm_na_five_lada_rfmodel_four = RFWrapper(None, None, 0, 1825)
-        self.niddm_na_fiveten_lada_rfmodel_one = RFWrapper(None, None, 1825, 3650)
-        self.niddm_na_fiveten_lada_rfmodel_two = RFWrapper(None, None, 1825, 3650)
-        self.niddm_na_fiveten_lada_rfmodel_three = RFWrapper(None, None, 1825, 3650)
-        self.niddm_na_fiveten_lada_rfmodel_four = RFWrapper(None, None, 1825, 3650)
-        self.niddm_na_ten_lada_rfrmodel_one = RFWrapper(None, None, 3650, 99999999)
-        self.niddm_na_ten_lada_rfrmodel_two = RFWrapper(None, None, 3650, 99999999)
-        self.niddm_na_ten_lada_rfrmodel_three = RFWrapper(None, None, 3650, 99999999)
-        self.niddm_na_ten_lada_rfrmodel_four = RFWrapper(None, None, 3650, 99999999)
-        
         self.diabetes_data_columns = None
         self.diabetes_question_columns = None
 
-        #COPD models
-        self.emphysema_model_current = LRWrapper(None, None, None, None)
-        self.chronic_bronchitis_model_current = LRWrapper(None, None, None, None)
-        self.other_copd_model_current = LRWrapper(None, None, None, None)
-
-        self.emphysema_model_past = LRWrapper(None, None, None, None)
-        self.other_copd_model_past = LRWrapper(None, None, None, None)
-
         self.copd_data_columns = None
         self.copd_cluster_columns = None
 
@@ -1072,176 +3469,235 @@ class modelConstruction():
         self.intercept_osteo = None
         self.binary_columns_osteo = None
 
-        self.nb_osteo = NBWrapper(None)
-
-        #Asthma
-        self.binary_columns_asthma = None
-        self.slope_asthma = None
-        self.intercept_asthma = None
-
-        self.nb_atshma = NBWrapper(None)
-
-        #CVD
-        self.cvd_hf_model = LRWrapper(None, None, None, None)
-        self.cvd_isch_model = LRWrapper(None, None, None, None)
-
-    def diabetes_modeling(self):
-        '''
-        Diabetes model construction
-        '''
-        #Dataprep
-        niddm = self.train[(self.train['Date E11 first reported (non-insulin-dependent diabetes mellitus)_onehot'] == 1)]
-        healthy = self.train[(self.train['first_occurence_diabetes_binary'] == 0) & (self.train['Glycated haemoglobin (HbA1c) | Instance 0'] < 48)]
-        question = [
-                'Age at recruitment',
-                'Sex',
-                'Asian',
-                'Black',
-                'Chinese',
-                'Mixed',
-                'Other',
-                'White',
-                'Alcohol intake frequency. | Instance 0_Daily or almost daily',
-                'Alcohol intake frequency. | Instance 0_Never',
-                'Alcohol intake frequency. | Instance 0_Once or twice a week',
-                'Alcohol intake frequency. | Instance 0_One to three times a month',
-                'Alcohol intake frequency. | Instance 0_Special occasions only',
-                'Alcohol intake frequency. | Instance 0_Three or four times a week',
-                'fmi',
-                'Body mass index (BMI) | Instance 0',
-                'Body fat percentage | Instance 0',
-                'Waist circumference | Instance 0',
-                'Weight | Instance 0',
-                'Hip circumference | Instance 0',
-                'Whole body fat mass | Instance 0',
-                'Basal metabolic rate | Instance 0',
-                'Trunk fat percentage | Instance 0',
-                'Arm fat percentage (left) | Instance 0',
-                'Leg fat percentage (left) | Instance 0',
-                'Diastolic blood pressure',
-                'Systolic blood pressure',
-                'Illnesses of father',
-                'Illnesses of mother',
-                'Illnesses of siblings',
-                'Cholesterol_lowering_medication',
-                'Insulin',
-                'Blood_pressure',
-                'Sleep duration | Instance 0',
-                'Tobacco smoking_Ex-smoker',
-                'Tobacco smoking_Never smoked',
-                'Tobacco smoking_Occasionally',
-                'Tobacco smoking_Smokes on most or all days',
-                'Summed MET minutes per week for all activity | Instance 0',
-                'Summed minutes activity | Instance 0'
-                ]
-        
-        self.diabetes_question_columns = question
-        cols_both = question+['Glycated haemoglobin (HbA1c) | Instance 0']
-        cols = question+['Glycated haemoglobin (HbA1c) | Instance 0','first_occurence_diabetes_binary', 
-                         'Date E11 first reported (non-insulin-dependent diabetes mellitus)',
-                         'Date of attending assessment centre | Instance 0']
-        
-        niddm_na = niddm[cols].dropna()
-        healthy_na = healthy[cols_both].dropna()
-        niddm_na = niddm_na[(niddm_na['Date E11 first reported (non-insulin-dependent diabetes mellitus)'] != "Code has event date matching participant's date of birth")]
-
-        niddm_na['Date of attending assessment centre | Instance 0'] = pd.to_datetime(niddm_na['Date of attending assessment centre | Instance 0'])
-        niddm_na['Date E11 first reported (non-insulin-dependent diabetes mellitus)'] = pd.to_datetime(niddm_na['Date E11 first reported (non-insulin-dependent diabetes mellitus)'])
-
-        niddm_na['diff_days'] = (niddm_na['Date E11 first reported (non-insulin-dependent diabetes mellitus)'] - niddm_na['Date of attending assessment centre | Instance 0']) / np.timedelta64(1, 'D')
-
-        #Different timescales
-        niddm_na_five = niddm_na[(niddm_na['diff_days'] < 1825) & (niddm_na['diff_days'] > 0)]
-        niddm_na_one = niddm_na[(niddm_na['diff_days'] < 365) & (niddm_na['diff_days'] > 0)]
-        niddm_na_fiveten = niddm_na[(niddm_na['diff_days'] > 1825) & (niddm_na['diff_days'] < 3650)]
-        niddm_na_ten = niddm_na[(niddm_na['diff_days'] > 3650)]
-
-        question_hb1ac = question+['Glycated haemoglobin (HbA1c) | Instance 0'] 
+        self.nb_osteo = NBWrapper(None)
 
-        #LADA column creation
-        niddm_na_one["LADA"] = niddm_na_one[['Age at recruitment','Body mass index (BMI) | Instance 0', 'Glycated haemoglobin (HbA1c) | Instance 0']].apply(self.lada_alg,axis=1)
-        niddm_na_five["LADA"] = niddm_na_five[['Age at recruitment','Body mass index (BMI) | Instance 0', 'Glycated haemoglobin (HbA1c) | Instance 0']].apply(self.lada_alg,axis=1)
-        niddm_na_fiveten["LADA"] = niddm_na_fiveten[['Age at recruitment','Body mass index (BMI) | Instance 0', 'Glycated haemoglobin (HbA1c) | Instance 0']].apply(self.lada_alg,axis=1)
-        niddm_na_ten["LADA"] = niddm_na_ten[['Age at recruitment','Body mass index (BMI) | Instance 0', 'Glycated haemoglobin (HbA1c) | Instance 0']].apply(self.lada_alg,axis=1)
+        #Asthma
+        self.binary_columns_asthma = None
+        self.slope_asthma = None
+        self.intercept_asthma = None
 
-        #Exclusion on LADA
-        niddm_na_one_lada = niddm_na_one[(niddm_na_one["LADA"] == 0)]
-        niddm_na_five_lada = niddm_na_five[(niddm_na_five["LADA"] == 0)]
-        niddm_na_fiveten_lada = niddm_na_fiveten[(niddm_na_fiveten["LADA"] == 0)]
-        niddm_na_ten_lada = niddm_na_ten[(niddm_na_ten["LADA"] == 0)]
+        self.nb_atshma = NBWrapper(None)
 
-        #Cluster model construction
-        self.niddm_na_one_lada_clustermodel.cluster_model, niddm_na_one_lada_clustercolumn, self.niddm_na_one_lada_clustermodel.scaler = self.kmeans_clustering(niddm_na_one_lada,question, 4)
-        self.niddm_na_five_lada_clustermodel.cluster_model, niddm_na_five_lada_clustercolumn, self.niddm_na_five_lada_clustermodel.scaler = self.kmeans_clustering(niddm_na_five_lada,question, 4)
-        self.niddm_na_fiveten_lada_clustermodel.cluster_model, niddm_na_fiveten_lada_clustercolumn, self.niddm_na_fiveten_lada_clustermodel.scaler = self.kmeans_clustering(niddm_na_fiveten_lada,question, 4)
-        self.niddm_na_ten_lada_clustermodel.cluster_model, niddm_na_ten_lada_clustercolumn, self.niddm_na_ten_lada_clustermodel.scaler = self.kmeans_clustering(niddm_na_ten_lada,question, 4)
+    def diabetes_modeling(self):
+        '''
+        Diabetes model construction
+        '''
+        self.train_models(diseases=["diabetes"])
 
-        #Adding clustering results
-        niddm_na_one_lada['cluster'] = niddm_na_one_lada_clustercolumn
-        niddm_na_five_lada['cluster'] = niddm_na_five_lada_clustercolumn
-        niddm_na_fiveten_lada['cluster'] = niddm_na_fiveten_lada_clustercolumn
-        niddm_na_ten_lada['cluster'] = niddm_na_ten_lada_clustercolumn
+    def spec(self, name):
+        '''
+        Returns the modelSpec of the registry with this name
+        '''
+        return next(spec for spec in self.model_registry if spec.name == name)
 
-        model_cols = cols_both+["cluster"]
-        self.diabetes_data_columns = cols_both
+    def spec_columns(self, spec):
+        '''
+        Returns the feature columns of a modelSpec
+        '''
+        return list(self.feature_columns[spec.features]) + spec.extra_features
 
-        #Model construction
-        x = self.cluster_label(self.class_balance(niddm_na_one_lada[niddm_na_one_lada['cluster']==0][model_cols], healthy_na))
-        self.niddm_na_one_lada_rfmodel_one.rf_model, self.niddm_na_one_lada_rfmodel_one.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+    def select_specs(self, names=None, diseases=None, cohort=None):
+        '''
+        Selects specs of the registry, in registry order
 
-        x = self.cluster_label(self.class_balance(niddm_na_one_lada[niddm_na_one_lada['cluster']==1][model_cols], healthy_na))
-        self.niddm_na_one_lada_rfmodel_two.rf_model, self.niddm_na_one_lada_rfmodel_two.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+        Parameters
+        -------
+        names : list
+            Names of the models (default is None, all)
+        diseases : list
+            Diseases of the models (default is None, all)
+        cohort : String
+            Cohort the models are trained on: combined, men or women (default is None, all)
 
-        x = self.cluster_label(self.class_balance(niddm_na_one_lada[niddm_na_one_lada['cluster']==2][model_cols], healthy_na))
-        self.niddm_na_one_lada_rfmodel_three.rf_model, self.niddm_na_one_lada_rfmodel_three.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+        Returns
+        -------
+        specs : list
+        '''
+        return [spec for spec in self.model_registry if (names == None or spec.name in names)
+                and (diseases == None or spec.disease in diseases) and (cohort == None or cohort in spec.cohorts)]
 
-        x = self.cluster_label(self.class_balance(niddm_na_one_lada[niddm_na_one_lada['cluster']==3][model_cols], healthy_na))
-        self.niddm_na_one_lada_rfmodel_four.rf_model, self.niddm_na_one_lada_rfmodel_four.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+    def train_models(self, names=None, diseases=None, cohort=None):
+        '''
+        Trains the selected models of the registry, the wrappers are updated in place. A diabetes random forest
+        reuses the cluster model of its timescale when that is fitted, otherwise it is fitted as well
 
-        x = self.cluster_label(self.class_balance(niddm_na_five_lada[niddm_na_five_lada['cluster']==0][model_cols], healthy_na))
-        self.niddm_na_five_lada_rfmodel_one.rf_model, self.niddm_na_five_lada_rfmodel_one.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+        Parameters
+        -------
+        names : list
+            Names of the models (default is None, all)
+        diseases : list
+            Diseases of the models (default is None, all)
+        cohort : String
+            Cohort the models are trained on: combined, men or women (default is None, all)
+        '''
+        specs = self.select_specs(names, diseases, cohort)
+        diabetes = [spec for spec in specs if spec.estimator in ("kmeans", "random_forest")]
+        if diabetes:
+            self.fit_diabetes_models(diabetes)
+        lr = [spec for spec in specs if spec.estimator == "logistic_regression"]
+        if lr:
+            self.fit_logistic_regressions(lr)
+        self.cohort_store.evict("train")
+
+    def diabetes_training_data(self):
+        '''
+        Returns the NIDDM cases without LADA, with the days from attendance to first occurence, and the healthy
+        participants of the train set
 
-        x = self.cluster_label(self.class_balance(niddm_na_five_lada[niddm_na_five_lada['cluster']==1][model_cols], healthy_na))
-        self.niddm_na_five_lada_rfmodel_two.rf_model, self.niddm_na_five_lada_rfmodel_two.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+        Returns
+        -------
+        niddm_na : pandas dataframe object
+        healthy_na : pandas dataframe object
+        '''
+        first_occurence, attendance_date = self.diabetes_dates
+        niddm = self.train[(self.train['Date E11 first reported (non-insulin-dependent diabetes mellitus)_onehot'] == 1)]
+        healthy = self.train[(self.train['first_occurence_diabetes_binary'] == 0) & (self.train['Glycated haemoglobin (HbA1c) | Instance 0'] < 48)]
+        question = list(self.feature_columns["diabetes_question"])
 
-        x= self.cluster_label(self.class_balance(niddm_na_five_lada[niddm_na_five_lada['cluster']==2][model_cols], healthy_na))
-        self.niddm_na_five_lada_rfmodel_three.rf_model, self.niddm_na_five_lada_rfmodel_three.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+        self.diabetes_question_columns = question
+        self.diabetes_data_columns = question+['Glycated haemoglobin (HbA1c) | Instance 0']
+        cols = question+['Glycated haemoglobin (HbA1c) | Instance 0','first_occurence_diabetes_binary', first_occurence, attendance_date]
 
-        x = self.cluster_label(self.class_balance(niddm_na_five_lada[niddm_na_five_lada['cluster']==3][model_cols], healthy_na))
-        self.niddm_na_five_lada_rfmodel_four.rf_model, self.niddm_na_five_lada_rfmodel_four.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+        niddm_na = niddm[cols].dropna()
+        healthy_na = healthy[self.diabetes_data_columns].dropna()
+        niddm_na = niddm_na[(niddm_na[first_occurence] != "Code has event date matching participant's date of birth")]
 
-        x = self.cluster_label(self.class_balance(niddm_na_fiveten_lada[niddm_na_fiveten_lada['cluster']==0][model_cols], healthy_na))
-        self.niddm_na_fiveten_lada_rfmodel_one.rf_model, self.niddm_na_fiveten_lada_rfmodel_one.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+        niddm_na[attendance_date] = pd.to_datetime(niddm_na[attendance_date])
+        niddm_na[first_occurence] = pd.to_datetime(niddm_na[first_occurence])
+        niddm_na['diff_days'] = (niddm_na[first_occurence] - niddm_na[attendance_date]) / np.timedelta64(1, 'D')
 
-        x = self.cluster_label(self.class_balance(niddm_na_fiveten_lada[niddm_na_fiveten_lada['cluster']==1][model_cols], healthy_na))
-        self.niddm_na_fiveten_lada_rfmodel_two.rf_model, self.niddm_na_fiveten_lada_rfmodel_two.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+        #Exclusion on LADA, see lada_alg
+        niddm_na = niddm_na[~(niddm_na['Body mass index (BMI) | Instance 0'] < 24)]
+        return niddm_na, healthy_na
 
-        x = self.cluster_label(self.class_balance(niddm_na_fiveten_lada[niddm_na_fiveten_lada['cluster']==2][model_cols], healthy_na))
-        self.niddm_na_fiveten_lada_rfmodel_three.rf_model, self.niddm_na_fiveten_lada_rfmodel_three.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+    def fit_diabetes_models(self, specs):
+        '''
+        Fits the cluster models of the timescales the specs need, then the random forests of the specs.
+        The training sets are sampled here in order, the independent fits run in a process pool when self.n_jobs
+        allows more than one at a time
 
-        x = self.cluster_label(self.class_balance(niddm_na_fiveten_lada[niddm_na_fiveten_lada['cluster']==3][model_cols], healthy_na))
-        self.niddm_na_fiveten_lada_rfmodel_four.rf_model, self.niddm_na_fiveten_lada_rfmodel_four.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+        Parameters
+        -------
+        specs : list
+            kmeans and random_forest specs of the registry
+        '''
+        store = self.cohort_store
+        niddm_na, healthy_na = store.cohort(("train", "diabetes"), self.diabetes_training_data)
+        question = self.diabetes_question_columns
+        model_cols = self.diabetes_data_columns+["cluster"]
+
+        #Cases of every timescale needed, labeled with their cluster
+        windows = {}
+        names = [spec.name for spec in specs]
+        for spec in specs:
+            name = spec.name if spec.estimator == "kmeans" else spec.cluster_model
+            if name in windows:
+                continue
+            window = self.spec(name).window
+            df = niddm_na[(niddm_na['diff_days'] > window[0]) & (niddm_na['diff_days'] < window[1])].copy()
+            wrapper = self.models[name]
+            if name in names or wrapper.cluster_model == None:
+                wrapper.cluster_model, df['cluster'], wrapper.scaler = self.kmeans_clustering(df, question, 4)
+            else:
+                x = df[question] if wrapper.scaler == None else pd.DataFrame(wrapper.scaler.transform(df[question]), columns=question)
+                df['cluster'] = wrapper.cluster_model.predict(x)
+            windows[name] = df
+
+        #Random forest per timescale and cluster. The forests of a timescale are sampled from its cases and the
+        #healthy participants, which are scaled once for all of them
+        wrappers = []
+        scalers = []
+        training_sets = []
+        for spec in specs:
+            if spec.estimator == "random_forest":
+                key = ("train", "diabetes", spec.cluster_model)
+                cohort = store.cohort(key, lambda: pd.concat([windows[spec.cluster_model][model_cols], healthy_na], ignore_index=True))
+                matrix, scaler = store.matrix(key, self.spec_columns(spec))
+                x = self.cluster_label(self.class_balance(cohort[cohort['cluster']==spec.cluster], cohort[cohort['cluster'].isna()]))
+                wrappers.append(self.models[spec.name])
+                scalers.append(scaler)
+                training_sets.append((pd.DataFrame(matrix[x.index], columns=self.spec_columns(spec)), x['cluster_label']))
+        for wrapper, scaler, (model, _) in zip(wrappers, scalers, self.random_forests(training_sets, scaling=False)):
+            wrapper.rf_model = model
+            wrapper.scaler = scaler
 
-        x = self.cluster_label(self.class_balance(niddm_na_ten_lada[niddm_na_ten_lada['cluster']==0][model_cols], healthy_na))
-        self.niddm_na_ten_lada_rfrmodel_one.rf_model, self.niddm_na_ten_lada_rfrmodel_one.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+        #Creating boxplots
+        if self.boxplot_eval:
+            for c in self.diabetes_data_columns:
+                for name, df in windows.items():
+                    self.cluster_boxplot(title=c+' '+name.replace("_clustermodel", "_")+self.sex, data=[df[df['cluster']==n][c].tolist() for n in range(0,4)])
 
-        x = self.cluster_label(self.class_balance(niddm_na_ten_lada[niddm_na_ten_lada['cluster']==1][model_cols], healthy_na))
-        self.niddm_na_ten_lada_rfrmodel_two.rf_model, self.niddm_na_ten_lada_rfrmodel_two .scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+    def fit_logistic_regressions(self, specs):
+        '''
+        Fits the logistic regression models of the specs on class balanced train data. Specs with the same
+        features and label share the selection of complete rows
 
-        x = self.cluster_label(self.class_balance(niddm_na_ten_lada[niddm_na_ten_lada['cluster']==2][model_cols], healthy_na))
-        self.niddm_na_ten_lada_rfrmodel_three.rf_model, self.niddm_na_ten_lada_rfrmodel_three.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
+        Parameters
+        -------
+        specs : list
+            logistic_regression specs of the registry
+        '''
+        for spec in specs:
+            wrapper = self.models[spec.name]
+            columns = self.spec_columns(spec)
+            wrapper.data_columns = columns
+            wrapper.label_column = spec.label
+
+            extra = [] if spec.window_column == None else [spec.window_column]
+            na = self.cohort_store.cohort(("train", tuple(columns), spec.label, spec.window_column),
+                                          lambda: self.train[columns+[spec.label]+extra].dropna(subset=columns+[spec.label]))
+
+            #Positives only count within the window, when the spec has one
+            target = na[spec.label]==1
+            if spec.window != None:
+                target = target & (na[spec.window_column] > spec.window[0]) & (na[spec.window_column] < spec.window[1])
+            na = self.class_balance(targetclass=na[target], class2=na[na[spec.label]==0])
+            wrapper.lr_model, wrapper.scaler = self.logistic_regression(y_train=na[spec.label], x_train=na[columns], scaling=False)
+
+    def evaluate_models(self, names=None, diseases=None, cohort=None, stratisfy=True):
+        '''
+        Evaluates the selected models of the registry on the test set, cluster models are evaluated through
+        their random forests
 
-        x = self.cluster_label(self.class_balance(niddm_na_ten_lada[niddm_na_ten_lada['cluster']==3][model_cols], healthy_na))
-        self.niddm_na_ten_lada_rfrmodel_four.rf_model, self.niddm_na_ten_lada_rfrmodel_four.scaler = self.random_forest(y_train=x['cluster_label'], x_train=x[cols_both])
-        
-        #Creating boxplots
-        if self.boxplot_eval:
-            for c in question_hb1ac: 
-                self.cluster_boxplot(title=c+' niddm_na_one_lada_'+self.sex, data=[niddm_na_one_lada[niddm_na_one_lada['cluster']==n][c].tolist() for n in range(0,4)])
-                self.cluster_boxplot(title=c+' niddm_na_five_lada_'+self.sex, data=[niddm_na_five_lada[niddm_na_five_lada['cluster']==n][c].tolist() for n in range(0,4)])
-                self.cluster_boxplot(title=c+' niddm_na_fiveten_lada_'+self.sex, data=[niddm_na_fiveten_lada[niddm_na_fiveten_lada['cluster']==n][c].tolist() for n in range(0,4)])
-                self.cluster_boxplot(title=c+' niddm_na_ten_lada_'+self.sex, data=[niddm_na_ten_lada[niddm_na_ten_lada['cluster']==n][c].tolist() for n in range(0,4)])
+        Parameters
+        -------
+        names : list
+            Names of the models (default is None, all)
+        diseases : list
+            Diseases of the models (default is None, all)
+        cohort : String
+            Cohort the models are trained on: combined, men or women (default is None, all)
+        stratisfy : Binary
+            Indicates if data should be class balanced (default is True)
+        '''
+        first_occurence, attendance_date = self.diabetes_dates
+        for spec in self.select_specs(names, diseases, cohort):
+            if spec.estimator == "random_forest":
+                self.rf_evaluation_diabetes(rf_model=self.models[spec.name], model_name=spec.evaluation_name.format(sex=self.sex),
+                                            data_columns=self.spec_columns(spec), label_column=spec.label,
+                                            first_occurence=first_occurence, attendance_date=attendance_date,
+                                            cluster_model=self.models[spec.cluster_model], current_cluster=spec.cluster,
+                                            stratisfy=stratisfy)
+            elif spec.estimator == "logistic_regression":
+                self.lr_evaluation_copd(model_name=spec.evaluation_name, lr_model=self.models[spec.name], stratisfy=stratisfy)
+        self.cohort_store.evict("test")
+
+    def save_models(self, folder, names=None):
+        '''
+        Pickles the wrappers of the selected models to <folder><name>.pkl
+        '''
+        for spec in self.select_specs(names):
+            with open(folder+spec.name+".pkl", "wb") as f:
+                pickle.dump(self.models[spec.name], f)
 
+    def load_models(self, folder, names=None):
+        '''
+        Loads the wrappers written by save_models into the registry slots, missing files are skipped
+        '''
+        for spec in self.select_specs(names):
+            if os.path.exists(folder+spec.name+".pkl"):
+                with open(folder+spec.name+".pkl", "rb") as f:
+                    self.models[spec.name].__dict__.update(pickle.load(f).__dict__)
 
     def lada_alg(self, l):
         '''
@@ -1318,7 +3774,7 @@ class modelConstruction():
         return cohort
     
     def cluster_label(self, cohort, clustertag='cluster'):
-        cohort[clustertag+'_label'] = cohort[clustertag].apply(self.dp.nan_to_binary)
+        cohort[clustertag+'_label'] = self.dp.nan_to_binary(cohort[clustertag])
         return cohort
 
     def random_forest(self, x_train, y_train, scaling=True):
@@ -1339,16 +3795,33 @@ class modelConstruction():
         model : sklearn random forest model
         mms : minmaxscaler object
         '''
-        mms = None
-        if scaling:
-            mms = MinMaxScaler()
-            mms.fit(x_train)
-            tcol = x_train.columns.tolist()
-            data_transformed = mms.transform(x_train)
-            x_train = pd.DataFrame(data_transformed, columns=tcol)
-        model = RandomForestClassifier()
-        model.fit(x_train, y_train)
-        return model, mms
+        return fit_random_forest(x_train, y_train, scaling=scaling, n_jobs=self.rf_n_jobs)
+
+    def random_forests(self, training_sets, scaling=True):
+        '''
+        Constructs a random forest model per training set. The core budget self.n_jobs is divided over worker
+        processes running self.rf_n_jobs threads each. The seeds are drawn from the global numpy random state in
+        order, so the models do not depend on the number of workers
+
+        Parameters
+        -------
+        training_sets : list
+            Tuples of x_train and y_train
+        scaling : Binary
+            Indicates wether or not data should be scaled (default is True)
+
+        Returns
+        -------
+        models : list
+            Tuples of the random forest model and minmaxscaler object, in the order of training_sets
+        '''
+        seeds = np.random.randint(0, 2**31-1, len(training_sets))
+        workers = min(len(training_sets), max(1, self.n_jobs // (self.rf_n_jobs or 1)))
+        if workers <= 1:
+            return [fit_random_forest(x, y, scaling, self.rf_n_jobs, seed) for (x, y), seed in zip(training_sets, seeds)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fit_random_forest, x, y, scaling, self.rf_n_jobs, seed) for (x, y), seed in zip(training_sets, seeds)]
+            return [future.result() for future in futures]
     
     def logistic_regression(self, x_train, y_train, scaling=True):
         '''
@@ -1375,6 +3848,8 @@ class modelConstruction():
             tcol = x_train.columns.tolist()
             data_transformed = mms.transform(x_train)
             x_train = pd.DataFrame(data_transformed, columns=tcol)
+        else:
+            x_train = self.feature_matrix(x_train, x_train.columns.tolist())
         logisticRegr = LogisticRegression(max_iter=1000000000)
         logisticRegr.fit(x_train, y_train)
         return logisticRegr, mms
@@ -1405,160 +3880,13 @@ class modelConstruction():
         '''
         This fucntion creates COPD models
         '''
-        #Define various columns for current smokers
-        self.chronic_bronchitis_model_current.data_columns = [
-            'Age at recruitment',
-            'Pack years adult smoking as proportion of life span exposed to smoking',
-            'Brisk pace',
-            'Steady average pace',
-            'Number of cigarettes previously smoked daily',
-            'hayfever/allergic rhinitis',
-            'Age started smoking in former smokers',
-            'allergy or anaphylactic reaction to food',
-            'Pack years of smoking',
-            'Neutrophill count | Instance 0'
-        ]
-        self.chronic_bronchitis_model_current.label_column = 'Date J42 first reported (unspecified chronic bronchitis)_binary'
-
-        self.emphysema_model_current.data_columns = [
-            'Pack years adult smoking as proportion of life span exposed to smoking',
-            'Age at recruitment',
-            'Number of cigarettes previously smoked daily',
-            'Brisk pace',
-            'Body mass index (BMI) | Instance 0',
-            'chronic sinusitis',
-            'Steady average pace',
-            'Neutrophill count | Instance 0',
-            'Pack years of smoking',
-            'Hayfever_allergic_rhinitis_eczema_doctor'
-        ]
-        self.emphysema_model_current.label_column = 'Date J43 first reported (emphysema)_binary'
-        
-        self.other_copd_model_current.data_columns = [
-            'Age at recruitment',
-            'Brisk pace',
-            'Pack years adult smoking as proportion of life span exposed to smoking',
-            'Steady average pace',
-            'Number of cigarettes previously smoked daily',
-            'Pack years of smoking',
-            'Neutrophill count | Instance 0',
-            'Doctor diagnosed asthma',
-            'Eosinophill count | Instance 0',
-            'Summed MET minutes per week for all activity | Instance 0'
-        ]
-        self.other_copd_model_current.label_column = 'Date J44 first reported (other chronic obstructive pulmonary disease)_binary'
-
-        #Model construction
-        na = self.train[self.chronic_bronchitis_model_current.data_columns+[self.chronic_bronchitis_model_current.label_column]].dropna()
-        na = self.class_balance(targetclass=na[na[self.chronic_bronchitis_model_current.label_column]==1], class2=na[na[self.chronic_bronchitis_model_current.label_column]==0])
-        self.chronic_bronchitis_model_current.lr_model , self.chronic_bronchitis_model_current.scaler = self.logistic_regression(y_train=na[self.chronic_bronchitis_model_current.label_column],
-                                                                                        x_train=na[self.chronic_bronchitis_model_current.data_columns],
-                                                                                        scaling=False)
-        
-        na = self.train[self.emphysema_model_current.data_columns+[self.emphysema_model_current.label_column]].dropna()
-        na = self.class_balance(targetclass=na[na[self.emphysema_model_current.label_column]==1], class2=na[na[self.emphysema_model_current.label_column]==0])
-        self.emphysema_model_current.lr_model , self.emphysema_model_current.scaler = self.logistic_regression(y_train=na[self.emphysema_model_current.label_column],
-                                                                                        x_train=na[self.emphysema_model_current.data_columns],
-                                                                                        scaling=False)
-
-        na = self.train[self.other_copd_model_current.data_columns+[self.other_copd_model_current.label_column ]].dropna()
-        na = self.class_balance(targetclass=na[na[self.other_copd_model_current.label_column]==1], class2=na[na[self.other_copd_model_current.label_column]==0])
-        self.other_copd_model_current.lr_model , self.other_copd_model_current.scaler = self.logistic_regression(y_train=na[self.other_copd_model_current.label_column ],
-                                                                                        x_train=na[self.other_copd_model_current.data_columns],
-                                                                                        scaling=False)
-
-        #With data on past smokers
-        self.emphysema_model_past.data_columns = [
-            'Number of cigarettes currently smoked daily (current cigarette smokers)',
-            'Age at recruitment',
-            'Pack years of smoking',
-            'Age started smoking in current smokers',
-            'Body mass index (BMI) | Instance 0',
-            'Brisk pace',
-            'Steady average pace',
-            'Pack years adult smoking as proportion of life span exposed to smoking',
-            'Cholesterol | Instance 0',
-            'Haemoglobin concentration | Instance 0'
-        ]
-        self.emphysema_model_past.label_column = 'Date J43 first reported (emphysema)_binary'
-
-        self.other_copd_model_past.data_columns = [
-            'Number of cigarettes currently smoked daily (current cigarette smokers)',
-            'Age at recruitment',
-            'Brisk pace',
-            'Pack years adult smoking as proportion of life span exposed to smoking',
-            'Age started smoking in current smokers',
-            'Steady average pace',
-            'Body mass index (BMI) | Instance 0',
-            'Cholesterol | Instance 0',
-            'asbestosis',
-            'Haemoglobin concentration | Instance 0'
-        ]
-        self.other_copd_model_past.label_column = 'Date J44 first reported (other chronic obstructive pulmonary disease)_binary'
-
-        na = self.train[self.emphysema_model_past.data_columns+[self.emphysema_model_past.label_column]].dropna()
-        na = self.class_balance(targetclass=na[na[self.emphysema_model_past.label_column]==1], class2=na[na[self.emphysema_model_past.label_column]==0])
-        self.emphysema_model_past.lr_model , self.emphysema_model_past.scaler = self.logistic_regression(y_train=na[self.emphysema_model_past.label_column],
-                                                                                        x_train=na[self.emphysema_model_past.data_columns],
-                                                                                        scaling=False)
-
-        
-        na = self.train[self.other_copd_model_past.data_columns+[self.other_copd_model_past.label_column]].dropna()
-        na = self.class_balance(targetclass=na[na[self.other_copd_model_past.label_column]==1], class2=na[na[self.other_copd_model_past.label_column]==0])
-        self.other_copd_model_past.lr_model , self.other_copd_model_past.scaler = self.logistic_regression(y_train=na[self.other_copd_model_past.label_column],
-                                                                                        x_train=na[self.other_copd_model_past.data_columns],
-                                                                                        scaling=False)
+        self.train_models(diseases=["copd"])
 
     def cvd_modeling(self):
         '''
         Model creation for CVD
         '''
-        #Define used columns
-        ten_hf = ['Hip circumference | Instance 0',
-         'heart attack/myocardial infarction',
-         'bronchitis',
-         'nasal/sinus disorder',
-         'fmi',
-         'osteoarthritis',
-         'Age at recruitment',
-         'Body mass index (BMI) | Instance 0',
-         'fracture upper arm / humerus / elbow',
-         'rheumatic fever']
-        self.cvd_hf_model.data_columns = ten_hf
-        self.cvd_hf_model.label_column = 'Date I50 first reported (heart failure)_binary'
-        
-        ten_isch = [
-        "heart attack/myocardial infarction",
-        "angina",
-        "Age at recruitment",
-        "Basal metabolic rate | Instance 0",
-        "ovarian cyst or cysts",
-        "Pack years adult smoking as proportion of life span exposed to smoking",
-        "essential hypertension",
-        "Pack years of smoking",
-        "Slow pace",
-        "hepatitis c"]
-        self.cvd_isch_model.data_columns = ten_isch
-        self.cvd_isch_model.label_column = "Date I25 first reported (chronic ischaemic heart disease)_binary"
-
-        #Model construction
-        na = self.train[self.cvd_hf_model.data_columns+[self.cvd_hf_model.label_column, 'Date I50 first reported (heart failure)diff_days']].dropna(subset=self.cvd_hf_model.data_columns)
-        na = self.class_balance(targetclass=na[  (na[self.cvd_hf_model.label_column]==1)
-                                               & (na['Date I50 first reported (heart failure)diff_days'] > 0) 
-                                               & (na['Date I50 first reported (heart failure)diff_days'] < 5*365)],
-                                class2=na[na[self.cvd_hf_model.label_column]==0])
-        self.cvd_hf_model.lr_model , self.cvd_hf_model.scaler = self.logistic_regression(y_train=na[self.cvd_hf_model.label_column],
-                                                                                        x_train=na[self.cvd_hf_model.data_columns],
-                                                                                        scaling=False)
-
-        na = self.train[self.cvd_isch_model.data_columns+[self.cvd_isch_model.label_column, 'Date I25 first reported (chronic ischaemic heart disease)diff_days']].dropna(subset=self.cvd_isch_model.data_columns)
-        na = self.class_balance(targetclass=na[  (na[self.cvd_isch_model.label_column]==1)
-                                               & (na['Date I25 first reported (chronic ischaemic heart disease)diff_days'] > 0) 
-                                               & (na['Date I25 first reported (chronic ischaemic heart disease)diff_days'] < 5*365)],
-                                class2=na[na[self.cvd_isch_model.label_column]==0])
-        self.cvd_isch_model.lr_model , self.cvd_isch_model.scaler = self.logistic_regression(y_train=na[self.cvd_isch_model.label_column],
-                                                                                        x_train=na[self.cvd_isch_model.data_columns],
-                                                                                        scaling=False)
+        self.train_models(diseases=["cvd"])
 
     def lr_evaluation_cvd(self, model_name, lr_model,stratisfy=True):
         '''
@@ -1683,10 +4011,55 @@ class modelConstruction():
         predictions_prob : list
             list with probability predictions
         '''
-        predictions = model.predict(df[data_columns])
-        predictions_prob = model.predict_proba(df[data_columns])
+        x = self.feature_matrix(df, data_columns)
+        if sparse.issparse(x) and isinstance(model, GaussianNB):
+            predictions = np.concatenate([model.predict(chunk) for start, chunk in self.dense_chunks(x)])
+            predictions_prob = np.concatenate([model.predict_proba(chunk) for start, chunk in self.dense_chunks(x)])
+            return predictions, predictions_prob
+        predictions = model.predict(x)
+        predictions_prob = model.predict_proba(x)
         return predictions, predictions_prob
     
+    def diabetes_test_data(self, columns, label_column, first_occurence, attendance_date):
+        '''
+        Returns the NIDDM cases without LADA, with the days from attendance to first occurence, and the controls
+        of the test set, of the sex of the construction
+
+        Parameters
+        -------
+        columns : list
+            Columns to return next to diff_days
+        label_column : String
+            String with name of the column containing labels
+        first_occurence : String
+            String with name of column indicating first occurence
+        attendance_date : string
+             String with name of column indicating attendance date
+
+        Returns
+        -------
+        cases : pandas dataframe object
+        controls : pandas dataframe object
+        '''
+        test = self.test[list(dict.fromkeys(columns+[attendance_date, first_occurence, "Sex", 'Body mass index (BMI) | Instance 0', 'Glycated haemoglobin (HbA1c) | Instance 0']))]
+        if self.sex in ("men", "women"):
+            test = test[test["Sex"]==(1 if self.sex == "men" else 0)]
+        cases = test[(test[label_column]==1) & (test[first_occurence] != "Code has event date matching participant's date of birth")]
+        controls = test[(test[label_column]==0) & (test['Glycated haemoglobin (HbA1c) | Instance 0'] < 48)]
+
+        cases = cases.assign(diff_days=(pd.to_datetime(cases[first_occurence]) - pd.to_datetime(cases[attendance_date])) / np.timedelta64(1, 'D'))
+        #Exclusion on LADA, see lada_alg
+        cases = cases[~(cases['Body mass index (BMI) | Instance 0'] < 24)]
+        return cases, controls
+
+    def empty_evaluation(self, model_name):
+        '''
+        Writes a model without test cases or controls to the evaluations file
+        '''
+        with open(self.evaluation_folder+"model_performance.txt", "a") as column_file:
+            column_file.write("Model: "+model_name +"\n")
+            column_file.write("Test size: 0\n\n")
+
     def rf_evaluation_diabetes(self, rf_model, data_columns, label_column, first_occurence ,attendance_date ,model_name, cluster_model, current_cluster,stratisfy=True):#TODO: Divide into functions
         '''
         This function evaluates diabetes RF models, results are written to evaluations file
@@ -1710,59 +4083,47 @@ class modelConstruction():
         Stratisfy : Binary
             Indicates if data should be class balanced (default is True)
         '''
-        #Obtain test data
-        test = self.test[data_columns+[label_column, attendance_date, first_occurence]]
-        test_pos = test[test[label_column]==1]
-        test_neg = test[(test[label_column]==0) & (test['Glycated haemoglobin (HbA1c) | Instance 0'] < 48)]
-        
-        test_pos = test_pos[(test_pos['Date E11 first reported (non-insulin-dependent diabetes mellitus)'] != "Code has event date matching participant's date of birth")]
-
-        test_pos['Date of attending assessment centre | Instance 0'] = pd.to_datetime(test_pos['Date of attending assessment centre | Instance 0'])
-        test_pos['Date E11 first reported (non-insulin-dependent diabetes mellitus)'] = pd.to_datetime(test_pos['Date E11 first reported (non-insulin-dependent diabetes mellitus)'])
-        test_pos['diff_days'] = (test_pos[first_occurence] - test_pos[attendance_date]) / np.timedelta64(1, 'D')
-
-        test_pos = test_pos[(test_pos['diff_days'] < rf_model.max_days) & (test_pos['diff_days'] > rf_model.min_days)]
-        test_pos["LADA"] = test_pos[['Age at recruitment','Body mass index (BMI) | Instance 0', 'Glycated haemoglobin (HbA1c) | Instance 0']].apply(self.lada_alg,axis=1)
-        test_pos = test_pos[test_pos["LADA"]==0]
-
-        #Split data on sex
-        if self.sex == "men":
-            test_pos = test_pos[test_pos["Sex"]==1]
-            test_neg = test_neg[test_neg["Sex"]==1]
-        if self.sex == "women":
-            test_pos = test_pos[test_pos["Sex"]==0]
-            test_neg = test_neg[test_neg["Sex"]==0]
-
-        #Remove missing data
-        test_pos = test_pos[data_columns+[label_column, "Participant ID"]].dropna()
-        test_neg = test_neg[data_columns+[label_column, "Participant ID"]].dropna()
-        
-        #Scaling
-        if rf_model.scaler != None:
-            lc = test_pos[label_column].tolist()
-            data_transformed = rf_model.scaler.transform(test_pos[data_columns])
-            test_pos = pd.DataFrame(data_transformed, columns=data_columns)
-            test_pos[label_column] = lc
-
-            lc = test_neg[label_column].tolist()
-            data_transformed = rf_model.scaler.transform(test_neg[rf_model.scaler.feature_names_in_])
-            test_neg = pd.DataFrame(data_transformed, columns=data_columns)
-            test_neg[label_column] = lc
-
-        #Cluster prediction
+        #Cases and controls of the test set, shared by the models with the same columns and timescale
+        store = self.cohort_store
+        columns = list(dict.fromkeys(data_columns+[label_column, "Participant ID"]))
+        cases, controls = store.cohort(("test", "diabetes", tuple(columns)),
+                                       lambda: self.diabetes_test_data(columns, label_column, first_occurence, attendance_date))
+        pos_key = ("test", "diabetes", tuple(columns), rf_model.min_days, rf_model.max_days)
+        neg_key = ("test", "diabetes", tuple(columns), "controls")
+        test_pos = store.cohort(pos_key, lambda: cases[(cases['diff_days'] < rf_model.max_days) & (cases['diff_days'] > rf_model.min_days)][columns].dropna().reset_index(drop=True))
+        test_neg = store.cohort(neg_key, lambda: controls[columns].dropna().reset_index(drop=True))
+        if test_pos.shape[0] == 0 or test_neg.shape[0] == 0:
+            return self.empty_evaluation(model_name)
+
+        #Cluster prediction, scaled like the cases the cluster model is fitted on
         tdc = data_columns.copy() 
         tdc.remove('Glycated haemoglobin (HbA1c) | Instance 0')
-
-        test_pos["cluster"+model_name] = self.cluster_predict(model=cluster_model.cluster_model, data_columns=tdc, df=test_pos)
-        test_pos = test_pos[test_pos["cluster"+model_name]==current_cluster]
-        
-        test_neg["cluster"+model_name] = self.cluster_predict(model=cluster_model.cluster_model, data_columns=tdc, df=test_neg)
-        test_neg = test_neg[test_neg["cluster"+model_name]==current_cluster]
+        clusters = []
+        for key, df in [(pos_key, test_pos), (neg_key, test_neg)]:
+            x = lambda: df[tdc] if cluster_model.scaler == None else pd.DataFrame(cluster_model.scaler.transform(df[tdc]), columns=tdc)
+            clusters.append(store.cohort(key+("cluster", cluster_model.cluster_model),
+                                         lambda: self.cluster_predict(model=cluster_model.cluster_model, data_columns=tdc, df=x())))
+
+        #Scaling, the matrices are shared by the models with the same scaler
+        scaled = []
+        for key, df, cluster in [(pos_key, test_pos, clusters[0]), (neg_key, test_neg, clusters[1])]:
+            matrix, _ = store.matrix(key, data_columns, rf_model.scaler)
+            mask = cluster == current_cluster
+            df_scaled = pd.DataFrame(matrix[mask], columns=data_columns)
+            df_scaled['Participant ID'] = df['Participant ID'].to_numpy()[mask]
+            df_scaled[label_column] = df[label_column].to_numpy()[mask]
+            df_scaled["cluster"+model_name] = cluster[mask]
+            scaled.append(df_scaled)
+        test_pos, test_neg = scaled
 
         #Save cluster prediction data
         tdf = pd.concat([test_neg[["cluster"+model_name, 'Participant ID']], test_pos[["cluster"+model_name, 'Participant ID']]]).dropna()
         self.test = self.test.merge(tdf, on='Participant ID', how="outer")
-        
+
+        #A cluster without cases or controls in the test set cannot be evaluated
+        if test_pos.shape[0] == 0 or test_neg.shape[0] == 0:
+            return self.empty_evaluation(model_name)
+
         #Stratification
         if stratisfy:
             test = pd.concat([test_pos, test_neg.sample(
@@ -1925,68 +4286,17 @@ class modelConstruction():
         #Column definitions
         if self.sex == 'men':
             s=1
-            self.binary_columns_osteo = ['hayfever/allergic rhinitis', 
-                                         'eczema/dermatitis', 
-                                         'pneumonia', 
-                                         'Hayfever_allergic_rhinitis_eczema_doctor', 
-                                         'Brisk pace', 'Slow pace', 
-                                         'Steady average pace', 
-                                         'Wheeze or whistling in the chest in last year | Instance 0_No', 
-                                          'hypertension', 'heart attack/myocardial infarction', 
-                                          'diabetes', 'high cholesterol', 'angina', 'asthma', 
-                                          'osteoarthritis', 'enlarged prostate', 'hiatus hernia', 
-                                          #'unclassifiable', 
-                                          'depression', 'ulcerative colitis', 
-                                          'emphysema/chronic bronchitis', 'stroke', 
-                                          'cataract', 'back problem', 'rheumatoid arthritis', 'epilepsy']
+            self.binary_columns_osteo = list(self.feature_columns["osteoporosis_men"])
         else:
             s=0
-            self.binary_columns_osteo = [
-                'hayfever/allergic rhinitis', 'chronic sinusitis', 
-                'pneumonia', 'Hayfever_allergic_rhinitis_eczema_doctor', 
-                'Brisk pace', 'Slow pace', 'Steady average pace', 
-                'Wheeze or whistling in the chest in last year | Instance 0_No',  
-                'hypertension', 'hypothyroidism/myxoedema', 'peritonitis', 'duodenal ulcer', 
-                'heart attack/myocardial infarction', 'diabetes', 'high cholesterol', 
-                'fracture lower leg / ankle', 'angina', 'anxiety/panic attacks',
-                'asthma', 'osteoarthritis', 'kidney stone/ureter stone/bladder stone', 
-                'cholelithiasis/gall stones', 'chronic fatigue syndrome', 'psoriasis', 
-                'hiatus hernia', 'heart valve problem/heart murmur', 'multiple sclerosis', 
-                #'unclassifiable', 
-                'allergy or anaphylactic reaction to drug', 'urinary frequency / incontinence', 
-                'spine arthritis/spondylitis', 'depression', 'glaucoma', 'other renal/kidney problem', 
-                'ulcerative colitis', 'ear/vestibular disorder', 'irritable bowel syndrome', 
-                'colitis/not crohns or ulcerative colitis', 'emphysema/chronic bronchitis', 
-                'diverticular disease/diverticulitis', 'hyperthyroidism/thyrotoxicosis', 
-                'malabsorption/coeliac disease', 'stroke', 'cervical spondylosis', 
-                'cataract',  'prolapsed disc/slipped disc', 
-                'oesophagitis/barretts oesophagus', 'pleurisy', 'urinary tract infection/kidney infection', 
-                'vaginal prolapse/uterine prolapse', 'back problem', 'essential hypertension', 
-                'muscle/soft tissue problem', 'crohns disease', 'anaemia', 'ovarian cyst or cysts',
-                'chronic obstructive airways disease/copd', 'heart arrhythmia', 'rheumatoid arthritis', 
-                'epilepsy', 'meningitis', 'other neurological problem', 'hepatitis', 'bone disorder', 
-                'gestational hypertension/pre-eclampsia', "meniere's disease", 'appendicitis', 
-                'benign breast lump', 'dry eyes', 'atrial fibrillation', 'polymyalgia rheumatica', 
-                'gastric/stomach ulcers', 'osteopenia', 'rectal or colon adenoma/polyps', 
-                'helicobacter pylori', 'eye/eyelid problem', 'parkinsons disease', 'joint disorder', 
-                'varicose veins', 'fracture wrist / colles fracture', 'rheumatic fever', 
-                'systemic lupus erythematosis/sle', 'pernicious anaemia', "sjogren's syndrome/sicca syndrome"
-            ]
+            self.binary_columns_osteo = list(self.feature_columns["osteoporosis_women"])
         
         #Linear regression dataprep
-        x = [i for i in range(140,190)]
-
-        y = []
-        for i in x:
-            t = self.train[(self.train['Standing height | Instance 0']==i) & (self.train['Date M81 first reported (osteoporosis without pathological fracture)_binary']==0) & (self.train["Sex"] ==s)]
-            to = self.train[(self.train['Standing height | Instance 0']==i) & (self.train['Date M81 first reported (osteoporosis without pathological fracture)_binary']==1)& (self.train["Sex"] ==s)]
-            if to.shape[0] == 0:
-                y.append(0)
-            else:
-                y.append(to.shape[0]/(t.shape[0]+to.shape[0])*100)
+        curve = prevalence_curve(self.train, 'Standing height | Instance 0', 'Date M81 first reported (osteoporosis without pathological fracture)_binary',
+                                 x=range(140,190), sex=s)
 
         #Model construction
-        self.slope_osteo, self.intercept_osteo, r, p, std_err = self.linear_regression(x=x, y=y)
+        self.slope_osteo, self.intercept_osteo, r, p, std_err = self.linear_regression(x=curve["x"], y=curve["y"])
         self.nb_osteo.nb_model = self.naive_bayes(df=self.train, data_columns=self.binary_columns_osteo, label_column='Date M81 first reported (osteoporosis without pathological fracture)_binary')
 
     def evaluation_osteoporosis(self, label_column='Date M81 first reported (osteoporosis without pathological fracture)_binary'):
@@ -2040,93 +4350,16 @@ class modelConstruction():
         #Column definition
         if self.sex == 'men':
             s=1
-            self.binary_columns_asthma = [
-                'hayfever/allergic rhinitis',
-                'pneumonia',
-                'Hayfever_allergic_rhinitis_eczema_doctor',
-                'Brisk pace',
-                'Slow pace',
-                'Wheeze or whistling in the chest in last year | Instance 0_No',
-                'hypertension',
-                'hypothyroidism/myxoedema',
-                'heart attack/myocardial infarction',
-                'diabetes',
-                'high cholesterol',
-                'angina',
-                'osteoarthritis',
-                'gout',
-                'enlarged prostate',
-                'hiatus hernia',
-                'depression',
-                'irritable bowel syndrome',
-                'emphysema/chronic bronchitis',
-                'stroke',
-                'cataract',
-                'prolapsed disc/slipped disc',
-                'back problem',
-                'eczema/dermatitis'
-            ]
+            self.binary_columns_asthma = list(self.feature_columns["asthma_men"])
         else:
             s=0
-            self.binary_columns_asthma = [
-                'hayfever/allergic rhinitis',
-                'pneumonia',
-                'Hayfever_allergic_rhinitis_eczema_doctor',
-                'Brisk pace',
-                'Slow pace',
-                'Steady average pace',
-                'Wheeze or whistling in the chest in last year | Instance 0_No',
-                'hypertension',
-                'hypothyroidism/myxoedema',
-                'heart attack/myocardial infarction',
-                'diabetes',
-                'high cholesterol',
-                'angina',
-                'anxiety/panic attacks',
-                'osteoarthritis',
-                'cholelithiasis/gall stones',
-                'psoriasis',
-                'hiatus hernia',
-                'migraine',
-                'allergy or anaphylactic reaction to drug',
-                'spine arthritis/spondylitis',
-                'depression',
-                'glaucoma',
-                'sciatica',
-                'allergy/hypersensitivity/anaphylaxis',
-                'irritable bowel syndrome',
-                'emphysema/chronic bronchitis',
-                'diverticular disease/diverticulitis',
-                'hyperthyroidism/thyrotoxicosis',
-                'stroke',
-                'cervical spondylosis',
-                'cataract',
-                'osteoporosis',
-                'prolapsed disc/slipped disc',
-                'endometriosis',
-                'vaginal prolapse/uterine prolapse',
-                'back problem',
-                'muscle/soft tissue problem',
-                'anaemia',
-                'eczema/dermatitis',
-                'rheumatoid arthritis',
-                'joint disorder'
-            ]
+            self.binary_columns_asthma = list(self.feature_columns["asthma_women"])
 
         #Linear regression dataprep
-        x = [i for i in range(140,190)]
-
-        y = []
-        for i in x:
-            t = self.train[(self.train['Pack years of smoking']==i) & (self.train['all_asthma_binary']==0) & (self.train["Sex"] ==s)]
-            to = self.train[(self.train['Pack years of smoking']==i) & (self.train['all_asthma_binary']==1)& (self.train["Sex"] ==s)]
-            if to.shape[0] == 0:
-                y.append(0)
-            else:
-                y.append(to.shape[0]/(t.shape[0]+to.shape[0])*100)
+        curve = prevalence_curve(self.train, 'Pack years of smoking', 'all_asthma_binary', x=range(140,190), sex=s)
 
         #Construct models
-        self.slope_asthma, self.intercept_asthma, r, p, std_err = self.linear_regression(x=x, y=y)
+        self.slope_asthma, self.intercept_asthma, r, p, std_err = self.linear_regression(x=curve["x"], y=curve["y"])
         self.nb_atshma.nb_model = self.naive_bayes(df=self.train, data_columns=self.binary_columns_asthma, label_column='all_asthma_binary')
         
     def evaluation_asthma(self,label_column = 'all_asthma_binary'):
@@ -2171,20 +4404,86 @@ class modelConstruction():
 
     def naive_bayes(self, df, data_columns, label_column):
         model = GaussianNB()
-        model.fit(df[data_columns], df[label_column])
+        x = self.feature_matrix(df, data_columns)
+        if sparse.issparse(x):
+            #GaussianNB needs dense input, fit on dense row chunks so the full block is never densified
+            y = df[label_column].to_numpy()
+            classes = np.unique(y)
+            for start, chunk in self.dense_chunks(x):
+                model.partial_fit(chunk, y[start:start+chunk.shape[0]], classes=classes)
+            return model
+        model.fit(x, df[label_column])
         return model
-    
+
+    def feature_matrix(self, df, data_columns):
+        '''
+        Returns the selected columns, as a CSR matrix when any of the columns is sparse
+
+        Parameters
+        -------
+        df : pandas dataframe object
+            Datasource
+        data_columns : list
+            List containing strings indicating which column to use from datasource
+
+        Returns
+        -------
+        x : pandas dataframe object or scipy CSR matrix
+        '''
+        is_sparse = [isinstance(df[c].dtype, pd.SparseDtype) for c in data_columns]
+        if not any(is_sparse):
+            return df[data_columns]
+
+        blocks = []
+        for c, sp in zip(data_columns, is_sparse):
+            if sp:
+                blocks.append(sparse.csc_matrix(df[[c]].sparse.to_coo()))
+            else:
+                blocks.append(sparse.csc_matrix(df[[c]].to_numpy(dtype=float)))
+        return sparse.hstack(blocks, format="csr", dtype=float)
+
+    def dense_chunks(self, x, chunk_size=50000):
+        '''
+        Yields dense row chunks of a sparse matrix
+
+        Returns
+        -------
+        start : int
+            Index of the first row in the chunk
+        chunk : numpy array object
+        '''
+        for start in range(0, x.shape[0], chunk_size):
+            yield start, x[start:start+chunk_size].toarray()
+
+    def profile_input(self, name):
+        '''
+        Input of a profiled method: the test set for evaluations, the train set otherwise
+        '''
+        return [self.test if "evaluation" in name else self.train]
+
+
+instrument(modelConstruction, "_modeling$|evaluation")
+
 
 class controller():
-    def __init__(self, wd, evaluation_folder,file=None, path=None, suppress_warnings=False, stratisfy=True) :
+    def __init__(self, wd, evaluation_folder,file=None, path=None, suppress_warnings=False, stratisfy=True, cache_dir=None, no_cache=False, n_jobs=1, csv_engine=None,
+                 compact_dtypes=False, diseases=None, profile=None, rf_n_jobs=None, parallel_cohorts=False, sparse_comorbidities=False) :
         #DATA PREPROCESSING
         self.file = file
+        self.diseases = list(modelConstruction.model_requirements) if diseases == None else diseases
         self.evaluation_folder = evaluation_folder
         self.path = path
+        self.path_written = False
         self.wd = wd
         self.stratisfy = stratisfy
+        self.profile = profile
+        self.rf_n_jobs = rf_n_jobs
+        #Model construction per cohort, independent of each other
+        self.cohorts = ["cohort_combined", "cohort_men", "cohort_women"]
 
-        self.dp = dataPreprocessing(wd=self.wd)
+        self.dp = dataPreprocessing(wd=self.wd, cache_dir=cache_dir, use_cache=not no_cache, n_jobs=n_jobs, csv_engine=csv_engine,
+                                     compact_dtypes=compact_dtypes, sparse_comorbidities=sparse_comorbidities,
+                                     profiler=None if profile == None else stageProfiler())
 
         if suppress_warnings:
             warnings.filterwarnings('ignore')
@@ -2194,12 +4493,18 @@ class controller():
             self.data_preprocessing()
             self.df = self.dp.df
             
-            if path != None:
+            if path != None and path.endswith(".csv"):
                 print("Saving dataframe to csv")
                 self.df.to_csv(self.path)
+            elif path != None:
+                print("Saving dataframe to feature store")
+                featureStore(self.path).write(self.df)
+                self.path_written = True
         else:
             print("Loading from file")
             self.df = self.load_file()
+            if compact_dtypes:
+                self.df = self.dp.compact(self.df)
 
         print("Save columns")
         self.columns_to_file()
@@ -2208,118 +4513,160 @@ class controller():
         self.split_test_train()
         print("Test size: ", self.test.shape)
         #MODELING
+        if parallel_cohorts:
+            self.run_cohorts()
+        else:
+            for cohort in self.cohorts:
+                getattr(self, cohort)()
+
+        #Save results to csv
+        print("Saving results")
+        results = pd.concat([self.mc_men.test,self.mc_women.test])
+        results = results.merge(self.mc.test[["Participant ID"]+self.mc.test.columns.tolist()[self.df.shape[1]:]])
+        print('Results shape: ', results.shape)
+        results.to_csv("results")
+
+        if self.profile != None:
+            self.save_profile()
+
+    def save_profile(self):
+        '''
+        Writes the stage and model records to <profile>.jsonl and <profile>.trace.json
+        '''
+        print("Saving profile")
+        self.dp.profiler.to_jsonl(self.profile+".jsonl")
+        self.dp.profiler.to_chrome_trace(self.profile+".trace.json")
+        print(self.dp.profiler.summary()[["name", "wall_seconds", "cpu_seconds", "peak_rss_delta", "input_rows", "output_rows"]].head(10))
 
-        #Both
+    def cohort_combined(self):
+        '''
+        COPD and CVD models on both sexes
+        '''
         print("Model construction: combined")
         self.mc = modelConstruction(df=self.df, train=self.train, 
                                     test=self.test, 
                                     evaluation_folder=self.evaluation_folder,
                                     dp=self.dp)
-        self.copd_model(self.mc)
-        self.copd_model_list = [self.mc.emphysema_model_current,
-                                self.mc.other_copd_model_current,
-                                self.mc.chronic_bronchitis_model_current,
-                                self.mc.emphysema_model_past,
-                                self.mc.other_copd_model_past
-                                ]
-        self.lr_evaluation_copd_con(construction_obj=self.mc, model_list=self.copd_model_list)
-
-        self.cvd_model(self.mc)
-        self.cvd_model_list = [self.mc.cvd_hf_model,
-                               self.mc.cvd_isch_model]
-        self.lr_evaluation_cvd_con(construction_obj=self.mc, model_list=self.cvd_model_list)
-
-        #Men only
+        if "copd" in self.diseases:
+            self.copd_model(self.mc)
+            self.mc.evaluate_models(diseases=["copd"], cohort="combined", stratisfy=self.stratisfy)
+
+        if "cvd" in self.diseases:
+            self.cvd_model(self.mc)
+            self.mc.evaluate_models(diseases=["cvd"], cohort="combined", stratisfy=self.stratisfy)
+
+    def cohort_men(self):
+        '''
+        Diabetes, osteoporosis and asthma models on men
+        '''
         print("Model construction: men only")
         self.mc_men = modelConstruction(df=self.df[self.df["Sex"]==1], 
                                         test=self.test[self.test["Sex"]==1],
                                         train=self.train[self.train["Sex"]==1],
                                         evaluation_folder=self.evaluation_folder,
                                         dp=self.dp,
-                                        sex="men")
-        self.diabetes_model(self.mc_men)
-        
-        self.diabetes_men_model_list = [self.mc_men.niddm_na_one_lada_rfmodel_one,
-                                    self.mc_men.niddm_na_one_lada_rfmodel_two ,
-                                    self.mc_men.niddm_na_one_lada_rfmodel_three ,
-                                    self.mc_men.niddm_na_one_lada_rfmodel_four ,
-                                    self.mc_men.niddm_na_five_lada_rfmodel_one ,
-                                    self.mc_men.niddm_na_five_lada_rfmodel_two ,
-                                    self.mc_men.niddm_na_five_lada_rfmodel_three ,
-                                    self.mc_men.niddm_na_five_lada_rfmodel_four ,
-                                    self.mc_men.niddm_na_fiveten_lada_rfmodel_one ,
-                                    self.mc_men.niddm_na_fiveten_lada_rfmodel_two ,
-                                    self.mc_men.niddm_na_fiveten_lada_rfmodel_three ,
-                                    self.mc_men.niddm_na_fiveten_lada_rfmodel_four ,
-                                    self.mc_men.niddm_na_ten_lada_rfrmodel_one ,
-                                    self.mc_men.niddm_na_ten_lada_rfrmodel_two ,
-                                    self.mc_men.niddm_na_ten_lada_rfrmodel_three ,
-                                    self.mc_men.niddm_na_ten_lada_rfrmodel_four ]
-        self.diabetes_men_cluster_list = [self.mc_men.niddm_na_one_lada_clustermodel,
-                                            self.mc_men.niddm_na_five_lada_clustermodel,
-                                            self.mc_men.niddm_na_fiveten_lada_clustermodel,
-                                            self.mc_men.niddm_na_ten_lada_clustermodel]
-        self.rf_evaluation_diabetes_con(construction_obj=self.mc_men, model_list=self.diabetes_men_model_list, cluster_list=self.diabetes_men_cluster_list)
-        
-        self.osteoporosis_model(construction_obj=self.mc_men)
-        self.mc_men.evaluation_osteoporosis()
-
-        self.asthma_model(construction_obj=self.mc_men)
-        self.mc_men.evaluation_asthma()
-
-        #Women only
+                                        sex="men",
+                                        n_jobs=self.dp.n_jobs,
+                                        rf_n_jobs=self.rf_n_jobs)
+        if "diabetes" in self.diseases:
+            self.diabetes_model(self.mc_men)
+            self.mc_men.evaluate_models(diseases=["diabetes"], cohort="men", stratisfy=self.stratisfy)
+
+        if "osteoporosis" in self.diseases:
+            self.osteoporosis_model(construction_obj=self.mc_men)
+            self.mc_men.evaluation_osteoporosis()
+
+        if "asthma" in self.diseases:
+            self.asthma_model(construction_obj=self.mc_men)
+            self.mc_men.evaluation_asthma()
+
+    def cohort_women(self):
+        '''
+        Diabetes, osteoporosis and asthma models on women
+        '''
         print("Model construction: women only")
         self.mc_women = modelConstruction(df=self.df[self.df["Sex"]==0], 
                                         test=self.test[self.test["Sex"]==0],
                                         train=self.train[self.train["Sex"]==0],
                                         evaluation_folder=self.evaluation_folder,
                                         dp=self.dp,
-                                        sex="women")
-        self.diabetes_model(self.mc_women)
-
-        self.diabetes_women_model_list = [self.mc_women.niddm_na_one_lada_rfmodel_one,
-                                    self.mc_women.niddm_na_one_lada_rfmodel_two ,
-                                    self.mc_women.niddm_na_one_lada_rfmodel_three ,
-                                    self.mc_women.niddm_na_one_lada_rfmodel_four ,
-                                    self.mc_women.niddm_na_five_lada_rfmodel_one ,
-                                    self.mc_women.niddm_na_five_lada_rfmodel_two ,
-                                    self.mc_women.niddm_na_five_lada_rfmodel_three ,
-                                    self.mc_women.niddm_na_five_lada_rfmodel_four ,
-                                    self.mc_women.niddm_na_fiveten_lada_rfmodel_one ,
-                                    self.mc_women.niddm_na_fiveten_lada_rfmodel_two ,
-                                    self.mc_women.niddm_na_fiveten_lada_rfmodel_three ,
-                                    self.mc_women.niddm_na_fiveten_lada_rfmodel_four ,
-                                    self.mc_women.niddm_na_ten_lada_rfrmodel_one ,
-                                    self.mc_women.niddm_na_ten_lada_rfrmodel_two ,
-                                    self.mc_women.niddm_na_ten_lada_rfrmodel_three ,
-                                    self.mc_women.niddm_na_ten_lada_rfrmodel_four ]
-        self.diabetes_women_cluster_list = [self.mc_women.niddm_na_one_lada_clustermodel,
-                                            self.mc_women.niddm_na_five_lada_clustermodel,
-                                            self.mc_women.niddm_na_fiveten_lada_clustermodel,
-                                            self.mc_women.niddm_na_ten_lada_clustermodel]
-        self.rf_evaluation_diabetes_con(construction_obj=self.mc_women, model_list=self.diabetes_women_model_list, cluster_list=self.diabetes_women_cluster_list)
-        
-        self.osteoporosis_model(construction_obj=self.mc_women)
-        self.mc_women.evaluation_osteoporosis()
-
-        self.asthma_model(construction_obj=self.mc_women)
-        self.mc_women.evaluation_asthma()
-
-        #Save results to csv
-        print("Saving results")
-        results = pd.concat([self.mc_men.test,self.mc_women.test])
-        results = results.merge(self.mc.test[["Participant ID"]+self.mc.test.columns.tolist()[self.df.shape[1]:]])
-        print('Results shape: ', results.shape)
-        results.to_csv("results")
+                                        sex="women",
+                                        n_jobs=self.dp.n_jobs,
+                                        rf_n_jobs=self.rf_n_jobs)
+        if "diabetes" in self.diseases:
+            self.diabetes_model(self.mc_women)
+            self.mc_women.evaluate_models(diseases=["diabetes"], cohort="women", stratisfy=self.stratisfy)
+
+        if "osteoporosis" in self.diseases:
+            self.osteoporosis_model(construction_obj=self.mc_women)
+            self.mc_women.evaluation_osteoporosis()
+
+        if "asthma" in self.diseases:
+            self.asthma_model(construction_obj=self.mc_women)
+            self.mc_women.evaluation_asthma()
+
+    def run_cohorts(self):
+        '''
+        Runs the cohorts in worker processes at the same time. The workers read the feature table from one
+        feature store, memory mapped so its pages are shared instead of pickled per worker. The attributes
+        a cohort sets, e.g. self.mc_men, are copied back without the train set and dataframe
+        '''
+        #Only a store holding this run's feature table can be shared, a store at path from an earlier run is stale
+        store = self.path if self.path_written else None
+        if store == None and self.file != None and featureStore.is_store(self.file) and not self.dp.compact_dtypes:
+            store = self.file
+        temporary = store == None
+        if temporary:
+            store = tempfile.mkdtemp()
+            featureStore(store).write(self.df)
+
+        index = self.df.index.to_numpy()
+        train_positions = self.df.index.get_indexer(self.train.index)
+        seeds = np.random.randint(0, 2**31-1, len(self.cohorts))
+        try:
+            with ProcessPoolExecutor(max_workers=len(self.cohorts)) as executor:
+                futures = [executor.submit(run_controller_cohort, self, cohort, store, index, train_positions, seed)
+                           for cohort, seed in zip(self.cohorts, seeds)]
+                for future in futures:
+                    attributes, records = future.result()
+                    for mc in attributes.values():
+                        if isinstance(mc, modelConstruction):
+                            mc.dp = self.dp
+                    self.__dict__.update(attributes)
+                    if self.dp.profiler != None:
+                        self.dp.profiler.extend(records)
+        finally:
+            if temporary:
+                shutil.rmtree(store, ignore_errors=True)
+
+    def __getstate__(self):
+        '''
+        Pickled for run_cohorts without the feature table, the workers read it from the feature store
+        '''
+        state = {k: v for k, v in self.__dict__.items() if k not in ("df", "train", "test")}
+        state["dp"] = self.dp.child(self.wd)
+        return state
 
     def data_preprocessing(self):
-        self.dp.factory()
+        '''
+        Builds the feature table, only the columns used by the modeling of self.diseases when a subset of
+        the diseases is modeled
+        '''
+        if set(self.diseases) == set(modelConstruction.model_requirements):
+            self.dp.factory()
+        else:
+            self.dp.factory(columns=modelConstruction.required_columns(self.diseases))
 
     def split_test_train(self):
         self.train = self.df.sample(frac = 0.80)
         self.test = self.df.drop(self.train.index)
 
     def load_file(self):
+        '''
+        Loads the dataframe from a feature store folder written with path, or from a csv file
+        '''
+        if featureStore.is_store(self.file):
+            return featureStore(self.file).read()
         return pd.read_csv(self.file, low_memory=False)
     
     def diabetes_model(self, construction_obj):
@@ -2346,69 +4693,48 @@ class controller():
         with open(self.evaluation_folder+"columns.txt", "w") as column_file:
             for i in self.df.columns.to_list():
                 column_file.write(i+"\n")
-
-    def rf_evaluation_diabetes_con(self, construction_obj, model_list, cluster_list):
-        x = 1
-        y =0
-        cc = 0
-        for model in model_list:
-            construction_obj.rf_evaluation_diabetes_rebuilt(rf_model=model, 
-                                            model_name=str(x)+"_Diabetes_"+construction_obj.sex+"_"+str(model.min_days)+"_"+str(model.max_days)+"_"+str(cc),
-                                           data_columns=construction_obj.diabetes_data_columns,
-                                           label_column='Date E11 first reported (non-insulin-dependent diabetes mellitus)_onehot',
-                                           first_occurence='Date E11 first reported (non-insulin-dependent diabetes mellitus)',
-                                           attendance_date='Date of attending assessment centre | Instance 0',
-                                           cluster_model=cluster_list[y],
-                                           current_cluster=cc,
-                                           stratisfy=self.stratisfy)
-            
-            if x % 4==0 and x !=0:
-                y+=1
-            if cc == 3:
-                cc-=4
-            cc+=1
-            x+=1
-            
-    def rf_evaluation_copd_con_deprecated(self, construction_oj, model_list):
-        cc=0
-        for model in model_list:
-            construction_oj.rf_evaluation_copd(rf_model=model, model_name="COPD_"+str(cc), 
-                                               data_columns=construction_oj.copd_data_columns, 
-                                               label_column='Date J43 first reported (emphysema)_binary' , 
-                                               first_occurence = "Date J44 first reported (other chronic obstructive pulmonary disease)",
-                                               attendance_date = 'Date of attending assessment centre | Instance 0', 
-                                               cluster_model = construction_oj.copd_clustermodel, 
-                                               cluster_columns = construction_oj.copd_cluster_columns, 
-                                               current_cluster = cc)
-            cc+=1
-
-    def lr_evaluation_copd_con(self, construction_obj, model_list):
-        x = 0
-        for model in model_list:
-            if x <= 2:
-                construction_obj.lr_evaluation_copd( model_name=model.label_column+"_current", 
-                                               lr_model=model,stratisfy=self.stratisfy )
-            else:
-                construction_obj.lr_evaluation_copd( model_name=model.label_column+"_past", 
-                                               lr_model=model, stratisfy=self.stratisfy)
-            x+=1
-
-    def lr_evaluation_cvd_con(self, construction_obj, model_list):
-        x = 0
-        modelnames = ['Date I50 first reported (heart failure)'
-            ,'Date I25 first reported (chronic ischaemic heart disease)']
-        for model in model_list:
-            construction_obj.lr_evaluation_copd( model_name=modelnames[x], 
-                                               lr_model=model,stratisfy=self.stratisfy )
-            x+=1
         
 
 #Driver code
 if __name__ == "__main__":
-    con = controller("C:/Users/keimp/", file="C:/Users/keimp/NHS/dataframe.csv",
-                     evaluation_folder="C:/Users/keimp/NHS/Code/experimental_modeling/Meta_learner/evaluations/",
+    parser = argparse.ArgumentParser(description="Lifestyle disease prediction pipeline")
+    parser.add_argument("--wd", default="C:/Users/keimp/")
+    parser.add_argument("--file", default="C:/Users/keimp/NHS/dataframe.csv", help="Prebuilt dataframe, a feature store folder or a csv file, pass an empty string to rebuild")
+    parser.add_argument("--path", default=None, help="Save the constructed dataframe to this feature store folder, or csv file when it ends with .csv")
+    parser.add_argument("--evaluation-folder", default="C:/Users/keimp/NHS/Code/experimental_modeling/Meta_learner/evaluations/")
+    parser.add_argument("--cache-dir", default=None, help="Folder for cached preprocessing stages")
+    parser.add_argument("--no-cache", action="store_true", help="Recompute all preprocessing stages")
+    parser.add_argument("--n-jobs", type=int, default=1, help="Worker processes for the preprocessing stages, cores for training the diabetes random forests")
+    parser.add_argument("--rf-n-jobs", type=int, default=None, help="n_jobs of each diabetes random forest")
+    parser.add_argument("--parallel-cohorts", action="store_true", help="Model the combined, men and women cohorts at the same time in worker processes")
+    parser.add_argument("--compact-dtypes", action="store_true", help="Downcast the feature table to the dtypes of dataPreprocessing.dtype_schema")
+    parser.add_argument("--sparse-comorbidities", action="store_true", help="Build the one hot encoded comorbidities as sparse columns, also in the feature store at --path")
+    parser.add_argument("--sharded-output", default=None, help="Only run the preprocessing, sharded by participant ID range, and write the partitions to this folder")
+    parser.add_argument("--shards", type=int, default=8, help="Number of shards for --sharded-output")
+    parser.add_argument("--diseases", nargs="+", default=None, choices=list(modelConstruction.model_requirements),
+                        help="Only build the features of and model these diseases (default is all)")
+    parser.add_argument("--profile", default=None, help="Record time, memory and row counts of every stage and model, written to PROFILE.jsonl and PROFILE.trace.json")
+    args = parser.parse_args()
+
+    if args.sharded_output != None:
+        dp = dataPreprocessing(args.wd, cache_dir=args.cache_dir, use_cache=not args.no_cache, n_jobs=args.n_jobs,
+                               compact_dtypes=args.compact_dtypes, sparse_comorbidities=args.sparse_comorbidities)
+        dp.factory_sharded(args.sharded_output, n_shards=args.shards)
+        raise SystemExit
+
+    con = controller(args.wd, file=args.file or None, path=args.path,
+                     evaluation_folder=args.evaluation_folder,
                         suppress_warnings=True,
-                        stratisfy=True)
+                        stratisfy=True,
+                        cache_dir=args.cache_dir,
+                        no_cache=args.no_cache,
+                        n_jobs=args.n_jobs,
+                        compact_dtypes=args.compact_dtypes,
+                        sparse_comorbidities=args.sparse_comorbidities,
+                        diseases=args.diseases,
+                        profile=args.profile,
+                        rf_n_jobs=args.rf_n_jobs,
+                        parallel_cohorts=args.parallel_cohorts)
 
     
     
\ No newline at end of file
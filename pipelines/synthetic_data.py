@@ -0,0 +1,375 @@
+'''
+Writes synthetic files with the paths, columns and answer encodings of the UK biobank extracts read by
+dataPreprocessing, so the pipeline can be run and timed without access to the real data:
+
+    python synthetic_data.py /tmp/biobank/ -n 500000
+    python model.py --wd /tmp/biobank/ --file ""
+'''
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+__author__ = "Keimpe Dijkstra"
+__credits__ = ["Stefan Wijtsma"]
+__license__ = "GNU GENERAL PUBLIC LICENSE Version 3, 29 June 2007"
+__version__ = "1.0.1"
+__maintainer__ = "Keimpe Dijkstra"
+__email__ = "k.dijkstra@labonovum.com"
+
+#Special dates as used by the UK biobank (coding 819)
+CODING819 = [
+    ("1900-01-01", "Code has no event date"),
+    ("1901-01-01", "Code has event date before participant's date of birth"),
+    ("1902-02-02", "Code has event date matching participant's date of birth"),
+    ("1903-03-03", "Code has event date after participant's date of birth and falls in the same calendar year as date of birth"),
+    ("2037-07-07", "Code has event date in the future and is presumed to be a place-holder or other system default"),
+]
+
+COMORBIDITIES = [
+    'hypertension', 'essential hypertension', 'high cholesterol', 'diabetes', 'asthma', 'hayfever/allergic rhinitis',
+    'eczema/dermatitis', 'pneumonia', 'angina', 'heart attack/myocardial infarction', 'osteoarthritis',
+    'chronic sinusitis', 'allergy or anaphylactic reaction to food', 'allergy or anaphylactic reaction to drug',
+    'allergy/hypersensitivity/anaphylaxis', 'asbestosis', 'bronchitis', 'nasal/sinus disorder',
+    'fracture upper arm / humerus / elbow', 'fracture lower leg / ankle', 'fracture wrist / colles fracture',
+    'rheumatic fever', 'ovarian cyst or cysts', 'hepatitis', 'hepatitis c', 'enlarged prostate', 'hiatus hernia',
+    'depression', 'ulcerative colitis', 'emphysema/chronic bronchitis', 'stroke', 'cataract', 'back problem',
+    'rheumatoid arthritis', 'epilepsy', 'hypothyroidism/myxoedema', 'peritonitis', 'duodenal ulcer',
+    'anxiety/panic attacks', 'kidney stone/ureter stone/bladder stone', 'cholelithiasis/gall stones',
+    'chronic fatigue syndrome', 'psoriasis', 'heart valve problem/heart murmur', 'multiple sclerosis',
+    'urinary frequency / incontinence', 'spine arthritis/spondylitis', 'glaucoma', 'other renal/kidney problem',
+    'ear/vestibular disorder', 'irritable bowel syndrome', 'colitis/not crohns or ulcerative colitis',
+    'diverticular disease/diverticulitis', 'hyperthyroidism/thyrotoxicosis', 'malabsorption/coeliac disease',
+    'cervical spondylosis', 'prolapsed disc/slipped disc', 'oesophagitis/barretts oesophagus', 'pleurisy',
+    'urinary tract infection/kidney infection', 'vaginal prolapse/uterine prolapse', 'muscle/soft tissue problem',
+    'crohns disease', 'anaemia', 'chronic obstructive airways disease/copd', 'heart arrhythmia', 'meningitis',
+    'other neurological problem', 'bone disorder', 'gestational hypertension/pre-eclampsia', "meniere's disease",
+    'appendicitis', 'benign breast lump', 'dry eyes', 'atrial fibrillation', 'polymyalgia rheumatica',
+    'gastric/stomach ulcers', 'osteopenia', 'rectal or colon adenoma/polyps', 'helicobacter pylori',
+    'eye/eyelid problem', 'parkinsons disease', 'joint disorder', 'varicose veins',
+    'systemic lupus erythematosis/sle', 'pernicious anaemia', "sjogren's syndrome/sicca syndrome", 'gout',
+    'migraine', 'sciatica', 'osteoporosis', 'endometriosis', 'unclassifiable'
+]
+
+FAMILY_ILLNESSES = ["Heart disease", "Stroke", "High blood pressure", "Chronic bronchitis/emphysema",
+                    "Alzheimer's disease/dementia", "Diabetes", "Parkinson's disease", "Severe depression",
+                    "Lung cancer", "Bowel cancer", "Prostate cancer", "Breast cancer", "Hip fracture"]
+
+DIABETES_DATES = ['Date E10 first reported (insulin-dependent diabetes mellitus)',
+                  'Date E11 first reported (non-insulin-dependent diabetes mellitus)',
+                  'Date E12 first reported (malnutrition-related diabetes mellitus)',
+                  'Date E13 first reported (other specified diabetes mellitus)',
+                  'Date E14 first reported (unspecified diabetes mellitus)']
+
+COPD_DATES = ['Date J40 first reported (bronchitis, not specified as acute or chronic)',
+              'Date J41 first reported (simple and mucopurulent chronic bronchitis)',
+              'Date J42 first reported (unspecified chronic bronchitis)',
+              'Date J43 first reported (emphysema)',
+              'Date J44 first reported (other chronic obstructive pulmonary disease)',
+              'Date J47 first reported (bronchiectasis)']
+
+ASTHMA_DATES = ["Date J45 first reported (asthma)", "Date J46 first reported (status asthmaticus)"]
+
+OSTEOPOROSIS_DATES = ["Date M80 first reported (osteoporosis with pathological fracture)",
+                      "Date M81 first reported (osteoporosis without pathological fracture)",
+                      "Date M82 first reported (osteoporosis in diseases classified elsewhere)"]
+
+CVD_DATES = ["Date I50 first reported (heart failure)",
+             "Date I25 first reported (chronic ischaemic heart disease)",
+             "Date I10 first reported (essential (primary) hypertension)",
+             "Date I21 first reported (acute myocardial infarction)",
+             "Date I48 first reported (atrial fibrillation and flutter)",
+             "Date I63 first reported (cerebral infarction)"]
+
+#Files of which the export has a description row before the participant rows
+PREAMBLE_FILES = ["NHS/Data_files/Grouped_files/replace/Family_history.csv"]
+
+
+class syntheticBiobank():
+    '''This class writes synthetic files shaped like the UK biobank extracts read by dataPreprocessing
+    '''
+
+    def __init__(self, wd, n_participants=10000, seed=0, chunk_size=100000, cvd_columns=None):
+        self.wd = wd
+        self.n_participants = n_participants
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.cvd_columns = CVD_DATES if cvd_columns == None else cvd_columns
+
+    def path(self, relative):
+        '''
+        Returns the path of a file relative to the working directory, creating its folder
+        '''
+        p = os.path.join(self.wd, relative)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        return p
+
+    def answers(self, rng, n, values, p=None, missing=0.0):
+        '''
+        Draws categorical answers, missing answers are returned as nan
+
+        Returns
+        -------
+        array : numpy array object
+        '''
+        a = rng.choice(np.array(values, dtype=object), size=n, p=p)
+        a[rng.random(n) < missing] = np.nan
+        return a
+
+    def numbers(self, rng, n, mean, sd, missing=0.05, decimals=1):
+        '''
+        Draws normally distributed measurements, missing measurements are returned as nan
+
+        Returns
+        -------
+        array : numpy array object
+        '''
+        a = np.round(rng.normal(mean, sd, n), decimals)
+        a[rng.random(n) < missing] = np.nan
+        return a
+
+    def multi_answers(self, rng, n, values, max_items, missing=0.1, sep="|"):
+        '''
+        Draws sets of distinct answers joined by the separator, like the array fields of the UK biobank
+
+        Returns
+        -------
+        array : numpy array object
+        '''
+        values = np.array(values, dtype=object)
+        counts = rng.integers(1, max_items+1, n)
+        #The first items of a random permutation per participant
+        items = values[np.argsort(rng.random((n, len(values))), axis=1)[:, :max_items]]
+        out = items[:, 0].copy()
+        for k in range(1, max_items):
+            out = np.where(counts > k, out + sep + items[:, k], out)
+        out[rng.random(n) < missing] = np.nan
+        return out
+
+    def event_dates(self, rng, attendance, prevalence, sentinels=(2, 3), sentinel=0.02):
+        '''
+        Draws first occurence dates around the attendance date, including special coding 819 dates
+
+        Returns
+        -------
+        array : numpy array object
+        '''
+        n = len(attendance)
+        offsets = rng.integers(-7300, 5000, n)
+        d = (attendance + offsets.astype("timedelta64[D]")).astype("datetime64[D]").astype(str).astype(object)
+        d[rng.random(n) >= prevalence] = np.nan
+        s = rng.random(n) < sentinel * prevalence
+        if len(sentinels) > 0:
+            d[s] = rng.choice(np.array([CODING819[i][1] for i in sentinels], dtype=object), size=s.sum())
+        return d
+
+    def write(self, relative, df, first):
+        '''
+        Writes the first chunk of a file with header, later chunks are appended. Files of PREAMBLE_FILES get
+        a description row between the header and the participant rows, which dataPreprocessing skips
+        '''
+        if first and relative in PREAMBLE_FILES:
+            df = pd.concat([pd.DataFrame([df.columns], columns=df.columns), df.astype(object)], ignore_index=True)
+        df.to_csv(self.path(relative), index=False, mode="w" if first else "a", header=first)
+
+    def chunk(self, rng, ids):
+        '''
+        Draws the rows of all files for a chunk of participants
+
+        Parameters
+        ----------
+        rng : numpy Generator object
+        ids : numpy array object
+            Participant IDs of the chunk
+
+        Returns
+        -------
+        out : dict
+            Dataframe per file, keyed by the path relative to the working directory
+        '''
+        n = len(ids)
+        attendance = np.datetime64("2006-03-01") + rng.integers(0, 1600, n).astype("timedelta64[D]")
+        sex = self.answers(rng, n, ["Female", "Male"])
+        height = np.round(np.where(sex == "Male", rng.normal(176, 7, n), rng.normal(163, 6.5, n)))
+        weight = np.round(rng.normal(78, 15, n), 1)
+        age = rng.integers(40, 71, n)
+        out = {}
+
+        out["NHS/Data_files/Grouped_files/replace/Demographics.csv"] = pd.DataFrame({
+            "Participant ID": ids,
+            "Sex": sex,
+            "Age at recruitment": age,
+            "Ethnic background | Instance 0": self.answers(rng, n, ['British', 'Irish', 'Any other white background', 'White and Black Caribbean',
+                                                                    'Indian', 'Pakistani', 'Caribbean', 'African', 'Chinese', 'Other ethnic group'],
+                                                                    p=[.8, .03, .04, .01, .03, .02, .02, .02, .01, .02], missing=0.005)})
+
+        out["NHS/Data_files/Grouped_files/replace/Dates_attending_assessment_centers_participant.csv"] = pd.DataFrame({
+            "Participant ID": ids,
+            "Date of attending assessment centre | Instance 0": attendance.astype(str),
+            "Year of birth": (attendance.astype("datetime64[Y]").astype(int) + 1970 - age),
+            "Date of attending assessment centre | Instance 1": self.answers(rng, n, ["2013-05-01"], missing=0.9)})
+
+        fam = {"Participant ID": ids}
+        for r in ["father", "mother", "siblings"]:
+            for i in range(4):
+                fam["Illnesses of "+r+" | Instance "+str(i)] = self.multi_answers(
+                    rng, n, FAMILY_ILLNESSES+["None of the above (group 1)", "None of the above (group 2)", "Do not know (group 1)"],
+                    3, missing=0.2 if i == 0 else 0.9)
+        out["NHS/Data_files/Grouped_files/replace/Family_history.csv"] = pd.DataFrame(fam)
+
+        bm = {"Participant ID": ids}
+        for i in ["0", "1"]:
+            m = 0.02 if i == "0" else 0.9
+            bm["Standing height | Instance "+i] = np.where(rng.random(n) < m, np.nan, height)
+            bm["Weight | Instance "+i] = np.where(rng.random(n) < m, np.nan, weight)
+            bm["Body mass index (BMI) | Instance "+i] = np.round(weight / (height/100)**2, 2)
+            bm["Whole body fat mass | Instance "+i] = self.numbers(rng, n, 25, 8, m)
+            bm["Body fat percentage | Instance "+i] = self.numbers(rng, n, 31, 8, m)
+            bm["Waist circumference | Instance "+i] = self.numbers(rng, n, 90, 13, m, 0)
+            bm["Hip circumference | Instance "+i] = self.numbers(rng, n, 103, 9, m, 0)
+            bm["Basal metabolic rate | Instance "+i] = self.numbers(rng, n, 6600, 1300, m, 0)
+            bm["Trunk fat percentage | Instance "+i] = self.numbers(rng, n, 30, 8, m)
+            bm["Arm fat percentage (left) | Instance "+i] = self.numbers(rng, n, 31, 10, m)
+            bm["Leg fat percentage (left) | Instance "+i] = self.numbers(rng, n, 32, 9, m)
+        out["NHS/Data_files/Grouped_files/replace/Body_measures.csv"] = pd.DataFrame(bm)
+
+        bb = {"Participant ID": ids}
+        for i in ["0", "1"]:
+            m = 0.1 if i == "0" else 0.95
+            bb["Glycated haemoglobin (HbA1c) | Instance "+i] = self.numbers(rng, n, 36, 7, m)
+            bb["Glycated haemoglobin (HbA1c) assay date | Instance "+i] = self.answers(rng, n, ["2010-01-01", "2011-02-02"], missing=m)
+            bb["Triglycerides | Instance "+i] = self.numbers(rng, n, 1.7, 0.9, m, 3)
+            bb["HDL cholesterol | Instance "+i] = self.numbers(rng, n, 1.45, 0.38, m, 3)
+            bb["Cholesterol | Instance "+i] = self.numbers(rng, n, 5.7, 1.1, m, 3)
+            bb["Apolipoprotein A | Instance "+i] = self.numbers(rng, n, 1.5, 0.26, m, 3)
+            bb["Apolipoprotein B | Instance "+i] = self.numbers(rng, n, 1.03, 0.24, m, 3)
+            bb["Glucose | Instance "+i] = self.numbers(rng, n, 5.1, 1.2, m, 3)
+        out["NHS/Data_files/Grouped_files/replace/Blood_biomarkers.csv"] = pd.DataFrame(bb)
+
+        bp = {"Participant ID": ids}
+        for a in ["0", "1"]:
+            bp["Diastolic blood pressure, automated reading | Instance 0 | Array "+a] = self.numbers(rng, n, 82, 10, 0.06, 0)
+            bp["Systolic blood pressure, automated reading | Instance 0 | Array "+a] = self.numbers(rng, n, 138, 19, 0.06, 0)
+        out["NHS/Data_files/Grouped_files/raw/Blood_pressure_raw.csv"] = pd.DataFrame(bp)
+
+        ub = {"Participant ID": ids}
+        for i in ["0", "1"]:
+            m = 0.03 if i == "0" else 0.95
+            ub["Creatinine (enzymatic) in urine | Instance "+i] = self.numbers(rng, n, 8900, 5500, m, 0)
+            ub["Microalbumin in urine | Instance "+i] = self.numbers(rng, n, 25, 50, 0.7, 1)
+            ub["Microalbumin in urine result flag | Instance "+i] = self.answers(rng, n, ["<6.7"], missing=0.3)
+            ub["Sodium in urine | Instance "+i] = self.numbers(rng, n, 76, 44, m, 1)
+        out["NHS/Data_files/Grouped_files/replace/Urine_biomarkers.csv"] = pd.DataFrame(ub)
+
+        medication = ["Cholesterol lowering medication", "Blood pressure medication", "Insulin", "None of the above", "Do not know"]
+        mc = {"Participant ID": ids,
+              "Non-cancer illness code, self-reported | Instance 0": self.multi_answers(rng, n, COMORBIDITIES, 4, missing=0.45),
+              "Medication for cholesterol, blood pressure or diabetes | Instance 0": self.multi_answers(rng, n, medication, 2, missing=0.55),
+              "Medication for cholesterol, blood pressure, diabetes, or take exogenous hormones | Instance 0": self.multi_answers(rng, n, medication+["Hormone replacement therapy"], 2, missing=0.5),
+              "Doctor diagnosed asthma": self.answers(rng, n, ["Yes", "No"], p=[.1, .9], missing=0.8),
+              "Diabetes diagnosed by doctor | Instance 0": self.answers(rng, n, ["Yes", "No", "Do not know", "Prefer not to answer"], p=[.05, .93, .01, .01], missing=0.01),
+              "Blood clot, DVT, bronchitis, emphysema, asthma, rhinitis, eczema, allergy diagnosed by doctor | Instance 0": self.multi_answers(
+                  rng, n, ["Hayfever, allergic rhinitis or eczema", "Emphysema/chronic bronchitis", "Asthma", "Blood clot in the leg (DVT)", "None of the above"], 2, missing=0.05),
+              "Doctor diagnosed bronchiectasis": self.answers(rng, n, ["Yes", "No"], p=[.02, .98], missing=0.8),
+              "Doctor diagnosed hayfever or allergic rhinitis": self.answers(rng, n, ["Yes", "No"], p=[.2, .8], missing=0.8),
+              "Doctor diagnosed chronic bronchitis": self.answers(rng, n, ["Yes", "No"], p=[.03, .97], missing=0.8)}
+        out["NHS/Data_files/Grouped_files/replace/Medical_conditions.csv"] = pd.DataFrame(mc)
+
+        out["NHS/Data_files/Grouped_files/replace/Alcohol.csv"] = pd.DataFrame({
+            "Participant ID": ids,
+            "Alcohol intake frequency. | Instance 0": self.answers(rng, n, ['Daily or almost daily', 'Never', 'Once or twice a week', 'One to three times a month',
+                                                                            'Special occasions only', 'Three or four times a week', 'Prefer not to answer'],
+                                                                            p=[.2, .08, .26, .11, .12, .22, .01], missing=0.002),
+            "Alcohol intake versus 10 years previously | Instance 0": self.answers(rng, n, ["More nowadays", "About the same", "Less nowadays"], missing=0.7)})
+
+        out["NHS/Data_files/Grouped_files/replace/Physical_activity.csv"] = pd.DataFrame({
+            "Participant ID": ids,
+            "Usual walking pace | Instance 0": self.answers(rng, n, ["Slow pace", "Steady average pace", "Brisk pace", "None of the above", "Prefer not to answer"],
+                                                            p=[.08, .52, .38, .01, .01], missing=0.01),
+            "Summed MET minutes per week for all activity | Instance 0": self.numbers(rng, n, 2600, 2700, 0.2, 0).clip(0),
+            "Summed minutes activity | Instance 0": self.numbers(rng, n, 700, 600, 0.2, 0).clip(0)})
+
+        sleep = self.numbers(rng, n, 7, 1.1, 0, 0).astype(object)
+        sleep[rng.random(n) < 0.01] = "Do not know"
+        sleep[rng.random(n) < 0.005] = "Prefer not to answer"
+        out["NHS/Data_files/Grouped_files/replace/Sleep.csv"] = pd.DataFrame({"Participant ID": ids, "Sleep duration | Instance 0": sleep})
+
+        smoker = self.answers(rng, n, ["Ex-smoker", "Never smoked", "Occasionally", "Smokes on most or all days", "Prefer not to answer"],
+                              p=[.34, .55, .03, .075, .005], missing=0.002)
+        out["NHS/Data_files/Grouped_files/replace/Smoking.csv"] = pd.DataFrame({
+            "Participant ID": ids,
+            "Tobacco smoking": smoker,
+            "Smoking status | Instance 0": smoker})
+
+        #Smoking details are only answered by current or former smokers
+        current = np.isin(smoker, ["Occasionally", "Smokes on most or all days"])
+        former = smoker == "Ex-smoker"
+
+        def smoking_answers(mask, values=None):
+            a = self.numbers(rng, n, 18, 5, 0, 0).astype(object) if values == None else self.answers(rng, n, values)
+            a[rng.random(n) < 0.02] = "Do not know"
+            a[rng.random(n) < 0.01] = "Prefer not to answer"
+            a[~mask] = np.nan
+            return a
+
+        ever = (current | former) & (rng.random(n) < 0.9)
+        out["NHS/Data_files/supplementary_data/smokers_data_keimpe_participant.csv"] = pd.DataFrame({
+            "eid": ids,
+            "p20161_i0": np.where(ever, self.numbers(rng, n, 23, 17, 0, 1).clip(0), np.nan),
+            "p20162_i0": np.where(ever, self.numbers(rng, n, 0.4, 0.2, 0, 3).clip(0), np.nan),
+            "p3436_i0": smoking_answers(current),
+            "p2867_i0": smoking_answers(former),
+            "p3456_i0": smoking_answers(current, ["10", "15", "20", "Less than one a day"]),
+            "p6183_i0": np.where(current & (rng.random(n) < 0.1), self.numbers(rng, n, 15, 8, 0, 0), np.nan),
+            "p2887_i0": smoking_answers(former, ["10", "15", "20", "Less than one a day"])})
+
+        wb = {"Participant ID": ids}
+        for i in ["0", "1"]:
+            m = 0.04 if i == "0" else 0.95
+            wb["Neutrophill count | Instance "+i] = self.numbers(rng, n, 4.2, 1.4, m, 2)
+            wb["Eosinophill count | Instance "+i] = self.numbers(rng, n, 0.17, 0.13, m, 2)
+            wb["Haemoglobin concentration | Instance "+i] = self.numbers(rng, n, 14.2, 1.2, m, 2)
+        out["NHS/Data_files/Separate_files/coding_option_replace/Blood_biomarkers_3.csv"] = pd.DataFrame(wb)
+
+        out["NHS/Data_files/Grouped_files/replace/Symptoms_and_pain.csv"] = pd.DataFrame({
+            "Participant ID": ids,
+            "Wheeze or whistling in the chest in last year | Instance 0": self.answers(rng, n, ["Yes", "No", "Do not know", "Prefer not to answer"],
+                                                                                       p=[.18, .8, .015, .005], missing=0.01),
+            "Chest pain or discomfort | Instance 0": self.answers(rng, n, ["Yes", "No"], missing=0.02)})
+
+        #First occurences, the sentinels are the coding 819 meanings observed in each extract
+        labels = {"NHS/Data_files/Labeling/DM_first_occurence_dates.csv": (DIABETES_DATES, [.005, .06, .001, .002, .01], (2,)),
+                  "NHS/Data_files/Labeling/copd_first_occurence_dates.csv": (COPD_DATES, [.03, .005, .01, .02, .04, .01], (1, 2, 3)),
+                  "NHS/Data_files/Labeling/asthma_first_occurence_dates.csv": (ASTHMA_DATES, [.13, .005], (1, 2, 3)),
+                  "NHS/Data_files/Labeling/osteoporosis_diagnosis_dates.csv": (OSTEOPOROSIS_DATES, [.01, .04, .002], ()),
+                  "NHS/Data_files/supplementary_data/CVD_first_occurrences_with_labels_participant.csv": (self.cvd_columns, None, (2, 3))}
+        for relative, (cols, prevalence, sentinels) in labels.items():
+            d = {"Participant ID": ids}
+            for x, c in enumerate(cols):
+                d[c] = self.event_dates(rng, attendance, 0.04 if prevalence == None else prevalence[x], sentinels)
+            out[relative] = pd.DataFrame(d)
+        return out
+
+    def generate(self):
+        '''
+        Writes all files in chunks of participants, the chunks keep memory bounded for large cohorts
+        '''
+        rng = np.random.default_rng(self.seed)
+        first = True
+        for start in range(0, self.n_participants, self.chunk_size):
+            ids = np.arange(1000000+start, 1000000+min(start+self.chunk_size, self.n_participants))
+            for relative, df in self.chunk(rng, ids).items():
+                self.write(relative, df, first)
+            first = False
+
+        pd.DataFrame(CODING819, columns=["coding", "meaning"]).to_csv(self.path("NHS/Data_files/coding/coding819.tsv"), sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic UK biobank shaped files")
+    parser.add_argument("wd")
+    parser.add_argument("-n", "--participants", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=100000, help="Participants drawn and written at a time")
+    args = parser.parse_args()
+    syntheticBiobank(args.wd, n_participants=args.participants, seed=args.seed, chunk_size=args.chunk_size).generate()